@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# benchfilediff.py - time-to-interactive of the file diff dialog
+#
+# Copyright 2012 TortoiseHg Developers
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""Time FileDiffDialog on two revisions of a large synthetic file
+
+usage: benchfilediff.py [LINES] [CHANGES]
+
+Creates a temporary repository with a file of LINES lines, and a second
+revision in which CHANGES regions are replaced, deleted or inserted.  It
+opens the file diff dialog on them and prints:
+
+- interactive: time until both texts are shown with the visible lines
+  marked, i.e. until the dialog responds to scrolling and navigation
+- filled: time until all diff markers are added
+
+A display is required (use Xvfb on headless machines).
+"""
+
+import os, sys, time, random, shutil, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mercurial import hg, ui as uimod, context, node
+
+from PyQt4.QtCore import QTimer
+from PyQt4.QtGui import QApplication
+
+from tortoisehg.hgqt import filedialogs
+
+FILENAME = 'large.txt'
+
+def makerevisions(nlines, nchanges, seed=0):
+    rnd = random.Random(seed)
+    old = ['line %d %s\n' % (i, 'x' * rnd.randint(0, 60))
+           for i in xrange(nlines)]
+    new = list(old)
+    for pos in sorted(rnd.sample(xrange(nlines), nchanges), reverse=True):
+        kind = rnd.choice('rdi')
+        size = rnd.randint(1, 200)
+        if kind == 'r':
+            new[pos:pos + size] = ['changed %d\n' % i for i in xrange(size)]
+        elif kind == 'd':
+            del new[pos:pos + size]
+        else:
+            new[pos:pos] = ['inserted %d\n' % i for i in xrange(size)]
+    return ''.join(old), ''.join(new)
+
+def build(path, nlines, nchanges):
+    u = uimod.ui()
+    u.setconfig('ui', 'quiet', True)
+    repo = hg.repository(u, path, create=True)
+    parent = node.nullid
+    for data in makerevisions(nlines, nchanges):
+        def filectxfn(repo, memctx, fn, data=data):
+            return context.memfilectx(fn, data, False, False, None)
+        ctx = context.memctx(repo, (parent, node.nullid), 'rev', [FILENAME],
+                             filectxfn, 'bench', (0, 0))
+        parent = repo.commitctx(ctx)
+    return hg.repository(u, path)
+
+class TimedFileDiffDialog(filedialogs.FileDiffDialog):
+    def __init__(self, repo, filename, starttime):
+        self.starttime = starttime
+        self.interactive = None
+        self.filled = None
+        super(TimedFileDiffDialog, self).__init__(repo, filename)
+
+    def update_diff(self, keeppos=None):
+        self.interactive = self.filled = None
+        super(TimedFileDiffDialog, self).update_diff(keeppos)
+        if None not in self.filedata.values():
+            self.interactive = time.time() - self.starttime
+            self.checkfilled()
+
+    def idle_fill_files(self):
+        super(TimedFileDiffDialog, self).idle_fill_files()
+        self.checkfilled()
+
+    def checkfilled(self):
+        if (self.interactive is not None and self.filled is None
+            and not self.timer.isActive()):
+            self.filled = time.time() - self.starttime
+            QTimer.singleShot(0, QApplication.instance().quit)
+
+def main(args):
+    nlines = args and int(args[0]) or 200000
+    nchanges = len(args) > 1 and int(args[1]) or 2000
+    app = QApplication(sys.argv)
+    tmpdir = tempfile.mkdtemp(prefix='thgbench')
+    try:
+        repo = build(os.path.join(tmpdir, 'repo'), nlines, nchanges)
+        start = time.time()
+        dlg = TimedFileDiffDialog(repo, FILENAME, start)
+        dlg.show()
+        app.exec_()
+        print '%d lines, %d changes' % (nlines, nchanges)
+        print 'interactive %8.2f s' % dlg.interactive
+        print 'filled      %8.2f s' % dlg.filled
+        dlg.timer.stop()
+        dlg.deleteLater()
+        return 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# benchfilelog.py - benchmark of graph.filelog_grapher on synthetic filelogs
+#
+# Copyright 2012 TortoiseHg Developers
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""Time the file history grapher on a synthetic, heavily edited file
+
+usage: benchfilelog.py [REVISIONS] [RENAMES] [REPEAT]
+
+Creates a temporary repository with one file modified in REVISIONS
+changesets, renamed RENAMES times along the way and branched and merged
+regularly, then prints the rows per second of filelog_grapher() over the
+whole history.  The yielded rows are checked against the file ancestry
+computed through filectx.
+"""
+
+import os, sys, time, shutil, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mercurial import hg, ui as uimod, context, node
+
+from tortoisehg.hgqt import graph
+
+BRANCHEVERY = 50   # start an anonymous branch every so many revisions
+MERGEAFTER = 10    # and merge it back that many revisions later
+
+def commit(repo, parents, path, data, copied=None, text='edit'):
+    def filectxfn(repo, memctx, fn):
+        if fn == copied:
+            raise IOError  # memctx convention for removed files
+        return context.memfilectx(fn, data, False, False, copied)
+    files = [path]
+    if copied:
+        files.append(copied)
+    p1 = parents[0]
+    p2 = len(parents) > 1 and parents[1] or node.nullid
+    ctx = context.memctx(repo, (p1, p2), text, files, filectxfn, 'bench',
+                         (0, 0))
+    return repo.commitctx(ctx)
+
+def build(path, nrevs, nrenames):
+    u = uimod.ui()
+    u.setconfig('ui', 'quiet', True)
+    repo = hg.repository(u, path, create=True)
+    renameevery = nrenames and max(nrevs // (nrenames + 1), 1) or 0
+    fname = 'file0.txt'
+    lines = ['line %d\n' % i for i in xrange(50)]
+    tip = commit(repo, [node.nullid], fname, ''.join(lines), text='add')
+    branch = None
+    for i in xrange(1, nrevs):
+        lines[i % len(lines)] = 'line %d rev %d\n' % (i % len(lines), i)
+        data = ''.join(lines)
+        if i % BRANCHEVERY == 0:
+            branch = (i, tip)
+        if branch and i - branch[0] == MERGEAFTER // 2:
+            # the side branch edits the same file
+            side = commit(repo, [branch[1]], fname, data + 'side\n')
+            branch = (branch[0], side)
+        if branch and i - branch[0] == MERGEAFTER:
+            tip = commit(repo, [tip, branch[1]], fname, data, text='merge')
+            branch = None
+        elif renameevery and i % renameevery == 0 and not branch:
+            newname = 'file%d.txt' % i
+            tip = commit(repo, [tip], newname, data, copied=fname,
+                         text='rename')
+            fname = newname
+        else:
+            tip = commit(repo, [tip], fname, data)
+    return repo, fname
+
+def ancestry(repo, fname):
+    fl = repo.file(fname)
+    revs = set()
+    for n in fl.heads():
+        fctx = repo.filectx(fname, fileid=n)
+        revs.add((fctx.rev(), fctx.path()))
+        for a in fctx.ancestors():
+            revs.add((a.rev(), a.path()))
+    return revs
+
+def bench(repo, fname, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        rows = list(graph.filelog_grapher(repo, fname))
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return rows, best
+
+def main(args):
+    nrevs = args and int(args[0]) or 5000
+    nrenames = len(args) > 1 and int(args[1]) or 5
+    repeat = len(args) > 2 and int(args[2]) or 3
+    tmpdir = tempfile.mkdtemp(prefix='thgbench')
+    try:
+        start = time.time()
+        repo, fname = build(os.path.join(tmpdir, 'repo'), nrevs, nrenames)
+        print 'built %d changesets, %d renames in %.1f s' % (
+            len(repo), nrenames, time.time() - start)
+        rows, elapsed = bench(repo, fname, repeat)
+        print '%d rows, best of %d: %.3f s, %.0f rows/s' % (
+            len(rows), repeat, elapsed, len(rows) / max(elapsed, 1e-9))
+        expected = ancestry(repo, fname)
+        found = set((r[0], r[5]) for r in rows)
+        if found != expected:
+            print 'MISMATCH: %d rows missing, %d unexpected' % (
+                len(expected - found), len(found - expected))
+            return 1
+        return 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# benchhtmlizer.py - micro-benchmark of qtlib.descriptionhtmlizer
+#
+# Copyright 2012 TortoiseHg Developers
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""Time description HTML rendering over the commit messages of a repository
+
+usage: benchhtmlizer.py [REPO] [REPEAT]
+
+Prints the throughput of uncached and cached rendering in descriptions per
+second.  Run it against the same repository before and after changing
+qtlib.descriptionhtmlizer() to spot regressions.
+"""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mercurial import hg, ui as uimod
+
+from tortoisehg.hgqt import qtlib
+
+def corpus(repo):
+    cl = repo.changelog
+    return [(cl.node(r), cl.read(cl.node(r))[4]) for r in repo]
+
+def bench(htmlize, descs, repeat, cached):
+    best = None
+    for i in xrange(repeat):
+        qtlib._deschtmlcache.clear()
+        if cached:
+            # warm the cache, then time the lookups only
+            for node, desc in descs:
+                htmlize(desc, cachekey=node)
+        start = time.time()
+        if cached:
+            for node, desc in descs:
+                htmlize(desc, cachekey=node)
+        else:
+            for node, desc in descs:
+                htmlize(desc)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main(args):
+    path = args and args[0] or '.'
+    repeat = len(args) > 1 and int(args[1]) or 5
+    u = uimod.ui()
+    repo = hg.repository(u, path)
+    descs = corpus(repo)
+    if not descs:
+        sys.stderr.write('no changesets in %s\n' % path)
+        return 1
+    htmlize = qtlib.descriptionhtmlizer(repo.ui)
+    size = sum(len(d) for n, d in descs)
+    print '%d descriptions, %d bytes, best of %d' % (len(descs), size, repeat)
+    for label, cached in (('uncached', False), ('cached', True)):
+        elapsed = bench(htmlize, descs, repeat, cached)
+        print '%-9s %10.0f desc/s %8.2f MB/s' % (
+            label, len(descs) / max(elapsed, 1e-9),
+            size / max(elapsed, 1e-9) / 1e6)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
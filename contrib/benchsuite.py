@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+#
+# benchsuite.py - headless benchmarks of hgqt models, graphers and threads
+#
+# Copyright 2012 TortoiseHg Developers
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""Time the hgqt models, graphers and worker threads on synthetic repositories
+
+usage: benchsuite.py [options] [BENCHMARK...]
+
+Builds temporary repositories of the requested shapes:
+
+- linear: one line of history editing a few files per changeset
+- branches: named branches developed in parallel and merged regularly
+- tags: linear history with a tag every few changesets
+- manifest: a huge manifest with few changesets touching it
+- filelog: a single file edited, renamed and merged in every changeset
+
+and times the selected benchmarks (all by default) on each of them:
+
+""" # the list of benchmarks is appended below
+
+import os, sys, re, time, json, shutil, tempfile, subprocess, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mercurial import hg, ui as uimod, context, node, util
+
+from PyQt4.QtCore import QModelIndex, Qt, QT_VERSION_STR, PYQT_VERSION_STR
+from PyQt4.QtGui import QApplication
+
+from tortoisehg.hgqt import graph, repomodel, manifestmodel, status, grep
+from tortoisehg.hgqt import thgrepo
+from tortoisehg.util import cachethg, version as thgversion
+
+import benchfilelog
+
+DIRS = 10          # top-level directories of the synthetic working copies
+EDITS = 3          # files changed by each ordinary changeset
+BRANCHES = 8       # named branches of the 'branches' shape
+MERGEEVERY = 7     # merge a named branch into default this often
+TAGEVERY = 5       # tag a changeset this often in the 'tags' shape
+MANIFESTSCALE = 100  # the 'manifest' shape has files * MANIFESTSCALE files
+PATTERN = 'line 1'
+
+def filename(i):
+    return 'dir%d/sub%d/file%d.txt' % (i % DIRS, i // DIRS % DIRS, i)
+
+def content(i, rev=0):
+    lines = ['line %d of file %d\n' % (n, i) for n in xrange(20)]
+    lines[rev % 20] = 'line %d edited in %d\n' % (rev % 20, rev)
+    return ''.join(lines)
+
+def commit(repo, parents, files, text='edit', extra=None):
+    '''Commit {path: data} on top of parents; None data removes the file'''
+    def filectxfn(repo, memctx, fn):
+        if files[fn] is None:
+            raise IOError  # memctx convention for removed files
+        return context.memfilectx(fn, files[fn], False, False, None)
+    p1 = parents[0]
+    p2 = len(parents) > 1 and parents[1] or node.nullid
+    ctx = context.memctx(repo, (p1, p2), text, sorted(files), filectxfn,
+                         'bench', (0, 0), extra)
+    return repo.commitctx(ctx)
+
+def edits(rev, nfiles):
+    return dict((filename(i), content(i, rev))
+                for i in ((rev * EDITS + k) % nfiles for k in xrange(EDITS)))
+
+def buildlinear(repo, nrevs, nfiles, tagevery=0):
+    tip = commit(repo, [node.nullid],
+                 dict((filename(i), content(i)) for i in xrange(nfiles)),
+                 text='add')
+    tags = []
+    for rev in xrange(1, nrevs):
+        files = edits(rev, nfiles)
+        if tagevery and rev % tagevery == 0:
+            tags.append('%s v%d\n' % (node.hex(tip), rev))
+            files['.hgtags'] = ''.join(tags)
+        tip = commit(repo, [tip], files)
+
+def buildbranches(repo, nrevs, nfiles):
+    default = commit(repo, [node.nullid],
+                     dict((filename(i), content(i)) for i in xrange(nfiles)),
+                     text='add')
+    heads = {}
+    for rev in xrange(1, nrevs):
+        name = 'branch%d' % (rev % BRANCHES)
+        files = edits(rev, nfiles)
+        if rev % MERGEEVERY == 0 and name in heads:
+            default = commit(repo, [default, heads.pop(name)], files,
+                             text='merge')
+        elif rev % BRANCHES == 0:
+            default = commit(repo, [default], files)
+        else:
+            heads[name] = commit(repo, [heads.get(name, default)], files,
+                                 extra={'branch': name})
+
+def buildmanifest(repo, nrevs, nfiles):
+    nfiles *= MANIFESTSCALE
+    buildlinear(repo, max(nrevs // MANIFESTSCALE, 2), nfiles)
+
+SHAPES = {
+    'linear': buildlinear,
+    'branches': buildbranches,
+    'tags': lambda repo, nrevs, nfiles: buildlinear(repo, nrevs, nfiles,
+                                                    TAGEVERY),
+    'manifest': buildmanifest,
+}
+SHAPEORDER = ['linear', 'branches', 'tags', 'manifest', 'filelog']
+
+def build(path, shape, nrevs, nfiles):
+    '''Create the repository and its working copy; return the repository
+    and the file to use for the file history benchmarks'''
+    u = uimod.ui()
+    u.setconfig('ui', 'quiet', True)
+    if shape == 'filelog':
+        repo, fname = benchfilelog.build(path, nrevs, 5)
+    else:
+        repo = hg.repository(u, path, create=True)
+        SHAPES[shape](repo, nrevs, nfiles)
+        fname = filename(0)
+    repo = hg.repository(u, path)
+    hg.clean(repo, repo['tip'].node(), show_stats=False)
+    # a dirty working copy for the status benchmarks
+    for i, f in enumerate(sorted(repo['.'].manifest())):
+        if i % 10 == 0:
+            fp = open(repo.wjoin(f), 'ab')
+            fp.write('modified\n')
+            fp.close()
+        if i % 25 == 0:
+            fp = open(repo.wjoin(f) + '.orig', 'wb')
+            fp.write('unknown\n')
+            fp.close()
+    return thgrepo.repository(u, path), fname
+
+# Each benchmark takes the repository and the file name; it does its setup
+# and returns the function to time, which returns the number of items
+# processed
+
+def benchrevgraph(repo, fname):
+    return lambda: len(list(graph.revision_grapher(repo)))
+
+def benchfilegraph(repo, fname):
+    return lambda: len(list(graph.filelog_grapher(repo, fname)))
+
+def _loadrepomodel(repo):
+    model = repomodel.HgRepoListModel(repo, 'benchsuite', None, '', False,
+                                      None)
+    while not model.graph.isfilled():
+        model.graph.build_nodes(nnodes=model.fill_step)
+    model.updateRowCount()
+    return model
+
+def benchrepomodelload(repo, fname):
+    def run():
+        return _loadrepomodel(repo).rowCount(QModelIndex())
+    return run
+
+def benchrepomodeldata(repo, fname):
+    model = _loadrepomodel(repo)
+    roles = sorted(model._roleoffsets)
+    def run():
+        n = 0
+        for row in xrange(model.rowCount(QModelIndex())):
+            for col in xrange(model.columnCount(QModelIndex())):
+                index = model.index(row, col)
+                for role in roles:
+                    model.data(index, role)
+                    n += 1
+        return n
+    return run
+
+def benchmanifestmodel(repo, fname):
+    rev = len(repo) - 1
+    def run():
+        model = manifestmodel.ManifestModel(repo, rev=rev)
+        model.rowCount(QModelIndex())
+        return len(repo[rev].manifest())
+    return run
+
+def benchstatus(repo, fname):
+    opts = dict(modified=True, added=True, removed=True, deleted=True,
+                unknown=True, clean=False, ignored=False, subrepo=True)
+    thread = status.StatusThread(repo, None, [], opts)
+    def run():
+        thread.start()
+        thread.wait()
+        return len(thread.wctx.modified()) + len(thread.wctx.unknown())
+    return run
+
+def benchcachethg(repo, fname):
+    cachethg.overlay_cache = {}
+    cachethg.cache_root = cachethg.cache_pdir = None
+    dirs = []
+    for dirpath, dirnames, filenames in os.walk(repo.root):
+        if '.hg' in dirnames:
+            dirnames.remove('.hg')
+        dirs.append([os.path.join(dirpath, f) for f in dirnames + filenames])
+    def run():
+        # what a file manager asks while browsing every directory once
+        n = 0
+        for paths in dirs:
+            for path in paths:
+                cachethg.get_states(path)
+                n += 1
+        return n
+    return run
+
+def _grepthread(thread):
+    found = []
+    thread.matchedRow.connect(found.append, Qt.DirectConnection)
+    def run():
+        thread.start()
+        thread.wait()
+        return len(found)
+    return run
+
+def benchgrephistory(repo, fname):
+    return _grepthread(grep.HistorySearchThread(repo, PATTERN, False, [], [],
+                                                False))
+
+def benchgrepctx(repo, fname):
+    return _grepthread(grep.CtxSearchThread(repo, re.compile(PATTERN),
+                                            repo['tip'], [], [], False,
+                                            False))
+
+BENCHMARKS = [
+    ('revision_grapher', benchrevgraph,
+     'graph.revision_grapher() over the whole history'),
+    ('filelog_grapher', benchfilegraph,
+     'graph.filelog_grapher() over a frequently edited file'),
+    ('repomodel_load', benchrepomodelload,
+     'HgRepoListModel construction and graph fill'),
+    ('repomodel_data', benchrepomodeldata,
+     'HgRepoListModel.data() for every cell and role'),
+    ('manifestmodel', benchmanifestmodel,
+     'ManifestModel construction of the tip manifest'),
+    ('status', benchstatus,
+     'StatusThread on a dirty working copy'),
+    ('cachethg', benchcachethg,
+     'cachethg.get_states() of every path, directory by directory'),
+    ('grep_history', benchgrephistory,
+     'HistorySearchThread for %r' % PATTERN),
+    ('grep_ctx', benchgrepctx,
+     'CtxSearchThread for %r in the tip' % PATTERN),
+]
+
+__doc__ += ''.join('- %s: %s\n' % (name, desc)
+                   for name, func, desc in BENCHMARKS)
+__doc__ += """
+The results are printed, and written as JSON with --output so that they
+can be compared between releases.  Without a display on X11, the suite
+runs on an Xvfb server started for the occasion.
+"""
+
+def startxvfb():
+    '''Start a private X server if Qt has no display; return its process'''
+    if (os.name != 'posix' or sys.platform == 'darwin'
+        or os.environ.get('DISPLAY')):
+        return None
+    xvfb = util.findexe('Xvfb')
+    if not xvfb:
+        raise util.Abort('no DISPLAY and no Xvfb found')
+    for n in xrange(90, 200):
+        if not (os.path.exists('/tmp/.X%d-lock' % n)
+                or os.path.exists('/tmp/.X11-unix/X%d' % n)):
+            break
+    devnull = open(os.devnull, 'wb')
+    proc = subprocess.Popen([xvfb, ':%d' % n, '-screen', '0', '1280x1024x24',
+                             '-nolisten', 'tcp'],
+                            stdout=devnull, stderr=devnull)
+    for i in xrange(100):
+        if os.path.exists('/tmp/.X11-unix/X%d' % n) or proc.poll() is not None:
+            break
+        time.sleep(0.05)
+    if proc.poll() is not None:
+        raise util.Abort('Xvfb failed to start')
+    os.environ['DISPLAY'] = ':%d' % n
+    return proc
+
+def timeit(func, repo, fname, repeat):
+    runs = []
+    items = 0
+    for i in xrange(repeat):
+        run = func(repo, fname)
+        start = time.time()
+        items = run()
+        runs.append(time.time() - start)
+    return runs, items
+
+def main(args):
+    parser = optparse.OptionParser(usage=__doc__.rstrip())
+    parser.add_option('-s', '--shapes', default=','.join(SHAPEORDER),
+                      help='comma separated repository shapes [%default]')
+    parser.add_option('-r', '--revs', type='int', default=2000,
+                      help='changesets per repository [%default]')
+    parser.add_option('-f', '--files', type='int', default=200,
+                      help='files per working copy [%default]')
+    parser.add_option('-n', '--repeat', type='int', default=3,
+                      help='runs of each benchmark [%default]')
+    parser.add_option('-o', '--output', help='write the results as JSON')
+    opts, names = parser.parse_args(args)
+    shapes = [s for s in opts.shapes.split(',') if s]
+    for s in shapes:
+        if s not in SHAPEORDER:
+            parser.error('unknown shape: %s' % s)
+    unknown = set(names) - set(b[0] for b in BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: %s' % ' '.join(sorted(unknown)))
+    benchmarks = [b for b in BENCHMARKS if not names or b[0] in names]
+
+    xvfb = startxvfb()
+    tmpdir = tempfile.mkdtemp(prefix='thgbench')
+    try:
+        app = QApplication([sys.argv[0]])
+        results = []
+        for shape in shapes:
+            start = time.time()
+            repo, fname = build(os.path.join(tmpdir, shape), shape,
+                                opts.revs, opts.files)
+            built = time.time() - start
+            print '%s: %d changesets, %d files, built in %.1f s' % (
+                shape, len(repo), len(repo['tip'].manifest()), built)
+            for name, func, desc in benchmarks:
+                runs, items = timeit(func, repo, fname, opts.repeat)
+                best = min(runs)
+                print '  %-18s %9.3f s %10d items %12.0f items/s' % (
+                    name, best, items, items / max(best, 1e-9))
+                results.append({'shape': shape, 'benchmark': name,
+                                'best': best, 'runs': runs, 'items': items,
+                                'changesets': len(repo)})
+        if opts.output:
+            report = {
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'tortoisehg': thgversion.version(),
+                'mercurial': util.version(),
+                'python': sys.version.split()[0],
+                'qt': QT_VERSION_STR,
+                'pyqt': PYQT_VERSION_STR,
+                'platform': sys.platform,
+                'revs': opts.revs,
+                'files': opts.files,
+                'repeat': opts.repeat,
+                'results': results,
+            }
+            fp = open(opts.output, 'w')
+            try:
+                json.dump(report, fp, indent=1, sort_keys=True)
+            finally:
+                fp.close()
+        return 0
+    finally:
+        shutil.rmtree(tmpdir)
+        if xvfb:
+            xvfb.terminate()
+            xvfb.wait()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -34,9 +34,10 @@ demandimport.enable()
 
 import subprocess
 import urllib
+import threading
+import Queue
 
 from mercurial import hg, ui, match, util, error
-from mercurial.node import short
 
 def _thg_path():
     # check if caja-thg.py is a symlink first
@@ -60,14 +61,128 @@ else:
 # avoid breaking other Python caja extensions
 demandimport.disable()
 
+# Worker calls gobject.idle_add() from its thread
+gobject.threads_init()
+
 nofilecmds = 'about serve synch repoconfig userconfig merge unmerge'.split()
 
+cache2state = {cachethg.UNCHANGED:   ('default',   'clean'),
+               cachethg.ADDED:       ('new',       'added'),
+               cachethg.MODIFIED:    ('important', 'modified'),
+               cachethg.UNKNOWN:     (None,        'unrevisioned'),
+               cachethg.IGNORED:     ('noread',    'ignored'),
+               cachethg.NOT_IN_REPO: (None,        'unrevisioned'),
+               cachethg.ROOT:        ('generic',   'root'),
+               cachethg.UNRESOLVED:  ('danger',    'unresolved')}
+
+class RepoCache(object):
+    '''Repositories opened by one thread, the most recently used last
+
+    A repository taken from the cache is invalidated, so that changes
+    made since its last use are seen; its files are only read again
+    when needed.  It is opened again if its .hg/hgrc has been modified,
+    as the configuration is only read when opening.
+    '''
+
+    maxrepos = 8
+
+    def __init__(self):
+        self.repos = []  # [(root, repo, hgrc mtime)]
+
+    def get(self, root):
+        try:
+            stamp = os.stat(os.path.join(root, '.hg', 'hgrc')).st_mtime
+        except EnvironmentError:
+            stamp = None
+        repo = None
+        for i, (r, cached, s) in enumerate(self.repos):
+            if r == root:
+                del self.repos[i]
+                if s == stamp:
+                    repo = cached
+                    repo.invalidate()
+                    repo.dirstate.invalidate()
+                break
+        if repo is None:
+            repo = hg.repository(ui.ui(), path=root)
+        self.repos.append((root, repo, stamp))
+        del self.repos[:-self.maxrepos]
+        return repo
+
+def _loadmodules():
+    '''Load the modules used by the worker which demandimport left as
+    proxies, so that the worker thread and the main loop never load the
+    same module at the same time'''
+    from mercurial import context, scmutil
+    for mod in (hg, ui, match, util, error, context, scmutil, cachethg):
+        mod.__dict__
+    for name in ('hg', 'ui', 'util', 'node', 'merge', 'error', 'scmutil'):
+        getattr(cachethg, name).__dict__
+
+class Worker(object):
+    '''Run queries in a background thread, which has its own RepoCache,
+    and pass their results to callbacks in the GTK main loop'''
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.repos = RepoCache()
+        self.thread = None
+
+    def submit(self, func, callback, *args):
+        '''Call func(repocache, *args) in the background, then
+        callback(result) in the main loop; result is None on error'''
+        if self.thread is None:
+            _loadmodules()
+            self.thread = threading.Thread(target=self.run, name='caja-thg')
+            self.thread.setDaemon(True)
+            self.thread.start()
+        self.queue.put((func, callback, args))
+
+    def run(self):
+        while True:
+            func, callback, args = self.queue.get()
+            try:
+                result = func(self.repos, *args)
+            except Exception, e:
+                debugf(e)
+                result = None
+            gobject.idle_add(self.deliver, callback, result)
+
+    def deliver(self, callback, result):
+        callback(result)
+        return False
+
+def query_file_info(repos, root, path):
+    '''Status and last change of the file at path; runs in the worker'''
+    repo = repos.get(root)
+    localpath = path[len(root)+1:]
+    state = cachethg.get_states_batch([path], repo)[path][:1]
+
+    ctx = repo['.']
+    try:
+        fctx = ctx.filectx(localpath)
+        rev = fctx.filelog().linkrev(fctx.filerev())
+    except:
+        rev = ctx.rev()
+    ctx = repo.changectx(rev)
+    return {
+        'status': cache2state.get(state, (None, '?'))[1],
+        'rev': str(rev),
+        'description': ctx.description(),
+        'date': util.datestr(ctx.date(), '%Y-%m-%d %H:%M:%S %1%2'),
+        'user': ctx.user(),
+        'tags': ', '.join(ctx.tags()),
+        'branch': ctx.branch(),
+        }
+
 class HgExtensionDefault:
 
     def __init__(self):
         self.scanStack = []
         self.allvfs = {}
         self.inv_dirs = set()
+        self.repos = RepoCache()
+        self.worker = Worker()
 
         from tortoisehg.util import menuthg
         self.hgtk = paths.find_in_path(thg_main)
@@ -114,7 +229,7 @@ class HgExtensionDefault:
         if not p:
             return None
         try:
-            return hg.repository(ui.ui(), path=p)
+            return self.repos.get(p)
         except error.RepoError:
             return None
         except StandardError, e:
@@ -225,14 +340,6 @@ class HgExtensionDefault:
 
     def _get_file_status(self, localpath, repo=None):
         cachestate = cachethg.get_state(localpath, repo)
-        cache2state = {cachethg.UNCHANGED:   ('default',   'clean'),
-                       cachethg.ADDED:       ('new',       'added'),
-                       cachethg.MODIFIED:    ('important', 'modified'),
-                       cachethg.UNKNOWN:     (None,        'unrevisioned'),
-                       cachethg.IGNORED:     ('noread',    'ignored'),
-                       cachethg.NOT_IN_REPO: (None,        'unrevisioned'),
-                       cachethg.ROOT:        ('generic',   'root'),
-                       cachethg.UNRESOLVED:  ('danger',    'unresolved')}
         emblem, status = cache2state.get(cachestate, (None, '?'))
         return emblem, status
 
@@ -281,69 +388,74 @@ class HgExtensionDefault:
         self.inv_dirs.clear()
 
     # property page borrowed from http://www.gnome.org/~gpoo/hg/nautilus-hg/
-    def __add_row(self, row, label_item, label_value):
+    def __add_row(self, table, row, label_item, label_value):
         label = gtk.Label(label_item)
         label.set_use_markup(True)
         label.set_alignment(1, 0)
-        self.table.attach(label, 0, 1, row, row + 1, gtk.FILL, gtk.FILL, 0, 0)
-        label.show()
-
-        label = gtk.Label(label_value)
-        label.set_use_markup(True)
-        label.set_alignment(0, 1)
-        label.show()
-        self.table.attach(label, 1, 2, row, row + 1, gtk.FILL, 0, 0, 0)
+        table.attach(label, 0, 1, row, row + 1, gtk.FILL, gtk.FILL, 0, 0)
+
+        value = gtk.Label(label_value)
+        value.set_use_markup(True)
+        value.set_alignment(0, 1)
+        table.attach(value, 1, 2, row, row + 1, gtk.FILL, 0, 0, 0)
+        return label, value
+
+    propertyrows = [('status', 'Status'),
+                    ('rev', 'Last-Commit-Revision'),
+                    ('description', 'Last-Commit-Description'),
+                    ('date', 'Last-Commit-Date'),
+                    ('user', 'Last-Commit-User'),
+                    ('tags', 'Tags'),
+                    ('branch', 'Branch')]
 
     def get_property_pages(self, vfs_files):
+        '''Property page for a single file; it is filled in when the
+        background worker has read the repository'''
         if len(vfs_files) != 1:
             return
         file = vfs_files[0]
         path = self.get_path_for_vfs_file(file)
         if path is None or file.is_directory():
             return
-        repo = self.get_repo_for_path(path)
-        if repo is None:
+        root = paths.find_root(path)
+        if root is None:
             return
-        localpath = path[len(repo.root)+1:]
-        emblem, status = self._get_file_status(path, repo)
 
-        # Get the information from Mercurial
-        ctx = repo['.']
-        try:
-            fctx = ctx.filectx(localpath)
-            rev = fctx.filelog().linkrev(fctx.filerev())
-        except:
-            rev = ctx.rev()
-        ctx = repo.changectx(rev)
-        node = short(ctx.node())
-        date = util.datestr(ctx.date(), '%Y-%m-%d %H:%M:%S %1%2')
-        parents = '\n'.join([short(p.node()) for p in ctx.parents()])
-        description = ctx.description()
-        user = ctx.user()
-        user = markup_escape_text(user)
-        tags = ', '.join(ctx.tags())
-        branch = ctx.branch()
-
-        self.property_label = gtk.Label('Mercurial')
-
-        self.table = gtk.Table(7, 2, False)
-        self.table.set_border_width(5)
-        self.table.set_row_spacings(5)
-        self.table.set_col_spacings(5)
-
-        self.__add_row(0, '<b>Status</b>:', status)
-        self.__add_row(1, '<b>Last-Commit-Revision</b>:', str(rev))
-        self.__add_row(2, '<b>Last-Commit-Description</b>:', description)
-        self.__add_row(3, '<b>Last-Commit-Date</b>:', date)
-        self.__add_row(4, '<b>Last-Commit-User</b>:', user)
-        if tags:
-            self.__add_row(5, '<b>Tags</b>:', tags)
-        if branch != 'default':
-            self.__add_row(6, '<b>Branch</b>:', branch)
-
-        self.table.show()
+        property_label = gtk.Label('Mercurial')
+
+        table = gtk.Table(len(self.propertyrows), 2, False)
+        table.set_border_width(5)
+        table.set_row_spacings(5)
+        table.set_col_spacings(5)
+        rows = {}
+        for i, (key, title) in enumerate(self.propertyrows):
+            rows[key] = self.__add_row(table, i, '<b>%s</b>:' % title, '')
+        rows['status'][1].set_markup('<i>reading...</i>')
+        for widget in rows['status']:
+            widget.show()
+        alive = [True]
+        table.connect('destroy', lambda w: alive.__setitem__(0, False))
+
+        def fill(info):
+            if not alive[0]:
+                return
+            if info is None:
+                rows['status'][1].set_markup('<i>unavailable</i>')
+                return
+            for key, title in self.propertyrows:
+                value = info[key]
+                if key == 'tags' and not value:
+                    continue
+                if key == 'branch' and value == 'default':
+                    continue
+                rows[key][1].set_markup(markup_escape_text(value))
+                for widget in rows[key]:
+                    widget.show()
+
+        self.worker.submit(query_file_info, fill, root, path)
+        table.show()
         return caja.PropertyPage("MercurialPropertyPage::status",
-                                     self.property_label, self.table),
+                                     property_label, table),
 
 class HgExtensionIcons(HgExtensionDefault):
 
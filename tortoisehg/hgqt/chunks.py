@@ -6,7 +6,9 @@
 # of the GNU General Public License, incorporated herein by reference.
 
 import cStringIO
+import copy
 import os
+import time
 
 from mercurial import hg, util, patch, commands, cmdutil
 from mercurial import match as matchmod, ui as uimod
@@ -27,6 +29,70 @@ from PyQt4 import Qsci
 
 qsci = Qsci.QsciScintilla
 
+class HunkCache(object):
+    """Parsed hunks of working files, shared by all ChunksWidgets
+
+    Entries are keyed by repository and file, and are valid while the
+    file's size and mtime, its dirstate entry and the working directory
+    parent are unchanged.  Entries computed within a second of the file's
+    mtime are not trusted, since the file may have been written again
+    without changing its size or mtime.  Callers get copies of the hunks,
+    which they may modify.
+    """
+
+    maxfiles = 500
+
+    def __init__(self):
+        self._entries = {}  # {(root, wfile): (key, chunks, time computed)}
+
+    def _key(self, repo, ctx, wfile):
+        try:
+            st = os.lstat(repo.wjoin(wfile))
+            stat = (st.st_size, st.st_mtime)
+        except EnvironmentError:
+            stat = None
+        return (stat, repo.dirstate[wfile], ctx.p1().node())
+
+    def get(self, repo, ctx, wfile):
+        'Return [header] + hunks of the changes of wfile in ctx'
+        key = self._key(repo, ctx, wfile)
+        entry = self._entries.get((repo.root, wfile))
+        if (entry and entry[0] == key
+            and not (key[0] and key[0][1] >= entry[2] - 1)):
+            return [copy.copy(c) for c in entry[1]]
+        return self.update(repo, ctx, wfile, key)
+
+    def update(self, repo, ctx, wfile, key=None):
+        'Recompute the hunks of wfile, after it has been changed by us'
+        if key is None:
+            key = self._key(repo, ctx, wfile)
+        now = time.time()
+        buf = cStringIO.StringIO()
+        diffopts = patch.diffopts(repo.ui, {'git':True})
+        m = matchmod.exact(repo.root, repo.root, [wfile])
+        for p in patch.diff(repo, ctx.p1().node(), None, match=m,
+                            opts=diffopts):
+            buf.write(p)
+        buf.seek(0)
+        chunks = record.parsepatch(buf)
+        if chunks:
+            header = chunks[0]
+            chunks = [header] + header.hunks
+        if len(self._entries) >= self.maxfiles:
+            self._entries.clear()
+        self._entries[(repo.root, wfile)] = (key, chunks, now)
+        return [copy.copy(c) for c in chunks]
+
+    def invalidate(self, repo, wfile=None):
+        if wfile is not None:
+            self._entries.pop((repo.root, wfile), None)
+            return
+        for k in self._entries.keys():
+            if k[0] == repo.root:
+                del self._entries[k]
+
+_hunkcache = HunkCache()
+
 class ChunksWidget(QWidget):
 
     linkActivated = pyqtSignal(QString)
@@ -44,6 +110,7 @@ class ChunksWidget(QWidget):
         self.repo = repo
         self.multiselectable = multiselectable
         self.currentFile = None
+        self.currentStatus = None
 
         layout = QVBoxLayout(self)
         layout.setSpacing(0)
@@ -157,10 +224,21 @@ class ChunksWidget(QWidget):
                 newmtime = os.path.getmtime(path)
                 if mtime != newmtime:
                     self.mtime = newmtime
-                    self.refresh()
+                    if isinstance(ctx, patchctx):
+                        self.refresh()
+                    else:
+                        self.refreshCurrentFile()
         except EnvironmentError:
             pass
 
+    def refreshCurrentFile(self):
+        '''Redisplay the current working file after it changed on disk;
+        the file list is only reloaded if the file has no changes left'''
+        if self.getChunksForFile(self.currentFile):
+            self.diffbrowse.displayFile(self.currentFile, self.currentStatus)
+        else:
+            self.refresh()
+
     def runPatcher(self, fp, wfile, updatestate):
         ui = self.repo.ui.copy()
         class warncapt(ui.__class__):
@@ -293,6 +371,7 @@ class ChunksWidget(QWidget):
                     self.runPatcher(fp, self.currentFile, False)
                 finally:
                     wlock.release()
+            _hunkcache.update(repo, ctx, self.currentFile)
             self.fileModified.emit()
 
     def mergeChunks(self, wfile, chunks):
@@ -359,10 +438,11 @@ class ChunksWidget(QWidget):
             fp.seek(0)
             wlock = repo.wlock()
             try:
-                return self.runPatcher(fp, wfile, True)
+                ok = self.runPatcher(fp, wfile, True)
             finally:
                 wlock.release()
-            return False
+            _hunkcache.update(repo, ctx, wfile)
+            return ok
 
     def getFileList(self):
         return self.ctx.files()
@@ -395,6 +475,7 @@ class ChunksWidget(QWidget):
                                 no_backup=True)
                 if wasadded and os.path.exists(fullpath):
                     os.unlink(fullpath)
+                _hunkcache.invalidate(repo, wfile)
             except EnvironmentError:
                 qtlib.InfoMsgBox(_("Unable to remove"),
                                  _("Unable to remove file %s,\n"
@@ -411,19 +492,7 @@ class ChunksWidget(QWidget):
             else:
                 return []
         else:
-            buf = cStringIO.StringIO()
-            diffopts = patch.diffopts(repo.ui, {'git':True})
-            m = matchmod.exact(repo.root, repo.root, [wfile])
-            for p in patch.diff(repo, ctx.p1().node(), None, match=m,
-                                opts=diffopts):
-                buf.write(p)
-            buf.seek(0)
-            chunks = record.parsepatch(buf)
-            if chunks:
-                header = chunks[0]
-                return [header] + header.hunks
-            else:
-                return []
+            return _hunkcache.get(repo, ctx, wfile)
 
     @pyqtSlot(QString, QString)
     def displayFile(self, file, status):
@@ -432,6 +501,7 @@ class ChunksWidget(QWidget):
             status = hglib.fromunicode(status)
         if file:
             self.currentFile = file
+            self.currentStatus = status
             path = self.repo.wjoin(file)
             if os.path.exists(path):
                 self.mtime = os.path.getmtime(path)
@@ -669,7 +739,11 @@ class DiffBrowser(QFrame):
         self._lastfile = filename
         self.clearChunks()
 
-        fd = filedata.FileData(self._ctx, None, filename, status)
+        # the hunks of modified working files come from the hunk cache,
+        # which ChunksWidget.getChunksForFile() has usually filled already
+        cached = self._ctx.rev() is None and status == 'M'
+        fd = filedata.FileData(self._ctx, None, filename, status,
+                               withdiff=not cached)
 
         if fd.elabel:
             self.extralabel.setText(fd.elabel)
@@ -678,14 +752,23 @@ class DiffBrowser(QFrame):
             self.extralabel.hide()
         self.filenamelabel.setText(fd.flabel)
 
-        if not fd.isValid() or not fd.diff:
-            self.sci.setText(fd.error or '')
-            return
+        if not fd.isValid():
+            chunks = []
+        elif cached:
+            if fd.olddata is None:
+                chunks = []
+            else:
+                chunks = _hunkcache.get(self._ctx._repo, self._ctx, filename)
+        elif not fd.diff:
+            chunks = []
         elif type(self._ctx.rev()) is str:
             chunks = self._ctx._files[filename]
         else:
             header = record.parsepatch(cStringIO.StringIO(fd.diff))[0]
             chunks = [header] + header.hunks
+        if len(chunks) < 2:
+            self.sci.setText(fd.error or '')
+            return
 
         utext = []
         for chunk in chunks[1:]:
@@ -0,0 +1,246 @@
+# cmdserver.py - pool of persistent Mercurial command servers
+#
+# Copyright 2012 TortoiseHg Developers
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""Run Mercurial commands through persistent ``hg serve --cmdserver pipe``
+
+Starting a new ``hg`` process (or dispatching in-process with a fresh ui)
+pays for interpreter startup, extension loading and repository open on
+every command.  Command servers are kept alive per repository root and
+reused by cmdui.Core until the relevant configuration files change.
+"""
+
+import os, sys, struct
+
+from PyQt4.QtCore import *
+
+from mercurial import scmutil
+
+from tortoisehg.util import hglib, paths
+
+_enabled = False
+
+def configure(ui):
+    """Enable or disable the command-server pool from user configuration"""
+    global _enabled
+    _enabled = ui.configbool('tortoisehg', 'cmdserver', False)
+
+def enabled():
+    return _enabled
+
+def findhgexe():
+    """Return the path to the hg executable used for child processes"""
+    if hasattr(sys, 'frozen'):
+        progdir = paths.get_prog_root()
+        exe = os.path.join(progdir, 'hg.exe')
+        if os.path.exists(exe):
+            return exe
+    return paths.find_in_path('hg')
+
+def reporoot(cmdline):
+    """Extract the repository root from a command line, or None"""
+    for i, arg in enumerate(cmdline):
+        if arg in ('--repository', '-R') and i + 1 < len(cmdline):
+            return cmdline[i + 1]
+        if arg.startswith('--repository='):
+            return arg[len('--repository='):]
+    return None
+
+# commands which may contact a remote repository, and so ask for a
+# password through getpass(), which cannot be forwarded over the
+# command-server channels; canonical names as returned by
+# hglib.commandname()
+_remotecommands = set(['bundle', 'clone', 'email', 'fetch', 'identify',
+                       'incoming', 'outgoing', 'pemail', 'pull',
+                       'push', 'qclone', 'transplant'])
+
+def usable(cmdline):
+    """True if cmdline can be run by a pooled command server"""
+    if not _enabled or not reporoot(cmdline):
+        return False
+    name = hglib.commandname(cmdline)
+    if name in _remotecommands:
+        return False
+    if name == 'summary' and '--remote' in cmdline:
+        return False
+    return True
+
+def _striprepository(cmdline):
+    """Remove --repository from cmdline; the server's own repository is
+    reused by dispatch only if no -R option is given"""
+    args = []
+    skip = False
+    for arg in cmdline:
+        if skip:
+            skip = False
+        elif arg in ('--repository', '-R'):
+            skip = True
+        elif not arg.startswith('--repository='):
+            args.append(arg)
+    return args
+
+def _configstamp(root):
+    """Snapshot of config files which affect a command server for root"""
+    stamp = []
+    for f in scmutil.rcpath() + [os.path.join(root, '.hg', 'hgrc')]:
+        try:
+            st = os.stat(f)
+            stamp.append((f, st.st_mtime, st.st_size))
+        except EnvironmentError:
+            stamp.append((f, None, None))
+    return stamp
+
+class CmdServer(QObject):
+    """A single ``hg serve --cmdserver pipe`` process bound to a repository
+
+    The channel protocol is decoded incrementally from stdout:
+
+    - 'o' / 'e': output / error data
+    - 'r': return code of the running command
+    - 'I' / 'L': the server requests input (raw bytes / a single line)
+    """
+
+    # (msg=str, label=str)
+    outputReceived = pyqtSignal(QString, QString)
+
+    # (prompt=str, channel=str); answer with respond()
+    inputRequested = pyqtSignal(QString, str)
+
+    # result code of runcommand, or -1 if the server died
+    commandFinished = pyqtSignal(int)
+
+    _headersize = struct.calcsize('>cI')
+
+    def __init__(self, root, parent=None):
+        super(CmdServer, self).__init__(parent)
+        self.root = root
+        self.stamp = _configstamp(root)
+        self.busy = False
+        self._hello = False
+        self._buf = ''
+        self._lastout = ''
+
+        self._proc = proc = QProcess(self)
+        proc.setWorkingDirectory(hglib.tounicode(root))
+        proc.readyReadStandardOutput.connect(self._readchannels)
+        proc.readyReadStandardError.connect(self._readstderr)
+        proc.finished.connect(self._onfinished)
+        proc.start(findhgexe(),
+                   ['--repository', root, '--config', 'ui.interactive=True',
+                    'serve', '--cmdserver', 'pipe'])
+
+    def alive(self):
+        return self._proc.state() != QProcess.NotRunning
+
+    def stale(self):
+        return not self.alive() or self.stamp != _configstamp(self.root)
+
+    def runcommand(self, cmdline):
+        assert not self.busy
+        self.busy = True
+        self._lastout = ''
+        data = '\0'.join(_striprepository(cmdline))
+        self._proc.write('runcommand\n' + struct.pack('>I', len(data)) + data)
+
+    def respond(self, data):
+        """Answer an input request; None sends EOF"""
+        if data is None:
+            data = ''
+        self._proc.write(struct.pack('>I', len(data)) + data)
+
+    def kill(self):
+        self._proc.kill()
+
+    def close(self):
+        self._proc.closeWriteChannel()
+        if not self._proc.waitForFinished(1000):
+            self._proc.kill()
+
+    @pyqtSlot()
+    def _readchannels(self):
+        self._buf += str(self._proc.readAllStandardOutput())
+        while len(self._buf) >= self._headersize:
+            ch, length = struct.unpack('>cI', self._buf[:self._headersize])
+            if ch in 'IL':
+                self._buf = self._buf[self._headersize:]
+                self.inputRequested.emit(hglib.tounicode(self._lastout), ch)
+                continue
+            end = self._headersize + length
+            if len(self._buf) < end:
+                break
+            data = self._buf[self._headersize:end]
+            self._buf = self._buf[end:]
+            self._dispatch(ch, data)
+
+    def _dispatch(self, ch, data):
+        if not self._hello:
+            # first message on 'o' lists capabilities and encoding
+            self._hello = True
+            return
+        if ch == 'o':
+            self._lastout = data
+            self.outputReceived.emit(hglib.tounicode(data), '')
+        elif ch == 'e':
+            self.outputReceived.emit(hglib.tounicode(data), 'ui.error')
+        elif ch == 'r':
+            self.busy = False
+            self.commandFinished.emit(struct.unpack('>i', data)[0])
+        elif ch.isupper():
+            # unknown required channel; the protocol cannot continue
+            self.kill()
+
+    @pyqtSlot()
+    def _readstderr(self):
+        data = str(self._proc.readAllStandardError())
+        self.outputReceived.emit(hglib.tounicode(data), 'ui.error')
+
+    @pyqtSlot()
+    def _onfinished(self):
+        if self.busy:
+            self.busy = False
+            self.commandFinished.emit(-1)
+
+class CmdServerPool(QObject):
+    """Command servers keyed by repository root"""
+
+    def __init__(self, parent=None):
+        super(CmdServerPool, self).__init__(parent)
+        self._servers = {}
+
+    def acquire(self, root):
+        """Return an idle server for root, starting or restarting it as
+        needed; None if the root's server is busy with another command"""
+        root = os.path.normpath(root)
+        server = self._servers.get(root)
+        if server and server.busy:
+            return None
+        if server and server.stale():
+            self.discard(root)
+            server = None
+        if not server:
+            server = CmdServer(root, self)
+            self._servers[root] = server
+        return server
+
+    def discard(self, root):
+        server = self._servers.pop(os.path.normpath(root), None)
+        if server:
+            server.close()
+            server.setParent(None)
+
+    def shutdown(self):
+        for root in self._servers.keys():
+            self.discard(root)
+
+_pool = None
+
+def pool():
+    """Shared command-server pool of this process"""
+    global _pool
+    if _pool is None:
+        _pool = CmdServerPool()
+        QCoreApplication.instance().aboutToQuit.connect(_pool.shutdown)
+    return _pool
@@ -5,15 +5,15 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2, incorporated herein by reference.
 
-import os, sys, time
+import re, tempfile, time
 
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 from PyQt4.Qsci import QsciScintilla
 
-from tortoisehg.util import hglib, paths
+from tortoisehg.util import hglib, tracing
 from tortoisehg.hgqt.i18n import _, localgettext
-from tortoisehg.hgqt import qtlib, qscilib, thread
+from tortoisehg.hgqt import qtlib, qscilib, thread, cmdserver
 
 local = localgettext()
 
@@ -132,6 +132,47 @@ class ThgStatusBar(QStatusBar):
             pm.unknown()
 
 
+class OutputBuffer(object):
+    """Raw command output with bounded memory usage
+
+    Once more than maxsize bytes are held, older data is spilled to a
+    temporary file, which is read back only on getvalue().
+    """
+
+    maxsize = 1024 * 1024
+
+    def __init__(self):
+        self._chunks = []
+        self._size = 0
+        self._spill = None
+
+    def append(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size > self.maxsize:
+            if not self._spill:
+                self._spill = tempfile.TemporaryFile(dir=qtlib.gettempdir())
+            self._spill.write(''.join(self._chunks))
+            self._chunks = []
+            self._size = 0
+
+    def getvalue(self):
+        data = ''.join(self._chunks)
+        if not self._spill:
+            return data
+        self._spill.seek(0)
+        spilled = self._spill.read()
+        self._spill.seek(0, 2)
+        return spilled + data
+
+    def close(self):
+        if self._spill:
+            self._spill.close()
+            self._spill = None
+        self._chunks = []
+        self._size = 0
+
+
 class Core(QObject):
     """Core functionality for running Mercurial command.
     Do not attempt to instantiate and use this directly.
@@ -149,11 +190,13 @@ class Core(QObject):
 
         self.thread = None
         self.extproc = None
+        self.server = None
         self.stbar = None
         self.queue = []
-        self.rawoutlines = []
+        self.rawoutbuf = OutputBuffer()
         self.display = None
         self.useproc = False
+        self._trace = None
         if logWindow:
             self.outputLog = LogWidget()
             self.outputLog.installEventFilter(qscilib.KeyPressInterceptor(self))
@@ -179,6 +222,11 @@ class Core(QObject):
             try:
                 if self.extproc:
                     self.extproc.close()
+                elif self.server:
+                    self.abortbyuser = True
+                    server = self.server
+                    server.kill()
+                    cmdserver.pool().discard(server.root)
                 elif self.thread:
                     self.thread.abort()
             except AttributeError:
@@ -192,6 +240,8 @@ class Core(QObject):
         try:
             if self.extproc:
                 return self.extproc.state() != QProcess.NotRunning
+            elif self.server:
+                return self.server.busy
             elif self.thread:
                 return self.thread.isRunning()
         except AttributeError:
@@ -199,24 +249,18 @@ class Core(QObject):
         return False
 
     def rawoutput(self):
-        return ''.join(self.rawoutlines)
+        return self.rawoutbuf.getvalue()
 
     ### Private Method ###
 
     def runproc(self):
         'Run mercurial command in separate process'
 
-        exepath = None
-        if hasattr(sys, 'frozen'):
-            progdir = paths.get_prog_root()
-            exe = os.path.join(progdir, 'hg.exe')
-            if os.path.exists(exe):
-                exepath = exe
-        if not exepath:
-            exepath = paths.find_in_path('hg')
+        exepath = cmdserver.findhgexe()
 
         def start(cmdline, display):
-            self.rawoutlines = []
+            self._startTrace(cmdline)
+            self.resetRawOutput()
             if display:
                 cmd = '%% hg %s\n' % display
             else:
@@ -226,6 +270,7 @@ class Core(QObject):
 
         @pyqtSlot(int)
         def finished(ret):
+            self._recordTrace(ret)
             if ret:
                 msg = _('[command returned code %d %%s]') % int(ret)
             else:
@@ -250,7 +295,7 @@ class Core(QObject):
 
         def stdout():
             data = proc.readAllStandardOutput().data()
-            self.rawoutlines.append(data)
+            self.rawoutbuf.append(data)
             self.output.emit(hglib.tounicode(data), '')
 
         def stderr():
@@ -271,12 +316,20 @@ class Core(QObject):
             return False
 
         cmdline = self.queue.pop(0)
+        self._startTrace(cmdline)
+        self.resetRawOutput()
+
+        if cmdserver.usable(cmdline):
+            server = cmdserver.pool().acquire(cmdserver.reporoot(cmdline))
+            if server:
+                self.runserver(server, cmdline)
+                return True
 
         self.thread = thread.CmdThread(cmdline, self.display, self.parent())
         self.thread.started.connect(self.onCommandStarted)
         self.thread.commandFinished.connect(self.onThreadFinished)
 
-        self.thread.outputReceived.connect(self.output)
+        self.thread.outputReceived.connect(self.onThreadOutput)
         self.thread.progressReceived.connect(self.progress)
         if self.stbar:
             self.thread.progressReceived.connect(self.stbar.progress)
@@ -284,6 +337,29 @@ class Core(QObject):
         self.thread.start()
         return True
 
+    def runserver(self, server, cmdline):
+        'Run mercurial command in a pooled command server'
+        self.server = server
+        self.abortbyuser = False
+        server.outputReceived.connect(self.onServerOutput)
+        server.inputRequested.connect(self.onServerInput)
+        server.commandFinished.connect(self.onServerFinished)
+
+        if self.display:
+            cmd = '%% hg %s\n' % self.display
+        else:
+            cmd = '%% hg %s\n' % ' '.join(cmdline)
+        self.output.emit(hglib.tounicode(cmd), 'control')
+        self.progress.emit(*startProgress(_('Running'), ''))
+        if self.stbar:
+            self.stbar.progress(*startProgress(_('Running'), ''))
+        self.onCommandStarted()
+        server.runcommand(cmdline)
+
+    def resetRawOutput(self):
+        self.rawoutbuf.close()
+        self.rawoutbuf = OutputBuffer()
+
     def clearOutput(self):
         if hasattr(self, 'outputLog'):
             self.outputLog.clear()
@@ -297,8 +373,25 @@ class Core(QObject):
 
         self.commandStarted.emit()
 
+    def _startTrace(self, cmdline):
+        self._trace = (tracing.now(), hglib.commandname(cmdline))
+
+    def _recordTrace(self, ret):
+        'Record the span of the command just finished, one per cmdline'
+        if self._trace:
+            start, name = self._trace
+            self._trace = None
+            tracing.record('command.' + name, start, {'ret': ret})
+
+    @pyqtSlot(QString, QString)
+    def onThreadOutput(self, msg, label):
+        if label != 'control':
+            self.rawoutbuf.append(hglib.fromunicode(msg, 'replace'))
+        self.output.emit(msg, label)
+
     @pyqtSlot(int)
     def onThreadFinished(self, ret):
+        self._recordTrace(ret)
         if self.stbar:
             error = False
             if ret is None:
@@ -319,14 +412,73 @@ class Core(QObject):
             return # run next command
         else:
             self.queue = []
-            text = self.thread.rawoutput.join('')
-            self.rawoutlines = [hglib.fromunicode(text, 'replace')]
 
         self.commandFinished.emit(ret)
 
+    @pyqtSlot(QString, QString)
+    def onServerOutput(self, msg, label):
+        if not label:
+            self.rawoutbuf.append(hglib.fromunicode(msg, 'replace'))
+        self.output.emit(msg, label)
+
+    @pyqtSlot(QString, str)
+    def onServerInput(self, prompt, channel):
+        if channel == 'L':
+            r = thread.askuser(self.parent(), prompt, False, None, None)
+            if r is not None:
+                r += '\n'
+        else:
+            r = None
+        self.server.respond(r)
+
+    @pyqtSlot(int)
+    def onServerFinished(self, ret):
+        self._recordTrace(ret)
+        server, self.server = self.server, None
+        server.outputReceived.disconnect(self.onServerOutput)
+        server.inputRequested.disconnect(self.onServerInput)
+        server.commandFinished.disconnect(self.onServerFinished)
+        self.progress.emit(*stopProgress(_('Running')))
+
+        if ret == -1:
+            if self.abortbyuser:
+                msg = _('[command terminated by user %s]')
+            else:
+                msg = _('[command interrupted %s]')
+        elif ret:
+            msg = _('[command returned code %d %%s]') % int(ret)
+        else:
+            msg = _('[command completed successfully %s]')
+        self.output.emit(msg % time.asctime() + '\n', 'control')
+
+        if self.stbar:
+            self.stbar.progress(*stopProgress(_('Running')))
+            if ret == -1:
+                status = self.abortbyuser and _('Terminated by user') \
+                                          or _('Terminated')
+                self.stbar.showMessage(status)
+            elif ret == 0:
+                self.stbar.showMessage(_('Finished'))
+            else:
+                self.stbar.showMessage(_('Failed!'), True)
+
+        self.display = None
+        if ret == 0 and self.runNext():
+            return # run next command
+        self.queue = []
+        self.commandFinished.emit(ret)
+
 
 class LogWidget(QsciScintilla):
-    """Output log viewer"""
+    """Output log viewer
+
+    Only the last MAXLINES lines are kept in the editor.  Older lines are
+    spilled to a temporary file, which can be searched by searchSpilled().
+    Output received while the widget is hidden is not rendered until it is
+    shown.
+    """
+
+    MAXLINES = 10000
 
     def __init__(self, parent=None):
         super(LogWidget, self).__init__(parent)
@@ -334,6 +486,9 @@ class LogWidget(QsciScintilla):
         self.setUtf8(True)
         self.setMarginWidth(1, 0)
         self.setWrapMode(QsciScintilla.WrapCharacter)
+        self._pending = []  # [(msg, label), ...] received while hidden
+        self._pendinglines = 0
+        self._spill = None
         self._initfont()
         self._initmarkers()
 
@@ -359,11 +514,77 @@ class LogWidget(QsciScintilla):
     @pyqtSlot(unicode, str)
     def appendLog(self, msg, label):
         """Append log text to the last line; scrolls down to there"""
+        msg = unicode(msg)
+        if not self.isVisible():
+            self._pending.append((msg, str(label)))
+            self._pendinglines += msg.count('\n')
+            if self._pendinglines > self.MAXLINES:
+                self.flushLog()
+            return
+        self._appendLog(msg, label)
+
+    @pyqtSlot()
+    def flushLog(self):
+        """Render output queued while the widget was hidden"""
+        pending, self._pending = self._pending, []
+        self._pendinglines = 0
+        msgs, curlabel = [], None
+        for msg, label in pending:
+            if label != curlabel and msgs:
+                self._appendLog(u''.join(msgs), curlabel)
+                msgs = []
+            msgs.append(msg)
+            curlabel = label
+        if msgs:
+            self._appendLog(u''.join(msgs), curlabel)
+
+    def _appendLog(self, msg, label):
         self.append(msg)
-        self._setmarker(xrange(self.lines() - unicode(msg).count('\n') - 1,
+        self._setmarker(xrange(self.lines() - msg.count('\n') - 1,
                                self.lines() - 1), label)
+        self._trimlines()
         self.setCursorPosition(self.lines() - 1, 0)
 
+    def _trimlines(self):
+        # trim in batches to amortize the cost of deleting from the top
+        excess = self.lines() - self.MAXLINES
+        if excess < self.MAXLINES // 10:
+            return
+        if not self._spill:
+            self._spill = tempfile.TemporaryFile(dir=qtlib.gettempdir())
+        text = u''.join(unicode(self.text(i)) for i in xrange(excess))
+        self._spill.write(text.encode('utf-8'))
+        readonly = self.isReadOnly()
+        self.setReadOnly(False)
+        self.SendScintilla(self.SCI_DELETERANGE, 0,
+                           self.positionFromLineIndex(excess, 0))
+        self.setReadOnly(readonly)
+
+    def searchSpilled(self, pattern):
+        """Return lines trimmed from the log which match the regexp"""
+        if not self._spill:
+            return []
+        regex = re.compile(unicode(pattern))
+        self._spill.seek(0)
+        try:
+            return [l for l in (l.decode('utf-8') for l in self._spill)
+                    if regex.search(l)]
+        finally:
+            self._spill.seek(0, 2)
+
+    def clear(self):
+        self._pending = []
+        self._pendinglines = 0
+        if self._spill:
+            self._spill.close()
+            self._spill = None
+        super(LogWidget, self).clear()
+
+    def showEvent(self, event):
+        super(LogWidget, self).showEvent(event)
+        if self._pending:
+            self.flushLog()
+
     def _setmarker(self, lines, label):
         for m in self._markersforlabel(label):
             for i in lines:
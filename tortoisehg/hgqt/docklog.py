@@ -5,7 +5,7 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2 or any later version.
 
-import glob, os, shlex
+import glob, os, re, shlex
 
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
@@ -14,7 +14,7 @@ from PyQt4.Qsci import QsciScintilla
 from mercurial import commands, util
 
 from tortoisehg.hgqt.i18n import _
-from tortoisehg.hgqt import cmdui, run
+from tortoisehg.hgqt import cmdui, run, thgrepo
 from tortoisehg.util import hglib
 
 class _LogWidgetForConsole(cmdui.LogWidget):
@@ -62,6 +62,15 @@ class _LogWidgetForConsole(cmdui.LogWidget):
 
         super(_LogWidgetForConsole, self).keyPressEvent(event)
 
+    @pyqtSlot()
+    def flushLog(self):
+        if not self._pending:
+            return
+        # queued output goes above the prompt line
+        self.clearPrompt()
+        super(_LogWidgetForConsole, self).flushLog()
+        self.openPrompt()
+
     def setPrompt(self, text):
         if text == self._prompt:
             return
@@ -433,6 +442,10 @@ class ConsoleWidget(QWidget):
     @pyqtSlot(unicode, str)
     def appendLog(self, msg, label):
         """Append log text from another cmdui"""
+        if not self._logwidget.isVisible():
+            # queued until shown; prompt is fixed up by flushLog()
+            self._logwidget.appendLog(msg, label)
+            return
         self._logwidget.clearPrompt()
         try:
             self._logwidget.appendLog(msg, label)
@@ -520,6 +533,59 @@ class ConsoleWidget(QWidget):
         finally:
             self.openPrompt()
 
+    @_cmdtable
+    def _cmd_findlog(self, args):
+        self.closePrompt()
+        try:
+            if not args:
+                self._logwidget.appendLog(_('usage: findlog PATTERN\n'),
+                                          'ui.error')
+                return
+            try:
+                lines = self._logwidget.searchSpilled(
+                    hglib.tounicode(' '.join(args)))
+            except re.error, e:
+                self._logwidget.appendLog(_('invalid pattern: %s\n')
+                                          % hglib.tounicode(str(e)),
+                                          'ui.error')
+                return
+            self._logwidget.appendLog(u''.join(lines), '')
+        finally:
+            self.openPrompt()
+
+    @_cmdtable
+    def _cmd_repocache(self, args):
+        self.closePrompt()
+        try:
+            lines = []
+            total = 0
+            for path, size, refs, busy in thgrepo.cachedrepos():
+                total += size
+                lines.append(u'%8d KB %3d %3d  %s\n'
+                             % (size // 1024, refs, busy,
+                                hglib.tounicode(path)))
+            lines.append(_('%d repositories, about %d KB\n')
+                         % (len(lines), total // 1024))
+            self._logwidget.appendLog(u''.join(lines), '')
+        finally:
+            self.openPrompt()
+
+    @_cmdtable
+    def _cmd_gcstats(self, args):
+        self.closePrompt()
+        try:
+            lines = [_('gen  count   total ms  max ms  unreachable  '
+                       'recent ms\n')]
+            for gen, count, total, maxpause, num, recent \
+                    in run.qtrun.gcstats():
+                recent = ' '.join('%.1f' % (p * 1000) for p in recent[-5:])
+                lines.append(u'%3d %6d %10.1f %7.1f %12d  %s\n'
+                             % (gen, count, total * 1000, maxpause * 1000,
+                                num, recent))
+            self._logwidget.appendLog(u''.join(lines), '')
+        finally:
+            self.openPrompt()
+
     @_cmdtable
     def _cmd_clear(self, args):
         self.clear()
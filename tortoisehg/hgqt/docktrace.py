@@ -0,0 +1,135 @@
+# docktrace.py - Timing dock widget for the TortoiseHg Workbench
+#
+# Copyright 2012 TortoiseHg Developers
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+import os
+
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+
+from tortoisehg.hgqt.i18n import _
+from tortoisehg.hgqt import qtlib
+from tortoisehg.util import hglib, tracing
+
+_BARS = u' \u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+def _histogram(counts):
+    'Render bucket counts as a bar per bucket'
+    top = max(counts) or 1
+    return u''.join(_BARS[(c * (len(_BARS) - 1) + top - 1) // top]
+                    for c in counts)
+
+def _bucketlabels():
+    labels = []
+    low = 0
+    for bound in tracing.BUCKETS:
+        labels.append(u'%d-%d ms' % (low, bound))
+        low = bound
+    labels.append(u'>= %d ms' % low)
+    return labels
+
+class TraceDockWidget(QDockWidget):
+    """Statistics of the spans recorded by tortoisehg.util.tracing"""
+
+    REFRESH = 1000  # msec between updates while visible
+
+    def __init__(self, parent=None):
+        super(TraceDockWidget, self).__init__(parent)
+        self.setFeatures(QDockWidget.DockWidgetClosable |
+                         QDockWidget.DockWidgetMovable  |
+                         QDockWidget.DockWidgetFloatable)
+        self.setWindowTitle(_('Timings'))
+
+        w = QWidget(self)
+        vbox = QVBoxLayout(w)
+        vbox.setContentsMargins(0, 0, 0, 0)
+        hbox = QHBoxLayout()
+        hbox.setContentsMargins(2, 2, 2, 2)
+        vbox.addLayout(hbox)
+
+        self.recordchk = QCheckBox(_('Record'))
+        self.recordchk.setToolTip(_('Record the duration of graph building, '
+                                    'model fetches, status walks, repository '
+                                    'invalidation, file display and '
+                                    'commands'))
+        self.recordchk.setChecked(tracing.enabled)
+        self.recordchk.toggled.connect(tracing.setenabled)
+        hbox.addWidget(self.recordchk)
+        hbox.addStretch()
+        clearbtn = QPushButton(_('Clear'))
+        clearbtn.clicked.connect(self.clear)
+        hbox.addWidget(clearbtn)
+        exportbtn = QPushButton(_('Export...'))
+        exportbtn.setToolTip(_('Save the recorded spans in Chrome trace '
+                               'format (chrome://tracing)'))
+        exportbtn.clicked.connect(self.export)
+        hbox.addWidget(exportbtn)
+
+        self.tree = QTreeWidget(self)
+        self.tree.setRootIsDecorated(False)
+        self.tree.setAlternatingRowColors(True)
+        self.tree.setHeaderLabels([_('Operation'), _('Count'), _('Total ms'),
+                                   _('Mean ms'), _('Max ms'),
+                                   _('Histogram')])
+        self.tree.setSortingEnabled(True)
+        self.tree.sortByColumn(2, Qt.DescendingOrder)
+        vbox.addWidget(self.tree)
+        self.setWidget(w)
+
+        self._labels = _bucketlabels()
+        self.timer = QTimer(self, interval=self.REFRESH)
+        self.timer.timeout.connect(self.refresh)
+
+    @pyqtSlot()
+    def refresh(self):
+        self.recordchk.setChecked(tracing.enabled)
+        self.tree.setSortingEnabled(False)
+        self.tree.clear()
+        for name, count, total, maxtime, hist in tracing.stats():
+            item = QTreeWidgetItem()
+            item.setText(0, name)
+            for col, value in ((1, count), (2, round(total * 1000, 1)),
+                               (3, round(total * 1000 / count, 2)),
+                               (4, round(maxtime * 1000, 1))):
+                item.setData(col, Qt.DisplayRole, QVariant(value))
+                item.setTextAlignment(col, Qt.AlignRight | Qt.AlignVCenter)
+            item.setText(5, _histogram(hist))
+            item.setToolTip(5, u'\n'.join(u'%s: %d' % (l, c)
+                                          for l, c in zip(self._labels, hist)))
+            self.tree.addTopLevelItem(item)
+        self.tree.setSortingEnabled(True)
+
+    @pyqtSlot()
+    def clear(self):
+        tracing.clear()
+        self.refresh()
+
+    @pyqtSlot()
+    def export(self):
+        fname = QFileDialog.getSaveFileName(self, _('Export timings'),
+                    os.path.join(os.getcwd(), 'thg-trace.json'),
+                    _('Trace files (*.json)'))
+        if not fname:
+            return
+        try:
+            fp = open(hglib.fromunicode(fname), 'wb')
+            try:
+                tracing.writechrometrace(fp)
+            finally:
+                fp.close()
+        except (EnvironmentError, ImportError), e:
+            qtlib.WarningMsgBox(_('Export timings'),
+                                _('Error writing file'),
+                                hglib.tounicode(str(e)), parent=self)
+
+    def showEvent(self, event):
+        super(TraceDockWidget, self).showEvent(event)
+        self.refresh()
+        self.timer.start()
+
+    def hideEvent(self, event):
+        super(TraceDockWidget, self).hideEvent(event)
+        self.timer.stop()
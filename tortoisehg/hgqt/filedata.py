@@ -22,7 +22,8 @@ def _exceedsMaxLineLength(data, maxlength=100000):
     return False
 
 class FileData(object):
-    def __init__(self, ctx, ctx2, wfile, status=None):
+    def __init__(self, ctx, ctx2, wfile, status=None, withdiff=True):
+        self.withdiff = withdiff
         self.contents = None
         self.ucontents = None
         self.error = None
@@ -391,6 +392,9 @@ class FileData(object):
             return
 
         self.olddata = olddata
+        if not self.withdiff:
+            # the caller computes the diff of olddata and contents itself
+            return
         newdate = util.datestr(ctx.date())
         olddate = util.datestr(ctx2.date())
         revs = [str(ctx), str(ctx2)]
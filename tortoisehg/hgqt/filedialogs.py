@@ -20,6 +20,7 @@ Qt4 dialogs to display hg revisions of a file
 import os
 import difflib
 import functools
+import itertools
 
 from tortoisehg.util import hglib
 from tortoisehg.hgqt.i18n import _
@@ -331,6 +332,10 @@ class FileDiffDialog(_AbstractFileDialog):
     """
     Qt4 dialog to display diffs between different mercurial revisions of a file.
     """
+
+    FILLBURST = 10000  # marker lines added per timer tick
+    FILLBATCH = 2000   # at most, per range taken from the fill queue
+
     def __init__(self, repo, filename, repoviewer=None):
         super(FileDiffDialog, self).__init__(repo, filename, repoviewer)
         self._readSettings()
@@ -479,6 +484,7 @@ class FileDiffDialog(_AbstractFileDialog):
         self.timer = QTimer()
         self.timer.setSingleShot(False)
         self.timer.timeout.connect(self.idle_fill_files)
+        self._fillqueue = None
 
     def setupModels(self):
         self.filedata = {'left': None, 'right': None}
@@ -573,62 +579,65 @@ class FileDiffDialog(_AbstractFileDialog):
         # refresh GUI at the end of the burst
         for side in sides:
             self.viewers[side].setUpdatesEnabled(False)
-            self.block[side].setUpdatesEnabled(False)
-        self.diffblock.setUpdatesEnabled(False)
-
-        for n in range(30): # burst pool
-            if self._diff is None or not self._diff.get_opcodes():
-                self._diff = None
-                self.timer.stop()
-                self.setDiffNavActions(-1)
-                break
 
-            tag, alo, ahi, blo, bhi = self._diff.get_opcodes().pop(0)
-
-            w = self.viewers['left']
-            cposl = w.SendScintilla(w.SCI_GETENDSTYLED)
-            w = self.viewers['right']
-            cposr = w.SendScintilla(w.SCI_GETENDSTYLED)
-            if tag == 'replace':
-                self.block['left'].addBlock('x', alo, ahi)
-                self.block['right'].addBlock('x', blo, bhi)
-                self.diffblock.addBlock('x', alo, ahi, blo, bhi)
+        budget = self.FILLBURST
+        while budget > 0 and self._fillqueue is not None:
+            try:
+                side, lo, hi, marker = self._fillqueue.next()
+            except StopIteration:
+                self._fillqueue = None
+                break
+            w = self.viewers[side]
+            for i in xrange(lo, hi):
+                w.markerAdd(i, marker)
+            budget -= hi - lo
 
-                w = self.viewers['left']
-                for i in range(alo, ahi):
-                    w.markerAdd(i, self.markertriangle)
+        # ok, let's enable GUI refresh for code viewers
+        for side in sides:
+            self.viewers[side].setUpdatesEnabled(True)
+        if self._fillqueue is None:
+            self.timer.stop()
 
-                w = self.viewers['right']
-                for i in range(blo, bhi):
-                    w.markerAdd(i, self.markertriangle)
+    def _visibleLines(self, side, margin=50):
+        w = self.viewers[side]
+        first = w.firstVisibleLine()
+        count = w.SendScintilla(w.SCI_LINESONSCREEN)
+        return max(first - margin, 0), first + count + margin
 
+    def _markerRanges(self, blocks):
+        """
+        Generate (side, lo, hi, marker) line ranges of the diff blocks to
+        mark, split in batches of at most FILLBATCH lines; the currently
+        visible lines are marked first
+        """
+        ranges = []
+        for tag, alo, ahi, blo, bhi in blocks:
+            if tag == 'replace':
+                ranges.append(('left', alo, ahi, self.markertriangle))
+                ranges.append(('right', blo, bhi, self.markertriangle))
             elif tag == 'delete':
-                self.block['left'].addBlock('-', alo, ahi)
-                self.diffblock.addBlock('-', alo, ahi, blo, bhi)
-
-                w = self.viewers['left']
-                for i in range(alo, ahi):
-                    w.markerAdd(i, self.markerminus)
-
+                ranges.append(('left', alo, ahi, self.markerminus))
             elif tag == 'insert':
-                self.block['right'].addBlock('+', blo, bhi)
-                self.diffblock.addBlock('+', alo, ahi, blo, bhi)
-
-                w = self.viewers['right']
-                for i in range(blo, bhi):
-                    w.markerAdd(i, self.markerplus)
-
-            elif tag == 'equal':
-                pass
-
-            else:
+                ranges.append(('right', blo, bhi, self.markerplus))
+            elif tag != 'equal':
                 raise ValueError, 'unknown tag %r' % (tag,)
 
-        # ok, let's enable GUI refresh for code viewers and diff-block displayers
-        for side in sides:
-            self.viewers[side].setUpdatesEnabled(True)
-            self.block[side].setUpdatesEnabled(True)
-        self.diffblock.setUpdatesEnabled(True)
+        visible = dict((side, self._visibleLines(side)) for side in sides)
+        first, rest = [], []
+        for side, lo, hi, marker in ranges:
+            vlo, vhi = visible[side]
+            if hi <= vlo or lo >= vhi:
+                rest.append((side, lo, hi, marker))
+                continue
+            first.append((side, max(lo, vlo), min(hi, vhi), marker))
+            if lo < vlo:
+                rest.append((side, lo, vlo, marker))
+            if hi > vhi:
+                rest.append((side, vhi, hi, marker))
+
+        for side, lo, hi, marker in itertools.chain(first, rest):
+            for blo in xrange(lo, hi, self.FILLBATCH):
+                yield side, blo, min(blo + self.FILLBATCH, hi), marker
 
     def update_diff(self, keeppos=None):
         """
@@ -639,27 +648,45 @@ class FileDiffDialog(_AbstractFileDialog):
             pos = self.viewers[keeppos].verticalScrollBar().value()
             keeppos = (keeppos, pos)
 
+        if self.timer.isActive():
+            self.timer.stop()
+        self._fillqueue = None
         for side in sides:
             self.viewers[side].clear()
             self.block[side].clear()
         self.diffblock.clear()
 
         if None not in self.filedata.values():
-            if self.timer.isActive():
-                self.timer.stop()
             for side in sides:
                 self.viewers[side].setMarginWidth(1, "00%s" % len(self.filedata[side]))
 
-            self._diff = difflib.SequenceMatcher(None, self.filedata['left'],
-                                                 self.filedata['right'])
-            blocks = self._diff.get_opcodes()[:]
+            blocks = difflib.SequenceMatcher(None, self.filedata['left'],
+                                             self.filedata['right']).get_opcodes()
 
             self._diffmatch = {'left': [x[1:3] for x in blocks],
                                'right': [x[3:5] for x in blocks]}
+            for tag, alo, ahi, blo, bhi in blocks:
+                if tag == 'replace':
+                    self.block['left'].addBlock('x', alo, ahi)
+                    self.block['right'].addBlock('x', blo, bhi)
+                    self.diffblock.addBlock('x', alo, ahi, blo, bhi)
+                elif tag == 'delete':
+                    self.block['left'].addBlock('-', alo, ahi)
+                    self.diffblock.addBlock('-', alo, ahi, blo, bhi)
+                elif tag == 'insert':
+                    self.block['right'].addBlock('+', blo, bhi)
+                    self.diffblock.addBlock('+', alo, ahi, blo, bhi)
             for side in sides:
                 self.viewers[side].setText(u'\n'.join(self.filedata[side]))
             self.update_page_steps(keeppos)
-            self.timer.start()
+            self.setDiffNavActions(-1)
+
+            # markers of the visible lines are added right away, the others
+            # during GUI idle time
+            self._fillqueue = self._markerRanges(blocks)
+            self.idle_fill_files()
+            if self._fillqueue is not None:
+                self.timer.start()
 
     def sbar_changed(self, value, side, bartype='vertical'):
         """
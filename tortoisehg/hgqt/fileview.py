@@ -11,7 +11,7 @@ import re
 
 from mercurial import util, patch
 
-from tortoisehg.util import hglib, colormap, thread2
+from tortoisehg.util import hglib, colormap, thread2, tracing
 from tortoisehg.hgqt.i18n import _
 from tortoisehg.hgqt import qscilib, qtlib, blockmatcher, lexers
 from tortoisehg.hgqt import visdiff, filedata
@@ -312,6 +312,7 @@ class HgFileView(QFrame):
         self.maxWidth = 0
         self.sci.showHScrollBar(False)
 
+    @tracing.traced('fileview.display')
     def displayFile(self, filename=None, status=None):
         if isinstance(filename, (unicode, QString)):
             filename = hglib.fromunicode(filename)
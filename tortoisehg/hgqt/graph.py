@@ -23,8 +23,12 @@ revision grapher (now stolen back).
 import time
 import os
 import itertools
+import heapq
 
 from mercurial import util, error
+from mercurial.node import nullid, nullrev
+
+from tortoisehg.util import tracing
 
 def revision_grapher(repo, **opts):
     """incremental revision grapher
@@ -157,22 +161,60 @@ def filelog_grapher(repo, path):
     '''
     Graph the ancestry of a single file (log).  Deletions show
     up as breaks in the graph.
-    '''
-    filerev = len(repo.file(path)) - 1
-    fctx = repo.filectx(path, fileid=filerev)
-    rev = fctx.rev()
 
-    flog = fctx.filelog()
-    heads = [repo.filectx(path, fileid=flog.rev(x)).rev() for x in flog.heads()]
-    assert rev in heads
-    heads.remove(rev)
+    The filelog indexes are walked directly: file revisions are placed
+    by their linkrevs, copy metadata is only read for file revisions
+    without a first parent, and the next row is taken from a heap of
+    pending linkrevs.
+    '''
+    filelogs = {}
+    def getfilelog(path):
+        fl = filelogs.get(path)
+        if fl is None:
+            fl = filelogs[path] = repo.file(path)
+        return fl
+
+    def getparents(path, filerev):
+        fl = getfilelog(path)
+        p1, p2 = fl.parentrevs(filerev)
+        parents = []
+        if p1 != nullrev:
+            parents.append((path, p1))
+        else:
+            # copies are recorded with a null first parent
+            renamed = fl.renamed(fl.node(filerev))
+            if renamed:
+                try:
+                    parents.append((renamed[0],
+                                    getfilelog(renamed[0]).rev(renamed[1])))
+                except error.LookupError:
+                    pass
+        if p2 != nullrev:
+            parents.append((path, p2))
+        return parents
+
+    nodes = {}    # {linkrev: (path, filerev)}
+    pending = []  # heap of -linkrev
+    fl = getfilelog(path)
+    for n in fl.heads():
+        if n == nullid:
+            continue
+        filerev = fl.rev(n)
+        rev = fl.linkrev(filerev)
+        nodes[rev] = (path, filerev)
+        heapq.heappush(pending, -rev)
 
     revs = []
     rev_color = {}
     nextcolor = 0
-    _paths = {}
+    done = set()
+
+    while pending:
+        rev = -heapq.heappop(pending)
+        if rev in done:
+            continue
+        done.add(rev)
 
-    while rev >= 0:
         # Compute revs and next_revs
         if rev not in revs:
             revs.append(rev)
@@ -182,14 +224,19 @@ def filelog_grapher(repo, path):
         next_revs = revs[:]
 
         # Add parents to next_revs
-        fctx = repo.filectx(_paths.get(rev, path), changeid=rev)
-        for pfctx in fctx.parents():
-            _paths[pfctx.rev()] = pfctx.path()
-        parents = [pfctx.rev() for pfctx in fctx.parents()]# if f.path() == path]
+        fpath, filerev = nodes[rev]
+        parents = []
+        for ppath, pfilerev in getparents(fpath, filerev):
+            prev = getfilelog(ppath).linkrev(pfilerev)
+            nodes.setdefault(prev, (ppath, pfilerev))
+            parents.append(prev)
+        pending_revs = set(next_revs)
         parents_to_add = []
         for parent in parents:
-            if parent not in next_revs:
+            if parent not in pending_revs:
+                pending_revs.add(parent)
                 parents_to_add.append(parent)
+                heapq.heappush(pending, -parent)
                 if len(parents) > 1:
                     rev_color[parent] = nextcolor ; nextcolor += 1
                 else:
@@ -197,28 +244,22 @@ def filelog_grapher(repo, path):
         parents_to_add.sort()
         next_revs[index:index + 1] = parents_to_add
 
+        next_index = {}
+        for i in xrange(len(next_revs) - 1, -1, -1):
+            next_index[next_revs[i]] = i
         lines = []
         for i, nrev in enumerate(revs):
-            if nrev in next_revs:
+            if nrev in next_index:
                 color = rev_color[nrev]
-                lines.append( (i, next_revs.index(nrev), color) )
+                lines.append( (i, next_index[nrev], color) )
             elif nrev == rev:
                 for parent in parents:
                     color = rev_color[parent]
-                    lines.append( (i, next_revs.index(parent), color) )
+                    lines.append( (i, next_index[parent], color) )
 
-        pcrevs = [pfc.rev() for pfc in fctx.parents()]
-        yield (fctx.rev(), index, curcolor, lines, pcrevs,
-               _paths.get(fctx.rev(), path))
+        yield (rev, index, curcolor, lines, parents, fpath)
         revs = next_revs
 
-        if revs:
-            rev = max(revs)
-        else:
-            rev = -1
-        if heads and rev <= heads[-1]:
-            rev = heads.pop()
-
 def mq_patch_grapher(repo):
     """Graphs unapplied MQ patches"""
     for patchname in reversed(repo.thgmqunappliedpatches):
@@ -277,6 +318,7 @@ class Graph(object):
         # len(graph) is the number of actually built graph nodes
         return len(self.nodes)
 
+    @tracing.traced('graph.build_nodes')
     def build_nodes(self, nnodes=None, rev=None):
         """
         Build up to `nnodes` more nodes in our graph, or build as many
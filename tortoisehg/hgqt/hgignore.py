@@ -18,6 +18,66 @@ from tortoisehg.util import shlib, hglib
 
 from tortoisehg.hgqt import qtlib, qscilib
 
+def _ignorematcher(root, pats, isregexp):
+    '''Match function for .hgignore patterns of the glob or regexp syntax;
+    raises util.Abort for invalid patterns'''
+    kind = isregexp and 'relre:' or 'relglob:'
+    return match.match(root, '', [], [kind + p for p in pats])
+
+class UnknownFilesModel(QAbstractListModel):
+    'Untracked files, greying out those hidden by a candidate pattern'
+
+    def __init__(self, parent=None):
+        super(UnknownFilesModel, self).__init__(parent)
+        self._files = []
+        self._hidden = set()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._files)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return QVariant()
+        f = self._files[index.row()]
+        if role == Qt.DisplayRole:
+            return QVariant(hglib.tounicode(f))
+        if role == Qt.ForegroundRole and f in self._hidden:
+            return QVariant(QColor(Qt.gray))
+        return QVariant()
+
+    def files(self):
+        return self._files
+
+    def setFiles(self, files):
+        self.beginResetModel()
+        self._files = list(files)
+        self._hidden = set()
+        self.endResetModel()
+
+    def removeMatching(self, matchfn):
+        'Drop the files matched by matchfn, i.e. newly ignored files'
+        files = [f for f in self._files if not matchfn(f)]
+        if len(files) != len(self._files):
+            self.setFiles(files)
+
+    def countMatching(self, matchfn):
+        return len([f for f in self._files if matchfn(f)])
+
+    def setPreview(self, matchfn):
+        '''Grey out the files matched by matchfn, or none if matchfn is
+        None; returns the number of matched files'''
+        if matchfn:
+            hidden = set(f for f in self._files if matchfn(f))
+        else:
+            hidden = set()
+        if hidden or self._hidden:
+            self._hidden = hidden
+            self.dataChanged.emit(self.index(0),
+                                  self.index(len(self._files) - 1))
+        return len(hidden)
+
 class HgignoreDialog(QDialog):
     'Edit a repository .hgignore file'
 
@@ -50,6 +110,8 @@ class HgignoreDialog(QDialog):
         le = QLineEdit()
         hbox.addWidget(le, 1)
         le.returnPressed.connect(self.addEntry)
+        le.textChanged.connect(self.schedulePreview)
+        recombo.currentIndexChanged.connect(self.schedulePreview)
 
         add = QPushButton(_('Add'))
         add.clicked.connect(self.addEntry)
@@ -96,15 +158,23 @@ class HgignoreDialog(QDialog):
         ignorelist = QListWidget()
         ivbox.addWidget(ignorelist)
         ignorelist.setSelectionMode(QAbstractItemView.ExtendedSelection)
-        unknownlist = QListWidget()
+        unknownlist = QListView()
         uvbox.addWidget(unknownlist)
+        unknownlist.setUniformItemSizes(True)
         unknownlist.setSelectionMode(QAbstractItemView.ExtendedSelection)
-        unknownlist.currentTextChanged.connect(self.setGlobFilter)
+        self.unknownmodel = UnknownFilesModel(self)
+        unknownlist.setModel(self.unknownmodel)
+        unknownlist.selectionModel().currentChanged.connect(self.setGlobFilter)
         unknownlist.setContextMenuPolicy(Qt.CustomContextMenu)
         unknownlist.customContextMenuRequested.connect(self.menuRequest)
-        unknownlist.itemDoubleClicked.connect(self.unknownDoubleClicked)
+        unknownlist.doubleClicked.connect(self.unknownDoubleClicked)
         lbl = QLabel(_('Backspace or Del to remove row(s)'))
         ivbox.addWidget(lbl)
+        self.previewlbl = QLabel()
+        uvbox.addWidget(self.previewlbl)
+
+        self.previewtimer = QTimer(self, interval=200, singleShot=True)
+        self.previewtimer.timeout.connect(self.updatePreview)
 
         # layer 4 - dialog buttons
         BB = QDialogButtonBox
@@ -138,6 +208,10 @@ class HgignoreDialog(QDialog):
         self.refresh()
         return True
 
+    @property
+    def lclunknowns(self):
+        return self.unknownmodel.files()
+
     def menuRequest(self, point):
         'context menu request for unknown list'
         point = self.unknownlist.viewport().mapToGlobal(point)
@@ -166,13 +240,16 @@ class HgignoreDialog(QDialog):
             filters.append(selected)
         for f in filters:
             n = len(f) == 1 and f[0] or _('selected files')
-            a = self.contextmenu.addAction(_('Ignore ') + hglib.tounicode(n))
+            count = self.unknownmodel.countMatching(
+                _ignorematcher(self.repo.root, f, False))
+            a = self.contextmenu.addAction(_('Ignore ') + hglib.tounicode(n)
+                                           + ' ' + _('(%d files)') % count)
             a._patterns = f
             a.triggered.connect(self.insertFilters)
         self.contextmenu.exec_(point)
 
-    def unknownDoubleClicked(self, item):
-        self.insertFilters([hglib.fromunicode(item.text())])
+    def unknownDoubleClicked(self, index):
+        self.insertFilters([self.lclunknowns[index.row()]])
 
     def insertFilters(self, pats=False, isregexp=False):
         if pats is False:
@@ -191,12 +268,42 @@ class HgignoreDialog(QDialog):
             self.ignorelines.append(h)
             self.ignorelines.extend(pats)
         self.writeIgnoreFile()
-        self.refresh()
-
-    def setGlobFilter(self, qstr):
+        # new patterns can only hide files, so there is no need to walk the
+        # working directory again
+        self.refreshIgnoreList()
+        self.unknownmodel.removeMatching(
+            _ignorematcher(self.repo.root, pats, isregexp))
+        self.updatePreview()
+
+    def setGlobFilter(self, index, previous=None):
         'user selected an unknown file; prep a glob filter'
+        if not index.isValid():
+            return
         self.recombo.setCurrentIndex(0)
-        self.le.setText(qstr)
+        self.le.setText(hglib.tounicode(self.lclunknowns[index.row()]))
+
+    def schedulePreview(self):
+        self.previewtimer.start()
+
+    def updatePreview(self):
+        'Grey out the untracked files hidden by the pattern being typed'
+        self.previewtimer.stop()
+        pat = hglib.fromunicode(self.le.text()).strip()
+        matchfn = None
+        if pat:
+            try:
+                matchfn = _ignorematcher(self.repo.root, [pat],
+                                         self.recombo.currentIndex() == 1)
+            except (util.Abort, re.error):
+                pass
+        count = self.unknownmodel.setPreview(matchfn)
+        if matchfn:
+            self.previewlbl.setText(_('%d of %d untracked files would be '
+                                      'ignored') % (count,
+                                                    len(self.lclunknowns)))
+        else:
+            self.previewlbl.setText(_('%d untracked files')
+                                    % len(self.lclunknowns))
 
     def fileselect(self):
         'user selected another ignore file'
@@ -232,6 +339,11 @@ class HgignoreDialog(QDialog):
                                     parent=self)
                 return
 
+    def refreshIgnoreList(self):
+        self.ignorelist.clear()
+        self.ignorelist.addItems([hglib.tounicode(l)
+                                  for l in self.ignorelines])
+
     def refresh(self):
         try:
             l = open(self.ignorefile, 'rb').readlines()
@@ -240,12 +352,10 @@ class HgignoreDialog(QDialog):
             self.doseoln = os.name == 'nt'
             l = []
         self.ignorelines = [line.strip() for line in l]
-        self.ignorelist.clear()
+        self.refreshIgnoreList()
 
         uni = hglib.tounicode
 
-        self.ignorelist.addItems([uni(l) for l in self.ignorelines])
-
         try:
             self.repo.thginvalidate()
             self.repo.lfstatus = True
@@ -262,7 +372,7 @@ class HgignoreDialog(QDialog):
                 err = uni(str(e))
             qtlib.WarningMsgBox(_('Unable to read repository status'),
                                 err, parent=self)
-            self.lclunknowns = []
+            self.unknownmodel.setFiles([])
             return
 
         if not self.pats:
@@ -271,16 +381,17 @@ class HgignoreDialog(QDialog):
                          for i in self.unknownlist.selectedIndexes()]
             except IndexError:
                 self.pats = []
-        self.lclunknowns = wctx.unknown()
-        self.unknownlist.clear()
-        self.unknownlist.addItems([uni(u) for u in self.lclunknowns])
+        self.unknownmodel.setFiles(wctx.unknown())
+        selmodel = self.unknownlist.selectionModel()
+        pats = set(self.pats)
         for i, u in enumerate(self.lclunknowns):
-            if u in self.pats:
-                item = self.unknownlist.item(i)
-                self.unknownlist.setItemSelected(item, True)
-                self.unknownlist.setCurrentItem(item)
-                self.le.setText(QString(u))
+            if u in pats:
+                index = self.unknownmodel.index(i)
+                selmodel.select(index, QItemSelectionModel.Select)
+                selmodel.setCurrentIndex(index, QItemSelectionModel.NoUpdate)
+                self.le.setText(uni(u))
         self.pats = []
+        self.updatePreview()
 
     def writeIgnoreFile(self):
         eol = self.doseoln and '\r\n' or '\n'
@@ -39,6 +39,8 @@ class PatchBranchWidget(QWidget, qtlib.TaskWidget):
         self.repo = repo
         self.pbranch = extensions.find('pbranch') # Unfortunately global instead of repo-specific
         self.show_internal_branches = False
+        # {patch name: (heads key, status key, status, message)}
+        self._patchcache = {}
 
         repo.configChanged.connect(self.configChanged)
         repo.repositoryChanged.connect(self.repositoryChanged)
@@ -140,6 +142,7 @@ class PatchBranchWidget(QWidget, qtlib.TaskWidget):
     def reload(self):
         'User has requested a reload'
         self.repo.thginvalidate()
+        self._patchcache.clear()
         self.refresh()
 
     def refresh(self):
@@ -193,6 +196,7 @@ class PatchBranchWidget(QWidget, qtlib.TaskWidget):
         mgr = self.pbranch.patchmanager(self.repo.ui, self.repo, opts)
         graph = mgr.graphforopts(opts)
         target_graph = mgr.graphforopts({})
+        tips_graph = graph
         if not self.show_internal_branches:
             graph = mgr.patchonlygraph(graph)
         names = None
@@ -200,16 +204,16 @@ class PatchBranchWidget(QWidget, qtlib.TaskWidget):
         in_lines = []
         if patch_list:
             dep_list = [patch_list[0]]
+            dep_columns = {patch_list[0]: 0}
         cur_branch = self.repo['.'].branch()
-        patch_status = {}
-        for name in patch_list:
-            patch_status[name] = self.pstatus(name)
+        patch_status, patch_message = self._patchdata(patch_list,
+                                                      target_graph, tips_graph)
         for name in patch_list:
             parents = graph.deps(name)
 
             # Node properties
-            if name in dep_list:
-                node_column = dep_list.index(name)
+            if name in dep_columns:
+                node_column = dep_columns[name]
             else:
                 node_column = len(dep_list)
             node_color = patch_status[name] and '#ff0000' or 0
@@ -223,16 +227,18 @@ class PatchBranchWidget(QWidget, qtlib.TaskWidget):
             # Find next dependency list
             my_deps = []
             for p in parents:
-                if p not in dep_list:
+                if p not in dep_columns:
                     my_deps.append(p)
             next_dep_list = dep_list[:]
             next_dep_list[node_column:node_column+1] = my_deps
+            next_dep_columns = dict((d, i) for i, d
+                                    in enumerate(next_dep_list))
 
             # Dependency lines
             shift = len(parents) - 1
             out_lines = []
             for p in parents:
-                dep_column = next_dep_list.index(p)
+                dep_column = next_dep_columns[p]
                 color = 0 # black
                 if patch_status[p]:
                     color = '#ff0000' # red
@@ -245,12 +251,12 @@ class PatchBranchWidget(QWidget, qtlib.TaskWidget):
                 else:
                     # Find line continuations
                     dep = dep_list[line.end_column]
-                    dep_column = next_dep_list.index(dep)
+                    dep_column = next_dep_columns[dep]
                     out_lines.append(GraphLine(line.end_column, dep_column, line.color, line.style))
 
             stat = patch_status[name] and 'M' or 'C' # patch status
             patchname = name
-            msg = self.pmessage(name) # summary
+            msg = patch_message[name] # summary
             if msg:
                 title = msg.split('\n')[0]
             else:
@@ -260,9 +266,61 @@ class PatchBranchWidget(QWidget, qtlib.TaskWidget):
             # Loop
             in_lines = out_lines
             dep_list = next_dep_list
+            dep_columns = next_dep_columns
 
         return model
 
+    def _patchdata(self, patch_list, graph, graph_cur):
+        '''Return ({name: status}, {name: message}) for patch_list
+
+        Results are cached per patch.  A message is recomputed only when
+        the heads of the patch branch moved, a status only when the heads
+        of the patch branch or any branch it depends on moved.
+        '''
+        branchmap = self.repo.branchmap()
+        def heads(name):
+            return tuple(sorted(branchmap.get(name, ())))
+
+        depheads = {}
+        def depkey(name):
+            # heads of name and all of its (transitive) dependencies
+            if name not in depheads:
+                depheads[name] = ()  # guard against cycles
+                key = [(name, heads(name))]
+                for g in (graph, graph_cur):
+                    try:
+                        deps = g.deps(name)
+                    except KeyError:
+                        continue
+                    for dep in deps:
+                        key.extend(depkey(dep))
+                depheads[name] = tuple(sorted(set(key)))
+            return depheads[name]
+
+        cache = self._patchcache
+        for name in list(cache):
+            if name not in patch_list:
+                del cache[name]
+        patch_status = {}
+        patch_message = {}
+        for name in patch_list:
+            hkey = heads(name)
+            skey = (depkey(name), graph_cur.isinner(name),
+                    graph.isinner(name))
+            entry = cache.get(name)
+            if entry and entry[0] == hkey:
+                msg = entry[3]
+            else:
+                msg = self.pmessage(name)
+            if entry and entry[1] == skey:
+                status = entry[2]
+            else:
+                status = self._pstatus(name, graph, graph_cur)
+            cache[name] = (hkey, skey, status, msg)
+            patch_status[name] = status
+            patch_message[name] = msg
+        return patch_status, patch_message
+
 
     #
     # pbranch extension functions
@@ -289,11 +347,14 @@ class PatchBranchWidget(QWidget, qtlib.TaskWidget):
         """
         if self.pbranch is None:
             return None
-        status = []
         opts = {}
         mgr = self.pbranch.patchmanager(self.repo.ui, self.repo, opts)
         graph = mgr.graphforopts(opts)
         graph_cur = mgr.graphforopts({'tips': True})
+        return self._pstatus(patch_name, graph, graph_cur)
+
+    def _pstatus(self, patch_name, graph, graph_cur):
+        status = []
         heads = self.repo.branchheads(patch_name)
         if graph_cur.isinner(patch_name) and not graph.isinner(patch_name):
             status.append(_('will be closed'))
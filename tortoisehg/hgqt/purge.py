@@ -6,10 +6,14 @@
 # GNU General Public License version 2, incorporated herein by reference.
 
 import os
+import errno
 import stat
 import shutil
+import itertools
+import threading
+import Queue
 
-from mercurial import hg, scmutil, ui
+from mercurial import hg, scmutil, ui, util
 
 from tortoisehg.util import hglib
 from tortoisehg.hgqt.i18n import _, ngettext
@@ -184,10 +188,71 @@ class PurgeDialog(QDialog):
         self.th.finished.connect(completed)
         self.th.start()
 
+def _removefile(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # read-only files cannot be unlinked under Windows
+        s = os.stat(path)
+        if (s.st_mode & stat.S_IWRITE) != 0:
+            raise
+        os.chmod(path, stat.S_IMODE(s.st_mode) | stat.S_IWRITE)
+        os.remove(path)
+
+def _ancestors(path):
+    'Yield the parent directories of a repository-relative path'
+    i = path.rfind('/')
+    while i != -1:
+        path = path[:i]
+        yield path
+        i = path.rfind('/')
+
+def planpurge(tracked, files, kept, keptdirs, directories):
+    """Split files to delete into whole subtrees and single files
+
+    Returns ([(subtree, number of files)], [file]).  A subtree is a
+    directory with nothing beneath it but files to delete and empty
+    directories: no tracked or kept files, and no kept directories
+    (nested repositories, subrepositories).
+    """
+    unsafe = set()
+    def protect(dirs):
+        for d in dirs:
+            if d in unsafe:
+                break
+            unsafe.add(d)
+    for f in tracked:
+        protect(_ancestors(f))
+    for f in kept:
+        protect(_ancestors(f))
+    for d in keptdirs:
+        protect(itertools.chain([d], _ancestors(d)))
+
+    dirset = set(d for d in directories if d not in ('', '.'))
+    counts = {}
+    for d in dirset:
+        if d in unsafe:
+            continue
+        parent = d.rpartition('/')[0]
+        if not parent or parent in unsafe or parent not in dirset:
+            counts[d] = 0
+    singles = []
+    for f in files:
+        for d in _ancestors(f):
+            if d in counts:
+                counts[d] += 1
+                break
+        else:
+            singles.append(f)
+    return sorted(counts.iteritems()), singles
+
 class PurgeThread(QThread):
     progress = pyqtSignal(QString, object, QString, QString, object)
     showMessage = pyqtSignal(QString)
 
+    MAXWORKERS = 4
+    PROGRESSINTERVAL = 0.1
+
     def __init__(self, repo, opts, parent):
         super(PurgeThread, self).__init__(parent)
         self.failures = 0
@@ -218,53 +283,121 @@ class PurgeThread(QThread):
         self.showMessage.emit('')
         match = scmutil.matchall(repo)
         match.dir = directories.append
+        # unknown files must be known to tell which ignored directories
+        # can be removed as a whole; they are found by the same walk
+        subtrees = opts['ignored'] and opts['delfolders']
         repo.bfstatus = True
         repo.lfstatus = True
         status = repo.status(match=match, ignored=opts['ignored'],
-                             unknown=opts['unknown'], clean=False)
+                             unknown=opts['unknown'] or subtrees,
+                             clean=False)
         repo.bfstatus = False
         repo.lfstatus = False
-        files = status[4] + status[5]
-
-        def remove(remove_func, name):
-            try:
-                if keephg and name.startswith('.hg'):
-                    return
-                remove_func(repo.wjoin(name))
-            except EnvironmentError:
-                failures.append(name)
-
-        def removefile(path):
-            try:
-                os.remove(path)
-            except OSError:
-                # read-only files cannot be unlinked under Windows
-                s = os.stat(path)
-                if (s.st_mode & stat.S_IWRITE) != 0:
-                    raise
-                os.chmod(path, stat.S_IMODE(s.st_mode) | stat.S_IWRITE)
-                os.remove(path)
-
-        for i, f in enumerate(sorted(files)):
-            data = ('deleting', i, f, '', len(files))
-            self.progress.emit(*data)
-            remove(removefile, f)
-        data = ('deleting', None, '', '', len(files))
-        self.progress.emit(*data)
+        files = status[5]
+        kept = []
+        if opts['unknown']:
+            files = status[4] + files
+        else:
+            kept = status[4]
+        if keephg:
+            kept += [f for f in files if f.startswith('.hg')]
+            files = [f for f in files if not f.startswith('.hg')]
+
+        if subtrees:
+            keptdirs = [d for d in directories
+                        if os.path.isdir(repo.wjoin(d, '.hg'))]
+            keptdirs += repo[None].substate.keys()
+            if keephg:
+                keptdirs += [d for d in directories if d.startswith('.hg')]
+            subtrees, singles = planpurge(self._trackedfiles(repo), files,
+                                          kept, keptdirs, directories)
+        else:
+            subtrees, singles = [], files
+
+        self._delete(repo, subtrees, singles, failures)
         self.showMessage.emit(_('Deleted %d files') % len(files))
 
         if opts['delfolders']:
-            for i, f in enumerate(sorted(directories, reverse=True)):
-                if not os.listdir(repo.wjoin(f)):
-                    data = ('rmdir', i, f, '', len(directories))
-                    self.progress.emit(*data)
-                    remove(os.rmdir, f)
-            data = ('rmdir', None, f, '', len(directories))
-            self.progress.emit(*data)
+            removed = set(d for d, n in subtrees)
+            for f in sorted(directories, reverse=True):
+                if f in removed or (keephg and f.startswith('.hg')):
+                    continue
+                try:
+                    os.rmdir(repo.wjoin(f))
+                except EnvironmentError, e:
+                    if e.errno not in (errno.ENOTEMPTY, errno.EEXIST,
+                                       errno.ENOENT):
+                        failures.append(f)
             self.showMessage.emit(_('Deleted %d files and %d folders') % (
                                   len(files), len(directories)))
         return failures
 
+    def _trackedfiles(self, repo):
+        'Tracked files, including largefiles behind their standins'
+        for f in repo.dirstate:
+            yield f
+            for prefix in ('.hglf/', '.kbf/'):
+                if f.startswith(prefix):
+                    yield f[len(prefix):]
+
+    def _delete(self, repo, subtrees, singles, failures):
+        """Delete subtrees and single files on a pool of worker threads
+
+        Single files are deleted in batches by directory.  Progress is
+        reported at a fixed rate rather than per file.
+        """
+        jobs = Queue.Queue()
+        for d, n in subtrees:
+            jobs.put((d, None, n))
+        bydir = {}
+        for f in singles:
+            bydir.setdefault(f.rpartition('/')[0], []).append(f)
+        for d in sorted(bydir):
+            jobs.put((d, bydir[d], len(bydir[d])))
+        total = len(singles) + sum(n for d, n in subtrees)
+        done = [0]
+        lock = threading.Lock()
+
+        def rmtreeerror(func, path, excinfo):
+            # read-only files cannot be unlinked under Windows
+            try:
+                os.chmod(path, stat.S_IMODE(os.lstat(path).st_mode)
+                         | stat.S_IWRITE)
+                func(path)
+            except EnvironmentError:
+                failures.append(util.pathto(repo.root, None, path))
+
+        def worker():
+            while True:
+                try:
+                    d, batch, n = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                if batch is None:
+                    shutil.rmtree(repo.wjoin(d), onerror=rmtreeerror)
+                else:
+                    for f in batch:
+                        try:
+                            _removefile(repo.wjoin(f))
+                        except EnvironmentError:
+                            failures.append(f)
+                lock.acquire()
+                try:
+                    done[0] += n
+                finally:
+                    lock.release()
+
+        nworkers = max(1, min(self.MAXWORKERS, jobs.qsize()))
+        threads = [threading.Thread(target=worker, name='purge')
+                   for i in xrange(nworkers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            while t.isAlive():
+                t.join(self.PROGRESSINTERVAL)
+                self.progress.emit('deleting', done[0], '', '', total)
+        self.progress.emit('deleting', None, '', '', total)
+
 def run(ui, *pats, **opts):
     from tortoisehg.hgqt import thgrepo
     from tortoisehg.util import paths
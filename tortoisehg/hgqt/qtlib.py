@@ -338,9 +338,17 @@ def markup(msg, **styles):
     msg = msg.replace('\n', '<br />')
     return u'<span style="%s">%s</span>' % (style, msg)
 
+# {(issue.regex, issue.link, cachekey): html} shared by all htmlizers
+_deschtmlcache = {}
+_DESCHTMLCACHESIZE = 2000
+
 def descriptionhtmlizer(ui):
     """Return a function to mark up ctx.description() as an HTML
 
+    The function takes an optional cachekey, e.g. the changeset node, which
+    identifies the description; results are then cached per issue tracker
+    configuration.
+
     >>> from mercurial import ui
     >>> u = ui.ui()
     >>> htmlize = descriptionhtmlizer(u)
@@ -387,6 +395,12 @@ def descriptionhtmlizer(ui):
     u'foo #123'
     >>> htmlize('http://example/')
     u'<a href="http://example/">http://example/</a>'
+
+    cached by key:
+    >>> htmlize('foo <bar>', cachekey='n1')
+    u'foo &lt;bar&gt;'
+    >>> htmlize('changed', cachekey='n1')
+    u'foo &lt;bar&gt;'
     """
     csmatch = r'(\b[0-9a-f]{12}(?:[0-9a-f]{28})?\b)'
     httpmatch = r'(\b(http|https)://([-A-Za-z0-9+&@#/%?=~_()|!:,.;]*' \
@@ -403,24 +417,30 @@ def descriptionhtmlizer(ui):
         except re.error:
             pass
 
-    def htmlize(desc):
+    def htmlize(desc, cachekey=None):
         """Mark up ctx.description() [localstr] as an HTML [unicode]"""
+        if cachekey is not None:
+            key = (issuematch, issuerepl, cachekey)
+            try:
+                return _deschtmlcache[key]
+            except KeyError:
+                pass
         desc = unicode(Qt.escape(hglib.tounicode(desc)))
 
-        buf = ''
+        buf = []
         pos = 0
         for m in bodyre.finditer(desc):
             a, b = m.span()
             if a >= pos:
-                buf += desc[pos:a]
+                buf.append(desc[pos:a])
                 pos = b
             groups = m.groups()
             if groups[0]:
                 cslink = groups[0]
-                buf += '<a href="cset:%s">%s</a>' % (cslink, cslink)
+                buf.append('<a href="cset:%s">%s</a>' % (cslink, cslink))
             if groups[1]:
                 urllink = groups[1]
-                buf += '<a href="%s">%s</a>' % (urllink, urllink)
+                buf.append('<a href="%s">%s</a>' % (urllink, urllink))
             if len(groups) > 4 and groups[4]:
                 issue = groups[4]
                 issueparams = groups[4:]
@@ -428,14 +448,19 @@ def descriptionhtmlizer(ui):
                     link = re.sub(r'\{(\d+)\}',
                                   lambda m: issueparams[int(m.group(1))],
                                   issuerepl)
-                    buf += '<a href="%s">%s</a>' % (link, issue)
+                    buf.append('<a href="%s">%s</a>' % (link, issue))
                 except IndexError:
-                    buf += issue
+                    buf.append(issue)
 
         if pos < len(desc):
-            buf += desc[pos:]
-
-        return buf
+            buf.append(desc[pos:])
+
+        html = u''.join(buf)
+        if cachekey is not None:
+            if len(_deschtmlcache) >= _DESCHTMLCACHESIZE:
+                _deschtmlcache.clear()
+            _deschtmlcache[key] = html
+        return html
 
     return htmlize
 
@@ -24,6 +24,7 @@ class RepoFilterBar(QToolBar):
     """Toolbar for RepoWidget to filter changesets"""
 
     setRevisionSet = pyqtSignal(object)
+    extendRevisionSet = pyqtSignal(object)
     clearRevisionSet = pyqtSignal()
     filterToggled = pyqtSignal(bool)
 
@@ -57,6 +58,7 @@ class RepoFilterBar(QToolBar):
         self.entrydlg.progress.connect(self.progress)
         self.entrydlg.showMessage.connect(self.showMessage)
         self.entrydlg.queryIssued.connect(self.queryIssued)
+        self.entrydlg.queryProgress.connect(self.queryProgress)
         self.entrydlg.hide()
 
         self.revsetcombo = combo = QComboBox()
@@ -169,6 +171,11 @@ class RepoFilterBar(QToolBar):
         self.saveQuery()
         self.revsetcombo.lineEdit().selectAll()
 
+    def queryProgress(self, query, revset):
+        'Show partial results of a running query'
+        if revset:
+            self.extendRevisionSet.emit(revset)
+
     def returnPressed(self):
         'Return pressed on revset line entry, forward to dialog'
         query = self.revsetcombo.lineEdit().text().simplified()
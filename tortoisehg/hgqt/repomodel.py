@@ -20,7 +20,7 @@ from mercurial import util, error
 from mercurial.util import propertycache
 from mercurial.context import workingctx
 
-from tortoisehg.util import hglib
+from tortoisehg.util import hglib, tracing
 from tortoisehg.hgqt.graph import Graph
 from tortoisehg.hgqt.graph import revision_grapher
 from tortoisehg.hgqt import qtlib
@@ -139,6 +139,7 @@ class HgRepoListModel(QAbstractTableModel):
         self.repo = repo
         self.revset = revset
         self.filterbyrevset = rfilter
+        self._revsetgraph = False
         self.unicodestar = True
         self.unicodexinabox = True
         self.cfgname = cfgname
@@ -173,7 +174,8 @@ class HgRepoListModel(QAbstractTableModel):
     def setBranch(self, branch=None, allparents=False):
         self.filterbranch = branch  # unicode
         self.invalidateCache()
-        if self.revset and self.filterbyrevset:
+        self._revsetgraph = bool(self.revset and self.filterbyrevset)
+        if self._revsetgraph:
             grapher = revision_grapher(self.repo,
                                        branch=hglib.fromunicode(branch),
                                        revset=self.revset)
@@ -189,6 +191,38 @@ class HgRepoListModel(QAbstractTableModel):
         self.showMessage.emit('')
         QTimer.singleShot(0, lambda: self.filled.emit())
 
+    def extendRevset(self, revset):
+        '''Show revset, the partial result of a running revision set query
+
+        Unlike setBranch(), this neither emits filled nor discards the
+        rows already shown if revset only adds revisions older than those
+        of the current one, so the selection and scroll position are kept.
+        '''
+        oldrevset = self.revset
+        self.revset = revset
+        self.invalidateCache()
+        if not self.filterbyrevset:
+            if self.rowcount:
+                self.dataChanged.emit(self.index(0, 0),
+                                      self.index(self.rowcount - 1,
+                                                 len(self._columns) - 1))
+            return
+        shown = 0
+        if (self._revsetgraph and oldrevset
+            and revset[:len(oldrevset)] == oldrevset):
+            shown = self.rowcount
+        self._revsetgraph = True
+        grapher = revision_grapher(self.repo,
+                                   branch=hglib.fromunicode(self.filterbranch),
+                                   revset=revset)
+        self.layoutAboutToBeChanged.emit()
+        self.graph = Graph(self.repo, grapher, include_mq=False)
+        if shown:
+            self.graph.build_nodes(nnodes=shown)
+        self.rowcount = min(shown, len(self.graph))
+        self.layoutChanged.emit()
+        self.ensureBuilt(row=self.rowcount)
+
     def reloadConfig(self):
         _ui = self.repo.ui
         self.fill_step = int(_ui.config('tortoisehg', 'graphlimit', 500))
@@ -300,15 +334,15 @@ class HgRepoListModel(QAbstractTableModel):
         if column in ('LocalTime', 'UTCTime'):
             return hglib.displaytime(util.makedate())
         if column == 'Tags':
-            try:
-                return sorted(self.repo.tags().keys(), key=lambda x: len(x))[-1][:10]
-            except IndexError:
-                pass
+            longest = self.repo.thgnamestats.longesttag()
+            if longest:
+                return longest[:10]
         if column == 'Branch':
-            try:
-                return sorted(self.repo.branchtags().keys(), key=lambda x: len(x))[-1]
-            except IndexError:
-                pass
+            longest = self.repo.thgnamestats.longestbranch()
+            if longest:
+                return longest
+        if column == 'Author':
+            return self.repo.thgnamestats.longestauthor or None
         if column == 'Filename':
             return self.filename
         if column == 'Graph':
@@ -335,6 +369,7 @@ class HgRepoListModel(QAbstractTableModel):
     def col2x(self, col):
         return 2 * self.dotradius * col + self.dotradius/2 + 8
 
+    @tracing.traced('repomodel.graphctx')
     def graphctx(self, ctx, gnode):
         w = self.col2x(gnode.cols) + 10
         h = self.rowheight
@@ -495,6 +530,7 @@ class HgRepoListModel(QAbstractTableModel):
                 self._cache[row] = data
             return data[idx]
 
+    @tracing.traced('repomodel.rawdata')
     def rawdata(self, row, column, role):
         gnode = self.graph[row]
         ctx = self.repo.changectx(gnode.rev)
@@ -627,9 +663,11 @@ class HgRepoListModel(QAbstractTableModel):
 
     def getauthor(self, ctx, gnode):
         try:
-            return hglib.username(ctx.user())
+            author = hglib.username(ctx.user())
         except error.Abort:
-            return _('Mercurial User')
+            author = _('Mercurial User')
+        self.repo.thgnamestats.addauthor(author)
+        return author
 
     def getlog(self, ctx, gnode):
         if ctx.rev() is None:
@@ -22,6 +22,14 @@ def settingsfilename():
     dir = os.path.dirname(unicode(s.fileName()))
     return dir + '/' + 'thg-reporegistry.xml'
 
+_registryindex = None
+
+def registryindex():
+    """Shared RegistryIndex of the registry file"""
+    global _registryindex
+    if _registryindex is None:
+        _registryindex = repotreemodel.RegistryIndex(settingsfilename())
+    return _registryindex
 
 class RepoTreeView(QTreeView):
     showMessage = pyqtSignal(QString)
@@ -250,6 +258,7 @@ class RepoRegistryView(QDockWidget):
         tv.setModel(repotreemodel.RepoTreeModel(sfile, self,
             showSubrepos=self.showSubrepos,
             showNetworkSubrepos=self.showNetworkSubrepos))
+        tv.model().subreposLoaded.connect(self.updateSettingsFile)
 
         mainframe.layout().addWidget(tv)
 
@@ -307,6 +316,7 @@ class RepoRegistryView(QDockWidget):
         if self.watcher:
             self.watcher.removePath(sfile)
         self.tview.model().write(sfile)
+        registryindex().invalidate()
         if self.watcher:
             self.watcher.addPath(sfile)
 
@@ -337,10 +347,12 @@ class RepoRegistryView(QDockWidget):
 
     def reloadModel(self):
         oldmodel = self.tview.model()
+        oldmodel.stopLoading()
         self.tview.setModel(
             repotreemodel.RepoTreeModel(settingsfilename(), self,
                 self.showSubrepos, self.showNetworkSubrepos,
                 self.showShortPaths))
+        self.tview.model().subreposLoaded.connect(self.updateSettingsFile)
         oldmodel.deleteLater()
         self.expand()
         self._pendingReloadModel = False
@@ -420,6 +432,7 @@ class RepoRegistryView(QDockWidget):
         # We must stop monitoring the settings file and then we can save it
         sfile = settingsfilename()
         self.watcher.removePath(sfile)
+        self.tview.model().stopLoading()
         self.tview.model().write(sfile)
 
     def _action_defs(self):
@@ -37,6 +37,18 @@ def classToXml(classname):
             inverseXmlClassMap[v] = k
     return inverseXmlClassMap[classname]
 
+def subrepoStamp(root):
+    """Return a string which changes when the subrepo list of root may
+    have changed"""
+    stamp = []
+    for f in ('.hgsub', '.hgsubstate'):
+        try:
+            st = os.stat(os.path.join(root, f))
+            stamp.append('%d:%d' % (st.st_mtime, st.st_size))
+        except EnvironmentError:
+            stamp.append('-')
+    return ' '.join(stamp)
+
 def undumpObject(xr):
     classname = xmlToClass(str(xr.name().toString()))
     class_ = getattr(sys.modules[RepoTreeItem.__module__], classname)
@@ -159,6 +171,9 @@ class RepoItem(RepoTreeItem):
         else:
             self._valid = False
         self._isActiveTab = False
+        # stamp of .hgsub and .hgsubstate at the time subrepos were loaded,
+        # or None if they have not been loaded yet
+        self._substamp = None
 
     def isRepo(self):
         return True
@@ -182,6 +197,17 @@ class RepoItem(RepoTreeItem):
     def setBaseNode(self, basenode):
         self._basenode = basenode
 
+    def subreposLoaded(self):
+        return self._substamp is not None
+
+    def subreposStale(self):
+        """True if the loaded subrepos of this tree may be out of date"""
+        if self._repotype != 'hg':
+            return False
+        if self._substamp != subrepoStamp(self._root):
+            return True
+        return util.any(c.subreposStale() for c in self.childs)
+
     def setShortName(self, uname):
         if uname != self._shortname:
             self._shortname = uname
@@ -248,6 +274,12 @@ class RepoItem(RepoTreeItem):
         xw.writeAttribute('root', hglib.tounicode(self._root))
         xw.writeAttribute('shortname', self.shortname())
         xw.writeAttribute('basenode', node.hex(self.basenode()))
+        if self.subreposLoaded():
+            xw.writeAttribute('substamp', self._substamp)
+            for c in self.childs:
+                # bypass SubrepoItem.dumpObject(), which refuses to dump
+                # non-hg subrepos on drag and drop
+                RepoTreeItem.dumpObject(c, xw)
 
     def undump(self, xr):
         self._valid = True
@@ -255,6 +287,8 @@ class RepoItem(RepoTreeItem):
         self._root = hglib.fromunicode(a.value('', 'root').toString())
         self._shortname = unicode(a.value('', 'shortname').toString())
         self._basenode = node.bin(str(a.value('', 'basenode').toString()))
+        if a.hasAttribute('substamp'):
+            self._substamp = str(a.value('', 'substamp').toString())
         RepoTreeItem.undump(self, xr)
 
     def details(self):
@@ -268,11 +302,17 @@ class RepoItem(RepoTreeItem):
             return super(RepoItem, self).getRepoItem(reporoot, lookForSubrepos)
         return None
 
-    def appendSubrepos(self, repo=None):
+    def appendSubrepos(self, repo=None, interactive=True):
+        """Load the subrepo tree from the working directory parent
+
+        If interactive is False, no message box is shown on unexpected
+        errors, so this can be called from a worker thread.
+        """
         invalidRepoList = []
 
         # Mercurial repos are the only ones that can have subrepos
         if self.repotype() == 'hg':
+            self._substamp = subrepoStamp(self._root)
             try:
                 sri = None
                 if repo is None:
@@ -303,7 +343,8 @@ class RepoItem(RepoTreeItem):
                     if subtype == 'hg':
                         # Only recurse into mercurial subrepos
                         sctx = wctx.sub(subpath)
-                        invalidSubrepoList = sri.appendSubrepos(sctx._repo)
+                        invalidSubrepoList = sri.appendSubrepos(sctx._repo,
+                                                                interactive)
                         if invalidSubrepoList:
                             self._valid = False
                             invalidRepoList += invalidSubrepoList
@@ -328,6 +369,8 @@ class RepoItem(RepoTreeItem):
                     sri._valid = False
                     invalidRepoList.append(abssubpath)
                 invalidRepoList.append(self._root)
+                if not interactive:
+                    return invalidRepoList
 
                 # Show a warning message indicating that there was an error
                 if repo:
@@ -377,18 +420,21 @@ class SubrepoItem(RepoItem):
         RepoItem.__init__(self, repo, parent)
         self._parentrepo = parentrepo
         self._repotype = subtype
-        if self._repotype != 'hg':
-            # Make sure that we cannot drag non hg subrepos
-            # To do so we disable the dumpObject method for non hg subrepos
-            def doNothing(dummy):
-                pass
-            self.dumpObject = doNothing
 
-            # Limit the context menu to those actions that are valid for non
-            # mercurial subrepos
-            def nonHgMenulist():
-                return ['remove', None, 'explore', 'terminal']
-            self.menulist = nonHgMenulist
+    def dumpObject(self, xw):
+        # Make sure that we cannot drag non hg subrepos
+        if self._repotype == 'hg':
+            super(SubrepoItem, self).dumpObject(xw)
+
+    def dump(self, xw):
+        xw.writeAttribute('subtype', self._repotype)
+        super(SubrepoItem, self).dump(xw)
+
+    def undump(self, xr):
+        a = xr.attributes()
+        if a.hasAttribute('subtype'):
+            self._repotype = str(a.value('', 'subtype').toString())
+        super(SubrepoItem, self).undump(xr)
 
     def data(self, column, role):
         if role == Qt.DecorationRole:
@@ -412,6 +458,10 @@ class SubrepoItem(RepoItem):
             return super(SubrepoItem, self).data(column, role)
 
     def menulist(self):
+        if self._repotype != 'hg':
+            # Limit the context menu to those actions that are valid for non
+            # mercurial subrepos
+            return ['remove', None, 'explore', 'terminal']
         if isinstance(self._parent, RepoGroupItem):
             return super(SubrepoItem, self).menulist()
         else:
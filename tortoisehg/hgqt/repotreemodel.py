@@ -17,7 +17,7 @@ from repotreeitem import RepoItem, RepoTreeItem, SubrepoItem
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
-import os
+import os, Queue
 
 
 extractXmlElementName = 'reporegextract'
@@ -56,13 +56,63 @@ def readXml(source, rootElementName):
     return itemread
 
 def iterRepoItemFromXml(source):
-    'Used by thgrepo.relatedRepositories to scan the XML file'
+    'Used by RegistryIndex to scan the XML file'
     xr = QXmlStreamReader(source)
     while not xr.atEnd():
         t = xr.readNext()
         if t == QXmlStreamReader.StartElement and xr.name() in ('repo', 'subrepo'):
             yield undumpObject(xr)
 
+class RegistryIndex(object):
+    """Repositories of a registry file by base node and root path
+
+    The file is parsed again only after invalidate() or when its size or
+    mtime changed, so lookups like thgrepo.relatedRepositories() cost a
+    stat and a dict lookup.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._stamp = None
+        self._bynode = {}  # {basenode: [(root, shortname)]}
+        self._byroot = {}  # {root: (basenode, shortname)}
+
+    def invalidate(self):
+        self._stamp = None
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.filename)
+            stamp = (st.st_mtime, st.st_size)
+        except EnvironmentError:
+            stamp = False
+        if stamp == self._stamp:
+            return
+        bynode, byroot = {}, {}
+        f = QFile(self.filename)
+        if stamp and f.open(QIODevice.ReadOnly):
+            try:
+                for e in iterRepoItemFromXml(f):
+                    root, shortname = e.rootpath(), e.shortname()
+                    bynode.setdefault(e.basenode(), []).append((root,
+                                                                shortname))
+                    byroot[root] = (e.basenode(), shortname)
+            finally:
+                f.close()
+        self._stamp = stamp
+        self._bynode = bynode
+        self._byroot = byroot
+
+    def related(self, basenode):
+        'List of (root, shortname) of the repositories with basenode'
+        self._refresh()
+        return list(self._bynode.get(basenode, ()))
+
+    def lookup(self, root):
+        '(basenode, shortname) of the repository at root, or None'
+        self._refresh()
+        return self._byroot.get(root)
+
 def getRepoItemList(root, includeSubRepos=False):
     if not includeSubRepos and isinstance(root, RepoItem):
         return [root]
@@ -73,10 +123,96 @@ def getRepoItemList(root, includeSubRepos=False):
                     for c in root.childs), [])
 
 
+class _SubrepoScanThread(QThread):
+    """Worker of SubrepoLoader; runs jobs taken from a shared queue"""
+
+    scanned = pyqtSignal(str, object, bool, object, object)
+    probed = pyqtSignal(str, bool, bool)
+
+    def __init__(self, queue, parent=None):
+        super(_SubrepoScanThread, self).__init__(parent)
+        self._queue = queue
+
+    def run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            kind, root = job
+            if kind == 'probe':
+                isnetwork = bool(paths.netdrive_status(root))
+                hashgsub = os.path.exists(os.path.join(root, '.hgsub'))
+                self.probed.emit(root, isnetwork, hashgsub)
+                continue
+            # scan into a detached item; only plain python objects are
+            # created here, so the model can adopt them in the GUI thread.
+            # The stamp is taken before scanning, so that changes made
+            # meanwhile leave the result stale.
+            item = RepoItem(root)
+            invalid = item.appendSubrepos(interactive=False)
+            self.scanned.emit(root, item.childs, item._valid, invalid,
+                              item._substamp)
+
+class SubrepoLoader(QObject):
+    """Discover subrepositories of registered repos on worker threads"""
+
+    # (root, [SubrepoItem, ...], valid, [invalid root, ...], stamp)
+    loaded = pyqtSignal(str, object, bool, object, object)
+    # (root, is on a network drive, has .hgsub)
+    probed = pyqtSignal(str, bool, bool)
+
+    MAXWORKERS = 4
+
+    def __init__(self, parent=None):
+        super(SubrepoLoader, self).__init__(parent)
+        self._queue = Queue.Queue()
+        self._threads = []
+
+    def request(self, root):
+        """Scan the subrepos of root"""
+        self._put(('scan', root))
+
+    def probe(self, root):
+        """Check whether root is on a network drive and may have subrepos,
+        without touching the file system in the GUI thread"""
+        self._put(('probe', root))
+
+    def _put(self, job):
+        self._queue.put(job)
+        if len(self._threads) < self.MAXWORKERS:
+            th = _SubrepoScanThread(self._queue, self)
+            th.scanned.connect(self.loaded)
+            th.probed.connect(self.probed)
+            self._threads.append(th)
+            th.start()
+
+    def stop(self):
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Queue.Empty:
+                break
+        for th in self._threads:
+            self._queue.put(None)
+        for th in self._threads:
+            th.wait()
+        self._threads = []
+
 class RepoTreeModel(QAbstractItemModel):
+    """Model of the repository registry
+
+    If showSubrepos is set, subrepos are discovered lazily when a repo
+    node is expanded, using a SubrepoLoader.  Discovered subrepos are
+    saved in the registry file along with a stamp of the .hgsub and
+    .hgsubstate files, so that unchanged repos are not reopened on the
+    next start.
+    """
 
     updateProgress = pyqtSignal(int, int, QString, QString)
 
+    # emitted when lazily-loaded subrepos should be saved
+    subreposLoaded = pyqtSignal()
+
     def __init__(self, filename, parent, showSubrepos=False,
             showNetworkSubrepos=False, showShortPaths=False):
         QAbstractItemModel.__init__(self, parent)
@@ -84,6 +220,14 @@ class RepoTreeModel(QAbstractItemModel):
         self.showSubrepos = showSubrepos
         self.showNetworkSubrepos = showNetworkSubrepos
         self.showShortPaths = showShortPaths
+        self._loader = SubrepoLoader(self)
+        self._loader.loaded.connect(self._subreposLoaded)
+        self._loader.probed.connect(self._repoProbed)
+        self._pendingloads = set()
+        self._probes = {}  # {root: (isnetwork, hashgsub)}
+        self._pendingprobes = set()
+        self._reloadafterprobe = set()
+        self._loadcount = 0
 
         root = None
         all = None
@@ -99,8 +243,7 @@ class RepoTreeModel(QAbstractItemModel):
                             all = c
                             break
 
-                    if self.showSubrepos:
-                        self.loadSubrepos(root)
+                    self._validateSubrepos(root)
 
         if not root:
             root = RepoTreeItem(self)
@@ -146,6 +289,25 @@ class RepoTreeModel(QAbstractItemModel):
             parentItem = parent.internalPointer()
         return parentItem.childCount()
 
+    def hasChildren(self, parent=QModelIndex()):
+        if parent.isValid() and parent.column() == 0:
+            item = parent.internalPointer()
+            if self._canLoadSubrepos(item):
+                return self._mayHaveSubrepos(item)
+        return super(RepoTreeModel, self).hasChildren(parent)
+
+    def canFetchMore(self, parent):
+        if not parent.isValid():
+            return False
+        item = parent.internalPointer()
+        return (self._canLoadSubrepos(item)
+                and item.rootpath() not in self._pendingloads
+                and self._mayHaveSubrepos(item))
+
+    def fetchMore(self, parent):
+        if parent.isValid():
+            self._requestSubrepos(parent.internalPointer())
+
     def columnCount(self, parent):
         if parent.isValid():
             return parent.internalPointer().columnCount()
@@ -228,8 +390,7 @@ class RepoTreeModel(QAbstractItemModel):
             return False
         if row < 0:
             row = 0
-        if self.showSubrepos:
-            self.loadSubrepos(itemread)
+        self._validateSubrepos(itemread)
         self.beginInsertRows(parent, row, row)
         group.insertChild(row, itemread)
         self.endInsertRows()
@@ -339,23 +500,122 @@ class RepoTreeModel(QAbstractItemModel):
             count += 1
 
     def loadSubrepos(self, root, filterFunc=(lambda r: True)):
-        repoList = getRepoItemList(root)
-        for n, c in enumerate(repoList):
-            QCoreApplication.processEvents()
-            if filterFunc(c.rootpath()):
-                if self.showNetworkSubrepos \
-                        or not paths.netdrive_status(c.rootpath()):
-                    self.updateProgress.emit(n, len(repoList),
-                        _('Updating repository registry'),
-                        _('Loading repository %s')
-                        % hglib.tounicode(c.rootpath()))
-                    QCoreApplication.processEvents()
-                    self.removeRows(0, c.childCount(),
-                        self.createIndex(c.row(), 0, c))
-                    c.appendSubrepos()
-        self.updateProgress.emit(len(repoList), len(repoList),
-            _('Updating repository registry'),
-            _('Repository Registry updated'))
+        """Reload subrepos of already-loaded repos under root in the
+        background; repos which were never expanded stay lazy"""
+        for c in getRepoItemList(root):
+            if not filterFunc(c.rootpath()) or not c.subreposLoaded():
+                continue
+            if self._canLoadSubrepos(c, True):
+                self._requestSubrepos(c)
+            elif c.rootpath() in self._pendingprobes:
+                self._reloadafterprobe.add(c.rootpath())
+
+    def stopLoading(self):
+        self._loader.stop()
+
+    def _canLoadSubrepos(self, item, reload=False):
+        if not self.showSubrepos or not isinstance(item, RepoItem):
+            return False
+        if item.subreposLoaded() and not reload:
+            return False
+        # only top-level items are scanned; nested ones load with them
+        if not isinstance(item.parent(), RepoGroupItem):
+            return False
+        if self.showNetworkSubrepos:
+            return True
+        probe = self._probe(item)
+        return probe is not None and not probe[0]
+
+    def _mayHaveSubrepos(self, item):
+        """Cheap check whether the repository may contain subrepos; False
+        until the loader has probed it"""
+        if item.subreposLoaded():
+            return bool(item.childs)
+        if item.repotype() != 'hg':
+            return False
+        probe = self._probe(item)
+        return probe is not None and probe[1]
+
+    def _probe(self, item):
+        """Cached (isnetwork, hashgsub) of item, or None after requesting
+        it from the loader"""
+        root = item.rootpath()
+        probe = self._probes.get(root)
+        if probe is None and root not in self._pendingprobes:
+            self._pendingprobes.add(root)
+            self._loader.probe(root)
+        return probe
+
+    @pyqtSlot(str, bool, bool)
+    def _repoProbed(self, root, isnetwork, hashgsub):
+        root = str(root)
+        self._pendingprobes.discard(root)
+        self._probes[root] = (isnetwork, hashgsub)
+        if root in self._reloadafterprobe:
+            self._reloadafterprobe.discard(root)
+            item = self.getRepoItem(root)
+            if item and self._canLoadSubrepos(item, True):
+                self._requestSubrepos(item)
+        if not self._pendingprobes:
+            # let the views ask hasChildren() again
+            self.layoutAboutToBeChanged.emit()
+            self.layoutChanged.emit()
+
+    def _validateSubrepos(self, root):
+        """Drop subrepos read from the registry file if they are hidden
+        or may be out of date"""
+        for c in getRepoItemList(root):
+            if not c.subreposLoaded():
+                continue
+            if self.showSubrepos and not c.subreposStale():
+                continue
+            c.removeRows(0, c.childCount())
+            c._substamp = None
+
+    def _requestSubrepos(self, item):
+        root = item.rootpath()
+        if root in self._pendingloads:
+            return
+        if not self._pendingloads:
+            self._loadcount = 0
+        self._pendingloads.add(root)
+        self._loadcount += 1
+        self._loader.request(root)
+        self._emitLoadProgress(root)
+
+    def _emitLoadProgress(self, root):
+        done = self._loadcount - len(self._pendingloads)
+        if self._pendingloads:
+            self.updateProgress.emit(done, self._loadcount,
+                _('Updating repository registry'),
+                _('Loading repository %s') % hglib.tounicode(root))
+        else:
+            self.updateProgress.emit(done, done,
+                _('Updating repository registry'),
+                _('Repository Registry updated'))
+
+    @pyqtSlot(str, object, bool, object, object)
+    def _subreposLoaded(self, root, childs, valid, invalid, stamp):
+        root = str(root)
+        self._pendingloads.discard(root)
+        self._probes.pop(root, None)  # .hgsub may have come or gone
+        self._emitLoadProgress(root)
+        item = self.getRepoItem(root)
+        if not item or not isinstance(item.parent(), RepoGroupItem):
+            return  # removed while loading
+        index = self.createIndex(item.row(), 0, item)
+        if item.childCount():
+            self.removeRows(0, item.childCount(), index)
+        if childs:
+            self.beginInsertRows(index, 0, len(childs) - 1)
+            for c in childs:
+                item.appendChild(c)
+            self.endInsertRows()
+        item._valid = valid
+        item._substamp = stamp
+        self.dataChanged.emit(index, index)
+        if not self._pendingloads:
+            self.subreposLoaded.emit()
 
     def updateCommonPaths(self, showShortPaths=None):
         if not showShortPaths is None:
@@ -66,6 +66,10 @@ class RepoWidget(QWidget):
         QWidget.__init__(self, parent, acceptDrops=True)
 
         self.repo = repo
+        # keep repo in thgrepo's cache while this widget exists; self.repo
+        # may later be replaced by a bundle repository
+        repo.incrementRefCount()
+        self.destroyed.connect(lambda: repo.decrementRefCount())
         repo.repositoryChanged.connect(self.repositoryChanged)
         repo.repositoryDestroyed.connect(self.repositoryDestroyed)
         repo.configChanged.connect(self.configChanged)
@@ -168,6 +172,7 @@ class RepoWidget(QWidget):
         self.filterbar.progress.connect(self.progress)
         self.filterbar.showMessage.connect(self.showMessage)
         self.filterbar.setRevisionSet.connect(self.setRevisionSet)
+        self.filterbar.extendRevisionSet.connect(self.extendRevisionSet)
         self.filterbar.clearRevisionSet.connect(self._unapplyRevisionSet)
         self.filterbar.filterToggled.connect(self.filterToggled)
         self.filterbar.hide()
@@ -537,6 +542,15 @@ class RepoWidget(QWidget):
         self.repoview.resetBrowseHistory(self.revset)
         self._reload_rev = self.revset[0]
 
+    def extendRevisionSet(self, revisions):
+        '''Show partial results of a revision set query, without reloading
+        or changing the selection; the final result goes to setRevisionSet'''
+        revs = revisions[:]
+        revs.sort(reverse=True)
+        self.revset = revs
+        self.repomodel.filterbyrevset = self.revsetfilter
+        self.repomodel.extendRevset(self.revset)
+
     @pyqtSlot(bool)
     def filterToggled(self, checked):
         self.revsetfilter = checked
@@ -230,10 +230,14 @@ class RevDetailsWidget(QWidget, qtlib.TaskWidget):
         self.revpanel.update(repo = self.repo)
         msg = ctx.description()
         inlinetags = self.repo.ui.configbool('tortoisehg', 'issue.inlinetags')
+        cachekey = ctx.node()
         if ctx.tags() and inlinetags:
             msg = ' '.join(['[%s]' % tag for tag in ctx.tags()]) + ' ' + msg
+            cachekey = (cachekey, tuple(ctx.tags()))
+        if not isinstance(ctx.rev(), int):
+            cachekey = None  # working directory or unapplied patch
         self.message.setHtml('<pre>%s</pre>'
-                             % self._deschtmlize(msg))
+                             % self._deschtmlize(msg, cachekey=cachekey))
         self._fileactions.setRev(rev)
         self.actionShowAllMerge.setEnabled(len(ctx.parents()) == 2)
         self.fileview.setContext(ctx)
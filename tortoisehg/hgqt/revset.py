@@ -5,9 +5,9 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2, incorporated herein by reference.
 
-import os
+import os, time
 
-from mercurial import revset, hg, error
+from mercurial import revset, hg, error, node, util
 
 from tortoisehg.hgqt import qtlib, cmdui
 from tortoisehg.util import hglib
@@ -111,9 +111,31 @@ _logical = (
      _('All changesets, the same as 0:tip.')),
 )
 
+# functions whose result for a revision depends only on that revision,
+# so that matches over new revisions can be added to earlier matches
+_appendsafe = set(['adds', 'all', 'author', 'closed', 'contains', 'desc',
+                   'file', 'grep', 'keyword', 'merge', 'modifies', 'removes',
+                   'user'])
+
+def _isappendsafe(tree, aliases):
+    op = tree[0]
+    if op == 'func':
+        name = tree[1][1]
+        return name in _appendsafe and name not in aliases
+    if op in ('and', 'or', 'not', 'group'):
+        return util.all(_isappendsafe(t, aliases) for t in tree[1:])
+    return False
+
+# {(repository root, query): (changelog length, tip node, [matched revs])}
+# for append-safe queries only
+_resultcache = {}
+_MAXCACHED = 50
+
 class RevisionSetQuery(QDialog):
     # Emit query string and resulting revision set
     queryIssued = pyqtSignal(QString, object)
+    # Emit query string and revisions found so far by a running query
+    queryProgress = pyqtSignal(QString, object)
     showMessage = pyqtSignal(QString)
     progress = pyqtSignal(QString, object, QString, QString, object)
 
@@ -230,6 +252,7 @@ class RevisionSetQuery(QDialog):
         self.refreshing = RevsetThread(self.repo, self.entry.text(), self)
         self.refreshing.showMessage.connect(self.showMessage)
         self.refreshing.queryIssued.connect(self.queryIssued)
+        self.refreshing.queryProgress.connect(self.queryProgress)
         self.refreshing.finished.connect(self.queryFinished)
         self.refreshing.setCursorPosition.connect(self.entry.setCursorPosition)
         self.refreshing.start()
@@ -366,6 +389,7 @@ class RevsetEntry(QsciScintilla):
 
 class RevsetThread(QThread):
     queryIssued = pyqtSignal(QString, object)
+    queryProgress = pyqtSignal(QString, object)
     showMessage = pyqtSignal(QString)
     setCursorPosition = pyqtSignal(int, int)
 
@@ -388,9 +412,7 @@ class RevsetThread(QThread):
         try:
             os.chdir(self.repo.root)
             func = revset.match(self.repo.ui, self.text)
-            l = []
-            for c in func(self.repo, range(len(self.repo))):
-                l.append(c)
+            l = self.evaluate(func)
             if len(l):
                 self.showMessage.emit(_('%d matches found') % len(l))
             else:
@@ -410,6 +432,52 @@ class RevsetThread(QThread):
 
         os.chdir(cwd)
 
+    CHUNKSIZE = 5000
+    PROGRESSINTERVAL = 0.5
+
+    def evaluate(self, func):
+        '''Return the revisions matched by func
+
+        Append-safe queries are evaluated in chunks, newest revisions
+        first, reporting partial results through queryProgress.  Their
+        results are cached; after new revisions are added to the
+        repository only those are evaluated.
+        '''
+        repo = self.repo
+        total = len(repo)
+        aliases = set(n.split('(')[0]
+                      for n, v in repo.ui.configitems('revsetalias'))
+        if not _isappendsafe(revset.parse(self.text)[0], aliases):
+            return list(func(repo, range(total)))
+
+        key = (repo.root, self.text)
+        start, revs = 0, []
+        if key in _resultcache:
+            clen, tipnode, cachedrevs = _resultcache[key]
+            if clen <= total and (not clen or repo.changelog.node(clen - 1)
+                                  == tipnode):
+                start, revs = clen, list(cachedrevs)
+
+        chunks = []
+        lastemit = time.time()
+        for stop in xrange(total, start, -self.CHUNKSIZE):
+            chunks.append(func(repo, range(max(start, stop - self.CHUNKSIZE),
+                                           stop)))
+            if chunks[-1] and time.time() - lastemit > self.PROGRESSINTERVAL:
+                found = []
+                for c in chunks:
+                    found.extend(reversed(c))
+                self.queryProgress.emit(self.query, found)
+                lastemit = time.time()
+        for c in reversed(chunks):
+            revs.extend(c)
+
+        if len(_resultcache) >= _MAXCACHED and key not in _resultcache:
+            _resultcache.pop(iter(_resultcache).next())
+        tipnode = total and repo.changelog.node(total - 1) or node.nullid
+        _resultcache[key] = (total, tipnode, revs)
+        return list(revs)
+
 def run(ui, *pats, **opts):
     from tortoisehg.util import paths
     from tortoisehg.hgqt import thgrepo
@@ -15,22 +15,26 @@ warranty; not even for MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
 import os
 import pdb
 import sys
+import getpass
+import socket
+import struct
 import subprocess
+import tempfile
+import time
 import traceback
 import zlib
 import gc
 
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
+from PyQt4.QtNetwork import QLocalServer
 
 import mercurial.ui as uimod
 from mercurial import util, fancyopts, cmdutil, extensions, error, scmutil
 
 from tortoisehg.hgqt.i18n import agettext as _
-from tortoisehg.util import hglib, paths, i18n
+from tortoisehg.util import hglib, paths, i18n, startupprof, tracing
 from tortoisehg.util import version as thgversion
-from tortoisehg.hgqt import qtlib
-from tortoisehg.hgqt.bugreport import run as bugrun
 
 try:
     from tortoisehg.util.config import nofork as config_nofork
@@ -53,6 +57,10 @@ def dispatch(args):
             u.setconfig('ui', 'traceback', 'on')
         if '--debugger' in args:
             pdb.set_trace()
+        if '--profile-startup' in args:
+            startupprof.enable()
+        if _sendtoserver(u, args):
+            return 0
         return _runcatch(u, args)
     except error.ParseError, e:
         from tortoisehg.hgqt.bugreport import ExceptionMsgBox
@@ -73,6 +81,7 @@ def dispatch(args):
         # generic errors before the QApplication is started
         if '--debugger' in args:
             pdb.post_mortem(sys.exc_info()[2])
+        from tortoisehg.hgqt.bugreport import run as bugrun
         opts = {}
         opts['cmd'] = ' '.join(sys.argv[1:])
         opts['error'] = traceback.format_exc()
@@ -81,6 +90,101 @@ def dispatch(args):
     except KeyboardInterrupt:
         print _('\nCaught keyboard interrupt, aborting.\n')
 
+# Requests to the application server are framed as
+#   _SERVERMAGIC, 4-byte length,
+#   '\0'.join([cwd, str(len(args))] + args + ['NAME=value' of _clientenv])
+# and answered by _SERVERACK, or by _SERVERNAK if the client environment
+# differs from the server's.  Any other data is a legacy request from
+# workbench.connectToExistingWorkbench(), i.e. a bare repository root
+# or '[echo]', which is echoed back.
+_SERVERMAGIC = '[thg]'
+_SERVERACK = '[ok]'
+_SERVERNAK = '[no]'
+
+# commands which only print to the console are never sent to the server
+_consolecommands = set(['debugcomplete', 'help', 'thgstatus', 'version'])
+
+def servername():
+    """Name of the local socket of the application server"""
+    return 'TortoiseHgQt-' + getpass.getuser()
+
+def _clientenv(environ):
+    """Variables of environ which change how a command runs"""
+    return dict((k, v) for k, v in environ.iteritems()
+                if k.startswith(('HG', 'LC_', 'LANG'))
+                or k in ('EMAIL', 'EDITOR', 'VISUAL'))
+
+def _findcmdname(args):
+    """Return the command name in args without consuming --listfile"""
+    valueopts = ('-R', '--repository', '--listfile', '--listfileutf8')
+    it = iter(args)
+    for a in it:
+        if a in valueopts:
+            it.next()
+        elif not a.startswith('-'):
+            return a
+    return 'workbench'
+
+def _connectserver():
+    """Open a file object to the application server without Qt"""
+    if os.name == 'nt':
+        return open(r'\\.\pipe\%s' % servername(), 'r+b', 0)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(10)
+    s.connect(os.path.join(hglib.fromunicode(QDir.tempPath()), servername()))
+    return s.makefile('r+b', 0)
+
+def _sendtoserver(ui, args):
+    """Ask a running thg process to run args; True if it accepted them
+
+    This runs before QApplication is created, so that an already running
+    process can open the dialog without paying for the startup cost.
+    """
+    if not ui.configbool('tortoisehg', 'appserver') or qtrun.running():
+        return False
+    localopts = ('--nofork', '--newworkbench', '--profile',
+                 '--profile-startup', '--debugger', '--help', '-h')
+    if [a for a in args if a in localopts]:
+        return False
+    try:
+        aliases, i = cmdutil.findcmd(_findcmdname(args), table, False)
+    except (error.AmbiguousCommand, error.UnknownCommand, StopIteration):
+        return False
+    if aliases[0] in _consolecommands:
+        return False
+
+    try:
+        f = _connectserver()
+    except (EnvironmentError, socket.error):
+        return False
+    reqargs = list(args)
+    listfiles = []
+    for opt in ('--listfile', '--listfileutf8'):
+        if opt in reqargs and reqargs.index(opt) + 1 < len(reqargs):
+            n = reqargs.index(opt) + 1
+            if reqargs[n] == '-':
+                # the server cannot read our stdin; it deletes the file
+                fd, reqargs[n] = tempfile.mkstemp(prefix='thg-listfile-')
+                os.write(fd, sys.stdin.read())
+                os.close(fd)
+                listfiles.append(n)
+    env = ['%s=%s' % e for e in sorted(_clientenv(os.environ).iteritems())]
+    req = '\0'.join([os.getcwd(), str(len(reqargs))] + reqargs + env)
+    try:
+        try:
+            f.write(_SERVERMAGIC + struct.pack('>I', len(req)) + req)
+            if f.read(len(_SERVERACK)) == _SERVERACK:
+                return True
+        finally:
+            f.close()
+    except (EnvironmentError, socket.error):
+        pass
+    # stdin is consumed, so run locally from the list file, which
+    # get_lines_from_listfile() removes after reading
+    for n in listfiles:
+        args[n] = reqargs[n]
+    return False
+
 origwdir = os.getcwd()
 def portable_fork(ui, opts):
     if 'THG_GUI_SPAWN' in os.environ or (
@@ -96,6 +200,7 @@ def portable_fork(ui, opts):
     sys.exit(0)
 
 def portable_start_fork(extraargs=None):
+    from tortoisehg.hgqt import qtlib
     os.environ['THG_GUI_SPAWN'] = '1'
     # Spawn background process and exit
     if hasattr(sys, "frozen"):
@@ -293,7 +398,7 @@ def runcommand(ui, args):
         os.chdir(path)
     if options['fork']:
         cmdoptions['fork'] = True
-    if options['nofork'] or options['profile']:
+    if options['nofork'] or options['profile'] or options['profile_startup']:
         cmdoptions['nofork'] = True
     path = paths.find_root(os.getcwd())
     if path:
@@ -376,13 +481,26 @@ def _runcommand(ui, options, cmd, cmdfunc):
 class GarbageCollector(QObject):
     '''
     Disable automatic garbage collection and instead collect manually
-    every INTERVAL milliseconds.
+    when the event loop is idle.
 
     This is done to ensure that garbage collection only happens in the GUI
     thread, as otherwise Qt can crash.
+
+    The allocation counts are checked every INTERVAL milliseconds.  A
+    collection is postponed by RETRY milliseconds while events are pending
+    or a mouse button is held, unless the counts grew far beyond the
+    thresholds.  The duration of the last collection of each generation
+    is used as its expected pause: a generation expected to pause longer
+    than MAXPAUSE seconds is only collected after IDLEPERIOD milliseconds
+    without activity, or when it is overdue.
     '''
 
     INTERVAL = 5000
+    RETRY = 500
+    IDLEPERIOD = 2000
+    MAXPAUSE = 0.05
+    OVERDUE = 4        # collect regardless of activity above threshold * 4
+    RECENT = 20        # number of pauses kept per generation
 
     def __init__(self, parent, debug=False):
         QObject.__init__(self, parent)
@@ -393,24 +511,76 @@ class GarbageCollector(QObject):
 
         self.threshold = gc.get_threshold()
         gc.disable()
+        self.lastbusy = time.time()
+        self.expected = [0.0, 0.0, 0.0]
+        # per generation: [collections, total secs, max secs, unreachable,
+        #                  recent pauses]
+        self.pauses = [[0, 0.0, 0.0, 0, []] for i in xrange(3)]
+        self.postponed = 0
         self.timer.start(self.INTERVAL)
         #gc.set_debug(gc.DEBUG_SAVEALL)
 
+    def busy(self):
+        'Whether the user is interacting or events are waiting'
+        app = QApplication.instance()
+        if app is None:
+            return False
+        return (app.hasPendingEvents()
+                or QApplication.mouseButtons() != Qt.NoButton)
+
     def check(self):
-        l0, l1, l2 = gc.get_count()
-        if l0 > self.threshold[0]:
-            num = gc.collect(0)
-            if self.debug:
-                print 'GarbageCollector.check:', l0, l1, l2
-                print 'collected gen 0, found', num, 'unreachable'
-            if l1 > self.threshold[1]:
-                num = gc.collect(1)
-                if self.debug:
-                    print 'collected gen 1, found', num, 'unreachable'
-                if l2 > self.threshold[2]:
-                    num = gc.collect(2)
-                    if self.debug:
-                        print 'collected gen 2, found', num, 'unreachable'
+        counts = gc.get_count()
+        now = time.time()
+        busy = self.busy()
+        if busy:
+            self.lastbusy = now
+        idle = (now - self.lastbusy) * 1000 >= self.IDLEPERIOD
+        due = None
+        waiting = False
+        for gen in xrange(3):
+            if counts[gen] <= self.threshold[gen]:
+                continue
+            overdue = counts[gen] > self.threshold[gen] * self.OVERDUE
+            if busy and not overdue:
+                waiting = True
+                break
+            if (self.expected[gen] > self.MAXPAUSE and not idle
+                and not overdue):
+                waiting = True
+                break
+            due = gen
+        if due is not None:
+            self.collect(due, counts)
+        if waiting:
+            self.postponed += 1
+            self.timer.start(self.RETRY)
+        else:
+            self.timer.start(self.INTERVAL)
+
+    def collect(self, gen, counts=None):
+        'Collect generation gen and the younger ones, recording the pause'
+        start = time.time()
+        num = gc.collect(gen)
+        pause = time.time() - start
+        self.expected[gen] = pause
+        stat = self.pauses[gen]
+        stat[0] += 1
+        stat[1] += pause
+        stat[2] = max(stat[2], pause)
+        stat[3] += num
+        stat[4].append(pause)
+        del stat[4][:-self.RECENT]
+        if self.debug:
+            print 'GarbageCollector.check:', counts or gc.get_count()
+            print 'collected gen %d in %.1f ms, found %d unreachable' % (
+                gen, pause * 1000, num)
+        return num
+
+    def stats(self):
+        '''Pause statistics as [(gen, collections, total secs, max secs,
+        unreachable, recent pauses)]'''
+        return [tuple([gen] + s[:4] + [list(s[4])])
+                for gen, s in enumerate(self.pauses)]
 
     def debug_cycles(self):
         gc.collect()
@@ -440,12 +610,20 @@ class _QtRunner(QObject):
         error.LockUnavailable: _('Repository is locked'),
         }
 
+    # quit a lingering application server after this many msec without
+    # any window
+    SERVERIDLE = 30 * 60 * 1000
+
     def __init__(self):
         super(_QtRunner, self).__init__()
         gc.disable()
         self.debug = 'THGDEBUG' in os.environ
         self._mainapp = None
         self._dialogs = []
+        self._server = None
+        self._idletimer = None
+        self._gc = None
+        self.workbench = None
         self.errors = []
         sys.excepthook = lambda t, v, o: self.ehook(t, v, o)
 
@@ -502,6 +680,7 @@ class _QtRunner(QObject):
                                   hglib.tounicode(errstr), opts,
                                   parent=self._mainapp.activeWindow())
         elif etype is KeyboardInterrupt:
+            from tortoisehg.hgqt import qtlib
             if qtlib.QuestionMsgBox(hglib.tounicode(_('Keyboard interrupt')),
                     hglib.tounicode(_('Close this application?'))):
                 QApplication.quit()
@@ -518,6 +697,7 @@ class _QtRunner(QObject):
 
     def __call__(self, dlgfunc, ui, *args, **opts):
         portable_fork(ui, opts)
+        from tortoisehg.hgqt import qtlib, cmdserver, thgrepo
 
         if self._mainapp:
             self._opendialog(dlgfunc, ui, *args, **opts)
@@ -538,14 +718,20 @@ class _QtRunner(QObject):
             qtlib.fix_application_font()
             qtlib.configstyles(ui)
             qtlib.initfontcache(ui)
+            cmdserver.configure(ui)
+            thgrepo.configure(ui)
+            tracing.configure(ui)
             self._mainapp.setWindowIcon(qtlib.geticon('thg-logo'))
+            if ui.configbool('tortoisehg', 'appserver'):
+                self.startServer()
+                if self.serving() and not opts.get('nofork'):
+                    self._lingerAfterLastWindow()
 
             if 'repository' in opts:
                 try:
                     # Ensure we can open the repository before opening any
                     # dialog windows.  Since thgrepo instances are cached, this
                     # is not wasted.
-                    from tortoisehg.hgqt import thgrepo
                     thgrepo.repository(ui, opts['repository'])
                 except error.RepoError, e:
                     qtlib.WarningMsgBox(hglib.tounicode(_('Repository Error')),
@@ -555,6 +741,8 @@ class _QtRunner(QObject):
             if dlg:
                 dlg.show()
                 dlg.raise_()
+            if dlg and startupprof.enabled():
+                dlg.installEventFilter(self)
         except:
             # Exception before starting eventloop needs to be postponed;
             # otherwise it will be ignored silently.
@@ -568,11 +756,153 @@ class _QtRunner(QObject):
         try:
             return self._mainapp.exec_()
         finally:
+            if self._server:
+                self._server.close()
+                self._server = None
             self._mainapp = None
 
+    def eventFilter(self, watched, event):
+        if event.type() == QEvent.Paint:
+            # report once the first paint event of the first window has
+            # been handled
+            watched.removeEventFilter(self)
+            QTimer.singleShot(0, self._reportstartup)
+        return False
+
+    @pyqtSlot()
+    def _reportstartup(self):
+        startupprof.windowshown()
+        startupprof.report()
+
+    def running(self):
+        """True if the Qt application is running in this process"""
+        return self._mainapp is not None
+
+    def gcstats(self):
+        """Pause statistics of the garbage collector, see GarbageCollector"""
+        if self._gc is None:
+            return []
+        return self._gc.stats()
+
+    def serving(self):
+        return self._server is not None
+
+    def startServer(self, workbench=None):
+        """Listen for requests from other thg processes
+
+        workbench is the Workbench which opens repositories requested by
+        workbench.connectToExistingWorkbench().
+        """
+        if workbench:
+            self.workbench = workbench
+            workbench.destroyed.connect(self._forgetworkbench)
+        if self._server:
+            return
+        server = QLocalServer(self)
+        if not server.listen(servername()):
+            return
+        server.newConnection.connect(self._newconnection)
+        self._server = server
+        # dialogs opened on request must not fork again
+        os.environ['THG_GUI_SPAWN'] = '1'
+
+    def stopServer(self, workbench):
+        """Detach workbench from the server; the server itself is closed
+        unless it is kept warm for other thg processes"""
+        if self.workbench is workbench:
+            self.workbench = None
+        if self._server and not self._idletimer:
+            self._server.close()
+            self._server = None
+
+    @pyqtSlot()
+    def _forgetworkbench(self):
+        self.workbench = None
+
+    def _lingerAfterLastWindow(self):
+        """Keep the application server warm for a while after the last
+        window is closed"""
+        self._mainapp.setQuitOnLastWindowClosed(False)
+        self._idletimer = QTimer(self, singleShot=True,
+                                 interval=self.SERVERIDLE)
+        self._idletimer.timeout.connect(self._quitIfIdle)
+        self._mainapp.lastWindowClosed.connect(self._idletimer.start)
+
+    @pyqtSlot()
+    def _quitIfIdle(self):
+        if not [w for w in self._mainapp.topLevelWidgets() if w.isVisible()]:
+            self._mainapp.quit()
+
+    @pyqtSlot()
+    def _newconnection(self):
+        sock = self._server.nextPendingConnection()
+        if not sock:
+            return
+        sock.disconnected.connect(sock.deleteLater)
+        sock.waitForReadyRead(10000)
+        data = str(sock.readAll())
+        if not data.startswith(_SERVERMAGIC):
+            self._legacyrequest(data)
+            sock.write(QByteArray(data))
+            sock.flush()
+            return
+
+        hdrlen = len(_SERVERMAGIC) + 4
+        while len(data) < hdrlen and sock.waitForReadyRead(10000):
+            data += str(sock.readAll())
+        size = struct.unpack('>I', data[len(_SERVERMAGIC):hdrlen])[0]
+        while len(data) < hdrlen + size and sock.waitForReadyRead(10000):
+            data += str(sock.readAll())
+        if len(data) < hdrlen + size:
+            sock.abort()
+            return
+        req = data[hdrlen:hdrlen + size].split('\0')
+        try:
+            cwd, nargs = req[0], int(req[1])
+            args = req[2:2 + nargs]
+            env = dict(e.split('=', 1) for e in req[2 + nargs:])
+        except (IndexError, ValueError):
+            sock.abort()
+            return
+        if env != _clientenv(os.environ):
+            # commands run here use the server's HGUSER, HGRCPATH, etc.,
+            # so let the client run it by itself
+            sock.write(QByteArray(_SERVERNAK))
+            sock.flush()
+            return
+        sock.write(QByteArray(_SERVERACK))
+        sock.flush()
+        # run after replying, so the client need not wait for the dialog
+        QTimer.singleShot(0, lambda: self._runrequest(cwd, args))
+
+    def _legacyrequest(self, root):
+        if not root or root == '[echo]':
+            return
+        if self.workbench:
+            self.workbench.showRepoFromServer(root)
+        else:
+            self._runrequest(root, ['log'])
+
+    def _runrequest(self, cwd, args):
+        global _lines, _linesutf8
+        # files from the --listfile of an earlier request must not leak
+        _lines = []
+        _linesutf8 = []
+        if self._idletimer:
+            self._idletimer.stop()
+        savedcwd = os.getcwd()
+        try:
+            os.chdir(cwd)
+            _runcatch(uimod.ui(), args)
+        except SystemExit:
+            pass
+        finally:
+            os.chdir(savedcwd)
+
     def _installtranslator(self):
         if not i18n.language:
             return
+        from tortoisehg.hgqt import qtlib
         t = QTranslator(self._mainapp)
         t.load('qt_' + i18n.language, qtlib.gettranslationpath())
         self._mainapp.installTranslator(t)
@@ -1047,6 +1377,8 @@ globalopts = [
     ('h', 'help', None, _('display help and exit')),
     ('', 'debugger', None, _('start debugger')),
     ('', 'profile', None, _('print command execution profile')),
+    ('', 'profile-startup', None,
+     _('print module import times and time to first window')),
     ('', 'nofork', None, _('do not fork GUI process')),
     ('', 'fork', None, _('always fork GUI process')),
     ('', 'listfile', '', _('read file list from file')),
@@ -583,6 +583,11 @@ INFO = (
     _fi(_('Fork GUI'), 'tortoisehg.guifork', genBoolRBGroup,
         _('When running from the command line, fork a background '
           'process to run graphical dialogs.  Default: True')),
+    _fi(_('Application Server'), 'tortoisehg.appserver', genBoolRBGroup,
+        _('Keep a TortoiseHg process running in the background and let it '
+          'open the dialogs of later thg commands, which then start '
+          'without loading Qt and Mercurial again.  The server exits '
+          '30 minutes after its last window is closed.  Default: False')),
     _fi(_('Full Path Title'), 'tortoisehg.fullpath', genBoolRBGroup,
         _('Show a full directory path of the repository in the dialog title '
           'instead of just the root directory name.  Default: False')),
@@ -594,6 +599,12 @@ INFO = (
           'even if the edits are to different parts of the file. In either '
           'case, when conflicts occur, the user will be invited to review and '
           'resolve changes manually. Default: False.')),
+    _fi(_('Command Server'), 'tortoisehg.cmdserver', genBoolRBGroup,
+        _('Run Mercurial commands through persistent command server '
+          'processes, one per repository, instead of starting a new '
+          'command for each operation.  Servers are restarted when the '
+          'configuration changes.  Commands which talk to remote '
+          'repositories are still run separately.  Default: False')),
     )),
 
 ({'name': 'log', 'label': _('Workbench'), 'icon': 'menulog'}, (
@@ -643,6 +654,16 @@ INFO = (
         _('The number of revisions to read and display in the '
           'changelog viewer in a single batch. '
           'Default: 500')),
+    _fi(_('Repository Cache Size'), 'tortoisehg.repocachesize',
+        genIntEditCombo,
+        _('The number of repositories kept open in memory.  Repositories '
+          'which are not open in a tab are closed, least recently used '
+          'first, when more are cached.  Default: 20')),
+    _fi(_('Record Timings'), 'tortoisehg.tracing', genBoolRBGroup,
+        _('Record the duration of graph building, model fetches, status '
+          'walks, repository invalidation, file display and commands, to '
+          'be shown by View/Show Timings in the Workbench.  Also enabled '
+          'by the THGTRACE environment variable.  Default: False')),
     _fi(_('Dead Branches'), 'tortoisehg.deadbranch', genEditCombo,
         _('Comma separated list of branch names that should be ignored '
           'when building a list of branch names for a repository. '
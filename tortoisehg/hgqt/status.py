@@ -9,7 +9,7 @@ import os
 
 from mercurial import hg, util, error, context, merge, scmutil
 
-from tortoisehg.util import paths, hglib
+from tortoisehg.util import paths, hglib, tracing
 from tortoisehg.hgqt.i18n import _
 from tortoisehg.hgqt import qtlib, wctxactions, visdiff, cmdui, fileview, thgrepo
 
@@ -428,6 +428,7 @@ class StatusThread(QThread):
         self.wctx = None
         self.patchecked = {}
 
+    @tracing.traced('status.walk')
     def run(self):
         self.repo.dirstate.invalidate()
         extract = lambda x, y: dict(zip(x, map(y.get, x)))
@@ -9,15 +9,17 @@
 import os
 import re
 import tempfile
+import time
 import urlparse
 
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
 from mercurial import hg, ui, url, util, error, demandimport, scmutil, httpconnection
+from mercurial import node
 from mercurial import merge as mergemod
 
-from tortoisehg.util import hglib, wconfig, paths
+from tortoisehg.util import hglib, wconfig, paths, discoverycache
 from tortoisehg.hgqt.i18n import _
 from tortoisehg.hgqt import qtlib, cmdui, thgrepo, rebase, resolve, hgrcutil
 
@@ -96,6 +98,8 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
 
         self.repo = repo
         self.finishfunc = None
+        self.multisync = None
+        discoverycache.setup()
         self.curuser = None
         self.default_user = None
         self.lastsshuser = None
@@ -154,6 +158,8 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
              'hg-push', lambda: self.pushclicked(True))
         newaction(_('Email outgoing changesets for remote repository'),
              'mail-forward', self.emailclicked)
+        newaction(_('Pull from or push to several remote repositories'),
+             'thg-sync', self.multisyncclicked)
 
         if 'perfarce' in self.repo.extensions():
             a = QAction(self)
@@ -618,7 +624,7 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
         self.setUrl(lurl)
 
     def canExit(self):
-        return not self.cmd.core.running()
+        return not self.cmd.core.running() and not self.multisyncRunning()
 
     @pyqtSlot(QPoint, QString, QString, bool)
     def menuRequest(self, point, url, alias, editable):
@@ -689,7 +695,7 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
         QApplication.clipboard().setText(self.menuurl)
 
     def closeEvent(self, event):
-        if self.cmd.core.running():
+        if self.cmd.core.running() or self.multisyncRunning():
             if not qtlib.QuestionMsgBox(_('TortoiseHg Sync'),
                 _('Are you sure that you want to cancel synchronization?'),
                 parent=self):
@@ -699,8 +705,8 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
         if event.matches(QKeySequence.Refresh):
             self.reload()
         elif event.key() == Qt.Key_Escape:
-            if self.cmd.core.running():
-                self.cmd.cancel()
+            if self.cmd.core.running() or self.multisyncRunning():
+                self.stopclicked()
             elif not self.embedded:
                 self.close()
         else:
@@ -709,6 +715,8 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
     def stopclicked(self):
         if self.cmd.core.running():
             self.cmd.cancel()
+        if self.multisyncRunning():
+            self.multisync.cancel()
 
     def saveclicked(self):
         if self.curalias:
@@ -753,19 +761,10 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
             self.finishfunc(ret, output)
 
     def run(self, cmdline, details):
-        if self.cmd.core.running():
+        if self.cmd.core.running() or self.multisyncRunning():
             return
         self.lastcmdline = list(cmdline)
-        for name in list(details) + ['remotecmd']:
-            val = self.opts.get(name)
-            if not val:
-                continue
-            if isinstance(val, bool):
-                if val:
-                    cmdline.append('--' + name)
-            elif val:
-                cmdline.append('--' + name)
-                cmdline.append(val)
+        self.appendOptions(cmdline, details)
 
         if 'rev' in details and '--rev' not in cmdline:
             if self.embedded and self.targetcheckbox.isChecked():
@@ -830,6 +829,27 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
         self.repo.incrementBusyCount()
         self.cmd.run(cmdline, display=display, useproc='p4://' in cururl)
 
+    def takeOutgoingNodes(self, data, verify):
+        '''Hex nodes found by the outgoing command just finished, from the
+        discovery cache if it ran in this process, else from its output'''
+        nodes = discoverycache.takeoutgoing(self.repo.root)
+        if nodes is not None:
+            return [node.hex(n) for n in nodes]
+        return [n for n in data.splitlines() if verify(n)]
+
+    def appendOptions(self, cmdline, details):
+        'Append the selected options named in details to cmdline'
+        for name in list(details) + ['remotecmd']:
+            val = self.opts.get(name)
+            if not val:
+                continue
+            if isinstance(val, bool):
+                if val:
+                    cmdline.append('--' + name)
+            elif val:
+                cmdline.append('--' + name)
+                cmdline.append(val)
+
     def outputHook(self, msg, label):
         if '\'hg push --new-branch\'' in msg:
             self.needNewBranch = True
@@ -978,7 +998,7 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
                 return not bad
             def outputnodes(ret, data):
                 if ret == 0:
-                    nodes = [n for n in data.splitlines() if verifyhash(n)]
+                    nodes = self.takeOutgoingNodes(data, verifyhash)
                     if nodes:
                         self.outgoingNodes.emit(nodes)
                     self.showMessage.emit(_('%d outgoing changesets to %s') %
@@ -988,6 +1008,7 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
                 else:
                     self.showMessage.emit(_('Outgoing to %s aborted, ret %d') % (link, ret))
             self.finishfunc = outputnodes
+            discoverycache.takeoutgoing(self.repo.root)
             cmdline = ['--repository', self.repo.root, 'outgoing', '--quiet',
                        '--template', '{node}\n']
             self.run(cmdline, ('force', 'branch', 'rev'))
@@ -1121,6 +1142,113 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
         self.needNewBranch = False
         self.run(cmdline, validopts)
 
+    def multisyncclicked(self):
+        if self.cmd.core.running() or self.multisyncRunning():
+            self.showMessage.emit(_('sync command already running'))
+            return
+        targets = self.hgrctv.model().rows + self.reltv.model().rows
+        targets = [(hglib.fromunicode(r[0]), r[2]) for r in targets]
+        if not targets:
+            self.showMessage.emit(_('No remote repository paths configured'))
+            return
+        dlg = MultiSyncDialog(targets, self)
+        dlg.setWindowFlags(Qt.Sheet)
+        dlg.setWindowModality(Qt.WindowModal)
+        if dlg.exec_() == QDialog.Accepted:
+            self.runMultiSync(dlg.command(), dlg.selectedTargets())
+
+    def multisyncRunning(self):
+        return bool(self.multisync and self.multisync.running())
+
+    def runMultiSync(self, command, targets):
+        '''Pull from or push to all (alias, url) targets, a few at a time
+
+        Post-pull operations, the target revision and mq options are not
+        applied, since they do not make sense for several remotes at once.
+        Each command runs in its own hg process, as in-process dispatch is
+        not thread-safe.
+        '''
+        if command == 'push':
+            details = ('force', 'new-branch', 'branch')
+        else:
+            details = ('force', 'branch')
+        jobs = []
+        for alias, remoteurl in targets:
+            cmdline = ['--repository', self.repo.root, command]
+            self.appendOptions(cmdline, details)
+            if self.opts.get('noproxy'):
+                cmdline += ['--config', 'http_proxy.host=']
+            if self.opts.get('debug'):
+                cmdline.append('--debug')
+            if remoteurl.startswith('https://'):
+                host = parseurl(remoteurl)[1]
+                if self.repo.ui.configbool('insecurehosts', host):
+                    cmdline.append('--insecure')
+            display = ' '.join(cmdline + [util.hidepassword(remoteurl)])
+            jobs.append((alias, cmdline + [remoteurl], display))
+
+        runner = MultiSyncRunner(self)
+        runner.output.connect(self.multisyncOutput)
+        runner.progress.connect(self.progress)
+        runner.makeLogVisible.connect(self.makeLogVisible)
+        runner.finished.connect(lambda: self.multisyncFinished(command))
+        self.multisync = runner
+
+        self.syncStarted.emit()
+        self.beginSuppressPrompt.emit()
+        self.commandStarted()
+        self.repo.incrementBusyCount()
+        if command == 'push':
+            msg = _('Pushing to %d remote repositories...')
+        else:
+            msg = _('Pulling from %d remote repositories...')
+        self.showMessage.emit(msg % len(jobs))
+        runner.run(jobs)
+
+    def multisyncOutput(self, msg, label):
+        if self.embedded:
+            self.output.emit(msg, label)
+        else:
+            # through the log of the standalone dialog
+            self.cmd.core.output.emit(msg, label)
+
+    def multisyncFinished(self, command):
+        runner = self.multisync
+        self.endSuppressPrompt.emit()
+        self.hideBusyIcon.emit('thg-sync')
+        self.repo.decrementBusyCount()
+        for b in self.opbuttons:
+            b.setEnabled(True)
+        self.stopAction.setEnabled(False)
+
+        results = runner.results()
+        self.multisyncOutput(_('%d remote repositories, %.1f seconds in total\n')
+                         % (len(results), runner.elapsed()), 'control')
+        failed = 0
+        for alias, ret, elapsed in results:
+            if ret in (0, 1):
+                status = _('ok')
+            elif ret is None:
+                status = _('canceled')
+                failed += 1
+            else:
+                status = _('failed, ret %s') % ret
+                failed += 1
+            self.multisyncOutput('  %s: %s, %.1f s\n'
+                             % (hglib.tounicode(alias), status, elapsed),
+                             'control')
+        if command == 'push':
+            msg = _('Push to %d remote repositories completed, %d failed')
+        else:
+            msg = _('Pull from %d remote repositories completed, %d failed')
+        self.showMessage.emit(msg % (len(results), failed))
+        if failed:
+            self.makeLogVisible.emit(True)
+        if command == 'push':
+            self.pushCompleted.emit()
+        else:
+            self.pullCompleted.emit()
+
     def postpullclicked(self):
         dlg = PostPullDialog(self.repo, self)
         dlg.setWindowFlags(Qt.Sheet)
@@ -1131,7 +1259,7 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
         self.showMessage.emit(_('Determining outgoing changesets to email...'))
         def outputnodes(ret, data):
             if ret == 0:
-                nodes = [n for n in data.splitlines() if len(n) == 40]
+                nodes = self.takeOutgoingNodes(data, lambda n: len(n) == 40)
                 self.showMessage.emit(_('%d outgoing changesets') %
                                         len(nodes))
                 try:
@@ -1146,6 +1274,7 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
             else:
                 self.showMessage.emit(_('Outgoing aborted, ret %d') % ret)
         self.finishfunc = outputnodes
+        discoverycache.takeoutgoing(self.repo.root)
         cmdline = ['--repository', self.repo.root, 'outgoing', '--quiet',
                     '--template', '{node}\n']
         self.run(cmdline, ('force', 'branch', 'rev'))
@@ -1187,6 +1316,170 @@ class SyncWidget(QWidget, qtlib.TaskWidget):
         self.repo.decrementBusyCount()
 
 
+class MultiSyncRunner(QObject):
+    """Run one command per remote repository, at most maxworkers at once
+
+    Every output line is prefixed by the alias of its remote, and progress
+    topics are qualified by it, so the commands can share the log dock.
+    """
+
+    MAXWORKERS = 4
+
+    output = pyqtSignal(QString, QString)
+    progress = pyqtSignal(QString, object, QString, QString, object)
+    makeLogVisible = pyqtSignal(bool)
+    finished = pyqtSignal()
+
+    def __init__(self, parent, maxworkers=None):
+        super(MultiSyncRunner, self).__init__(parent)
+        self.maxworkers = maxworkers or self.MAXWORKERS
+        self._pending = []
+        self._active = {}   # {job index: (runner, start time)}
+        self._results = []  # [(alias, ret, elapsed)]
+        self._canceled = False
+        self._start = None
+
+    def run(self, jobs):
+        'Start the (alias, cmdline, display) jobs'
+        self._pending = list(enumerate(jobs))
+        self._start = time.time()
+        self._startNext()
+
+    def running(self):
+        return bool(self._pending or self._active)
+
+    def cancel(self):
+        self._canceled = True
+        for i, (alias, cmdline, display) in self._pending:
+            self._results.append((alias, None, 0.0))
+        self._pending = []
+        if not self._active:
+            self.finished.emit()
+        for runner, start in self._active.values():
+            runner.cancel()
+
+    def results(self):
+        return list(self._results)
+
+    def elapsed(self):
+        return time.time() - self._start
+
+    def _startNext(self):
+        while self._pending and len(self._active) < self.maxworkers:
+            i, (alias, cmdline, display) = self._pending.pop(0)
+            # prompts of the command need a widget as parent
+            runner = cmdui.Runner(False, self.parent())
+            runner.output.connect(self._outputfunc(alias))
+            runner.progress.connect(self._progressfunc(alias))
+            runner.commandFinished.connect(self._finishedfunc(i, alias))
+            self._active[i] = (runner, time.time())
+            runner.run(cmdline, display=display, useproc=True)
+
+    def _outputfunc(self, alias):
+        prefix = hglib.tounicode(alias) + ': '
+        state = {'newline': True}
+        def output(msg, label):
+            msg = unicode(msg)
+            if not msg:
+                return
+            lines = msg.split('\n')
+            if state['newline']:
+                text = prefix + lines[0]
+            else:
+                text = lines[0]
+            for line in lines[1:-1]:
+                text += '\n' + prefix + line
+            if len(lines) > 1:
+                text += '\n'
+                if lines[-1]:
+                    text += prefix + lines[-1]
+            state['newline'] = msg.endswith('\n')
+            self.output.emit(text, label)
+        return output
+
+    def _progressfunc(self, alias):
+        ualias = hglib.tounicode(alias)
+        def progress(topic, pos, item, unit, total):
+            self.progress.emit(u'%s: %s' % (ualias, topic), pos, item, unit,
+                               total)
+        return progress
+
+    def _finishedfunc(self, i, alias):
+        def finished(ret):
+            runner, start = self._active.pop(i)
+            self._results.append((alias, ret, time.time() - start))
+            if ret not in (0, 1):
+                self.makeLogVisible.emit(True)
+            runner.core.deleteLater()
+            runner.deleteLater()
+            if not self._canceled:
+                self._startNext()
+            if not self.running():
+                self.finished.emit()
+        return finished
+
+class MultiSyncDialog(QDialog):
+    'Select the command and the remote repositories of a multi-target sync'
+
+    def __init__(self, targets, parent):
+        super(MultiSyncDialog, self).__init__(parent)
+        self.setWindowTitle(_('%s - sync with several remotes')
+                            % parent.repo.displayname)
+        self.setWindowFlags(self.windowFlags() &
+                            ~Qt.WindowContextHelpButtonHint)
+        self.targets = targets
+        layout = QVBoxLayout()
+        self.setLayout(layout)
+
+        self.pullradio = QRadioButton(_('Pull from the selected remotes'))
+        self.pushradio = QRadioButton(_('Push to the selected remotes'))
+        self.pullradio.setChecked(True)
+        layout.addWidget(self.pullradio)
+        layout.addWidget(self.pushradio)
+
+        self.targetlist = QListWidget()
+        for alias, remoteurl in targets:
+            safeurl = util.hidepassword(remoteurl)
+            item = QListWidgetItem(u'%s\t%s' % (hglib.tounicode(alias),
+                                                 hglib.tounicode(safeurl)))
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            if alias in ('default', 'default-push'):
+                item.setCheckState(Qt.Checked)
+            else:
+                item.setCheckState(Qt.Unchecked)
+            self.targetlist.addItem(item)
+        self.targetlist.itemChanged.connect(self.refreshButtons)
+        layout.addWidget(self.targetlist)
+
+        lbl = QLabel(_('Post-pull operations are not run, and up to %d '
+                       'remotes are contacted at once.')
+                     % MultiSyncRunner.MAXWORKERS)
+        lbl.setWordWrap(True)
+        layout.addWidget(lbl)
+
+        BB = QDialogButtonBox
+        self.bb = bb = QDialogButtonBox(BB.Ok|BB.Cancel)
+        bb.accepted.connect(self.accept)
+        bb.rejected.connect(self.reject)
+        layout.addWidget(bb)
+        self.refreshButtons()
+
+    def refreshButtons(self):
+        ok = self.bb.button(QDialogButtonBox.Ok)
+        ok.setEnabled(bool(self.selectedTargets()))
+
+    def command(self):
+        if self.pushradio.isChecked():
+            return 'push'
+        return 'pull'
+
+    def selectedTargets(self):
+        targets = []
+        for i, target in enumerate(self.targets):
+            if self.targetlist.item(i).checkState() == Qt.Checked:
+                targets.append(target)
+        return targets
+
 class PostPullDialog(QDialog):
     def __init__(self, repo, parent):
         super(PostPullDialog, self).__init__(parent)
@@ -13,6 +13,7 @@ import sys
 import shutil
 import tempfile
 import re
+import weakref
 
 from PyQt4.QtCore import *
 
@@ -21,10 +22,9 @@ from mercurial import merge, subrepo
 from mercurial import ui as uimod
 from mercurial.util import propertycache
 
-from tortoisehg.util import hglib, paths
+from tortoisehg.util import hglib, paths, tracing
 from tortoisehg.util.patchctx import patchctx
 
-_repocache = {}
 _kbfregex = re.compile(r'^\.kbf/')
 _lfregex = re.compile(r'^\.hglf/')
 
@@ -35,6 +35,135 @@ else:
     def dbgoutput(*args):
         pass
 
+def estimatememory(repo):
+    '''Rough estimate of the memory used by data already loaded into repo
+
+    Only caches which are already populated are counted; nothing is read
+    from disk.  The per-entry sizes are approximations of the Python
+    objects kept by Mercurial's revlog, manifest and dirstate caches.
+    '''
+    size = 0
+    d = repo.__dict__
+    for name in ('changelog', 'manifest'):
+        rl = d.get(name)
+        if rl is None:
+            continue
+        # index entries plus nodemap
+        size += len(rl.index) * 160
+        cache = getattr(rl, '_cache', None)
+        if cache:
+            size += len(cache[2])
+        mapcache = getattr(rl, 'mapcache', None)
+        if mapcache:
+            size += len(mapcache[1]) * 200
+    ds = d.get('dirstate')
+    if ds is not None and '_map' in ds.__dict__:
+        size += len(ds._map) * 250
+    return size
+
+class _RepoCache(object):
+    '''Opened repositories keyed by path, with LRU eviction
+
+    Repositories referenced by a RepoWidget (see incrementRefCount) or
+    busy with a transaction are never evicted.  The others are dropped,
+    least recently used first, while the cache holds more than maxrepos
+    repositories or more than maxmemory bytes by estimatememory().
+
+    Dialogs keep repositories without counting references, so evicted
+    repositories are only weakly referenced, not detached, and are put
+    back into the cache if still alive when their path is looked up
+    again.  Thus no second instance of a repository is opened while one
+    is in use.
+    '''
+
+    def __init__(self, maxrepos=20, maxmemory=512 * 1024 * 1024):
+        self.maxrepos = maxrepos
+        self.maxmemory = maxmemory
+        self._repos = {}
+        self._lastused = {}
+        self._clock = 0
+        self._evicted = weakref.WeakValueDictionary()
+
+    def __contains__(self, path):
+        if path in self._repos:
+            return True
+        repo = self._evicted.pop(path, None)
+        if repo is None:
+            return False
+        dbgoutput('revive evicted repository:', path)
+        self[path] = repo
+        return True
+
+    def __getitem__(self, path):
+        repo = self._repos[path]
+        self._touch(path)
+        return repo
+
+    def __setitem__(self, path, repo):
+        self._repos[path] = repo
+        self._touch(path)
+        self.shrink(keep=path)
+
+    def __delitem__(self, path):
+        del self._repos[path]
+        del self._lastused[path]
+
+    def __len__(self):
+        return len(self._repos)
+
+    def _touch(self, path):
+        self._clock += 1
+        self._lastused[path] = self._clock
+
+    def _evictable(self, keep):
+        'Unreferenced repositories, least recently used first'
+        paths = [p for p, repo in self._repos.iteritems()
+                 if p != keep and not repo._pyqtobj.refcount
+                 and not repo._pyqtobj.busycount]
+        return sorted(paths, key=self._lastused.__getitem__)
+
+    def shrink(self, keep=None):
+        'Evict unreferenced repositories until the cache is within bounds'
+        candidates = self._evictable(keep)
+        if not candidates:
+            return
+        total = sum(estimatememory(r) for r in self._repos.itervalues())
+        for path in candidates:
+            if len(self._repos) <= self.maxrepos and total <= self.maxmemory:
+                break
+            repo = self._repos[path]
+            total -= estimatememory(repo)
+            dbgoutput('evict repository from cache:', path)
+            del self[path]
+            self._evicted[path] = repo
+
+    def stats(self):
+        '''List of (path, estimated bytes, refcount, busycount), most
+        recently used first'''
+        result = []
+        for path in sorted(self._repos, key=self._lastused.__getitem__,
+                           reverse=True):
+            repo = self._repos[path]
+            result.append((path, estimatememory(repo),
+                           repo._pyqtobj.refcount, repo._pyqtobj.busycount))
+        return result
+
+_repocache = _RepoCache()
+
+def configure(ui):
+    'Set the bounds of the repository cache from user configuration'
+    try:
+        maxrepos = int(ui.config('tortoisehg', 'repocachesize', 20))
+    except ValueError:
+        maxrepos = 20
+    _repocache.maxrepos = max(maxrepos, 1)
+    _repocache.shrink()
+
+def cachedrepos():
+    '''List of (path, estimated bytes, refcount, busycount) of cached
+    repositories, most recently used first'''
+    return _repocache.stats()
+
 def repository(_ui=None, path='', create=False, bundle=None):
     '''Returns a subclassed Mercurial repository to which new
     THG-specific methods have been added. The repository object
@@ -78,6 +207,7 @@ class ThgRepoWrapper(QObject):
         QObject.__init__(self)
         self.repo = repo
         self.busycount = 0
+        self.refcount = 0
         repo.configChanged = self.configChanged
         repo.repositoryChanged = self.repositoryChanged
         repo.repositoryDestroyed = self.repositoryDestroyed
@@ -269,6 +399,53 @@ class ThgRepoWrapper(QObject):
         except (EnvironmentError, ValueError):
             pass
 
+def _longest(names):
+    longest = ''
+    for name in names:
+        if len(name) > len(longest):
+            longest = name
+    return longest
+
+class NameStats(object):
+    """Longest tag, branch and author names of a repository
+
+    Used for column width hints.  Tag and branch names are only scanned
+    again after the repository reloaded its tags or branch caches, or
+    grew; author names are recorded by the models as they format rows.
+    The object survives thginvalidate().
+    """
+
+    def __init__(self, repo):
+        self._repo = repo
+        self._tags = (None, None, '')      # (cache object, len(repo), name)
+        self._branches = (None, None, '')
+        self.longestauthor = ''
+
+    def _cached(self, attr, getnames, getcacheobj):
+        '''Longest of getnames(), which is only called if the cache object
+        of the names changed or the repository grew'''
+        ref, size, longest = getattr(self, attr)
+        cacheobj = getcacheobj()
+        if cacheobj is None or cacheobj is not ref or size != len(self._repo):
+            names = getnames()
+            # getnames() may have loaded or replaced the cache
+            cacheobj = getcacheobj()
+            longest = _longest(names)
+            setattr(self, attr, (cacheobj, len(self._repo), longest))
+        return longest
+
+    def longesttag(self):
+        return self._cached('_tags', self._repo.tags,
+                            lambda: self._repo.__dict__.get('_tagscache'))
+
+    def longestbranch(self):
+        return self._cached('_branches', self._repo.branchtags,
+                            lambda: getattr(self._repo, '_branchcache', None))
+
+    def addauthor(self, author):
+        if len(author) > len(self.longestauthor):
+            self.longestauthor = author
+
 _uiprops = '''_uifiles _uimtime postpull tabwidth maxdiff
               deadbranches _exts _thghiddentags displayname summarylen
               shortname mergetools namedbranches'''.split()
@@ -323,6 +500,11 @@ def _extendrepo(repo):
 
             return [pname for pname in q.series if not pname in applied]
 
+        @propertycache
+        def thgnamestats(self):
+            'NameStats of this repository, kept across invalidation'
+            return NameStats(self)
+
         @propertycache
         def _thgmqpatchnames(self):
             '''Returns all tag names used by MQ patches. Returns []
@@ -508,6 +690,7 @@ def _extendrepo(repo):
             f = open(os.path.join(self.shelfdir, patch), "wb")
             f.close()
 
+        @tracing.traced('repo.invalidate')
         def thginvalidate(self):
             'Should be called when mtime of repo store/dirstate are changed'
             self.dirstate.invalidate()
@@ -533,6 +716,16 @@ def _extendrepo(repo):
             'A GUI widget is starting a transaction'
             self._pyqtobj.busycount += 1
 
+        def incrementRefCount(self):
+            'A RepoWidget has opened this repository'
+            self._pyqtobj.refcount += 1
+
+        def decrementRefCount(self):
+            'A RepoWidget using this repository has been closed'
+            self._pyqtobj.refcount -= 1
+            if self._pyqtobj.refcount == 0:
+                _repocache.shrink()
+
         def decrementBusyCount(self):
             'A GUI widget has finished a transaction'
             self._pyqtobj.busycount -= 1
@@ -694,21 +887,9 @@ def _createchangectxcls(parentcls):
 
     return thgchangectx
 
-_pctxcache = {}
 def genPatchContext(repo, patchpath, rev=None):
-    global _pctxcache
-    try:
-        if os.path.exists(patchpath) and patchpath in _pctxcache:
-            cachedctx = _pctxcache[patchpath]
-            if cachedctx._mtime == os.path.getmtime(patchpath) and \
-               cachedctx._fsize == os.path.getsize(patchpath):
-                return cachedctx
-    except EnvironmentError:
-        pass
-    # create a new context object
-    ctx = patchctx(patchpath, repo, rev=rev)
-    _pctxcache[patchpath] = ctx
-    return ctx
+    # cheap: parsed patches are cached by patchctx while unchanged on disk
+    return patchctx(patchpath, repo, rev=rev)
 
 def recursiveMergeStatus(repo):
     ms = merge.mergestate(repo)
@@ -726,18 +907,9 @@ def recursiveMergeStatus(repo):
 
 def relatedRepositories(repoid):
     'Yields root paths for local related repositories'
-    from tortoisehg.hgqt import reporegistry, repotreemodel
-    f = QFile(reporegistry.settingsfilename())
-    f.open(QIODevice.ReadOnly)
-    try:
-        for e in repotreemodel.iterRepoItemFromXml(f):
-            if e.basenode() == repoid:
-                yield e.rootpath(), e.shortname()
-    except:
-        f.close()
-        raise
-    else:
-        f.close()
+    from tortoisehg.hgqt import reporegistry
+    for root, shortname in reporegistry.registryindex().related(repoid):
+        yield root, shortname
 
 def isBfStandin(path):
     return _kbfregex.match(path)
@@ -129,6 +129,38 @@ class QtUi(uimod.ui):
         return self.sig.progress(topic, pos, item, unit, total)
 
 
+def askuser(parent, prompt, password, choices, default):
+    """Ask the user for a response to a Mercurial prompt; returns the
+    chosen index or entered text, or None if the prompt was cancelled"""
+    prompt = hglib.tounicode(prompt)
+    if choices:
+        dlg = QMessageBox(QMessageBox.Question,
+                    _('TortoiseHg Prompt'), prompt, parent=parent)
+        dlg.setWindowFlags(Qt.Sheet)
+        dlg.setWindowModality(Qt.WindowModal)
+        for index, choice in enumerate(choices):
+            button = dlg.addButton(hglib.tounicode(choice),
+                                   QMessageBox.ActionRole)
+            button.response = index
+            if index == default:
+                dlg.setDefaultButton(button)
+        dlg.exec_()
+        button = dlg.clickedButton()
+        if button is 0:
+            return None
+        return button.response
+    else:
+        mode = password and QLineEdit.Password \
+                         or QLineEdit.Normal
+        text, ok = qtlib.getTextInput(parent,
+                     _('TortoiseHg Prompt'),
+                     prompt.title(),
+                     mode=mode)
+        if ok:
+            return hglib.fromunicode(text)
+        return None
+
+
 class CmdThread(QThread):
     """Run an Mercurial command in a background thread, implies output
     is being sent to a rendered text buffer interactively and requests
@@ -147,6 +179,11 @@ class CmdThread(QThread):
     #          others - return code of command
     commandFinished = pyqtSignal(int)
 
+    # pending output is emitted every FLUSHINTERVAL msec, or as soon as
+    # it grows beyond FLUSHSIZE characters
+    FLUSHINTERVAL = 100
+    FLUSHSIZE = 64 * 1024
+
     def __init__(self, cmdline, display, parent=None):
         super(CmdThread, self).__init__(parent)
 
@@ -155,13 +192,13 @@ class CmdThread(QThread):
         self.ret = -1
         self.abortbyuser = False
         self.responseq = Queue.Queue()
-        self.rawoutput = QStringList()
         self.topics = {}
         self.curstrs = QStringList()
         self.curlabel = None
+        self.curlen = 0
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.flush)
-        self.timer.start(100)
+        self.timer.start(self.FLUSHINTERVAL)
         self.finished.connect(self.thread_finished)
 
     def abort(self):
@@ -178,9 +215,7 @@ class CmdThread(QThread):
         self.commandFinished.emit(self.ret)
 
     def flush(self):
-        if self.curlabel is not None:
-            self.outputReceived.emit(self.curstrs.join(''), self.curlabel)
-        self.curlabel = None
+        self.flushoutput()
         if self.timer.isActive():
             keys = self.topics.keys()
             for topic in keys:
@@ -194,18 +229,22 @@ class CmdThread(QThread):
                 self.progressReceived.emit(topic, None, '', '', None)
             self.topics = {}
 
+    def flushoutput(self):
+        if self.curlabel is not None:
+            self.outputReceived.emit(self.curstrs.join(''), self.curlabel)
+        self.curstrs = QStringList()
+        self.curlabel = None
+        self.curlen = 0
+
     @pyqtSlot(QString, QString)
     def output_handler(self, msg, label):
-        if label != 'control':
-            self.rawoutput.append(msg)
-
-        if label == self.curlabel:
-            self.curstrs.append(msg)
-        else:
-            if self.curlabel is not None:
-                self.outputReceived.emit(self.curstrs.join(''), self.curlabel)
-            self.curstrs = QStringList(msg)
+        if label != self.curlabel:
+            self.flushoutput()
             self.curlabel = label
+        self.curstrs.append(msg)
+        self.curlen += msg.length()
+        if self.curlen > self.FLUSHSIZE:
+            self.flushoutput()
 
     @pyqtSlot(QString, object, QString, QString, object)
     def progress_handler(self, topic, pos, item, unit, total):
@@ -213,37 +252,7 @@ class CmdThread(QThread):
 
     @pyqtSlot(DataWrapper)
     def interact_handler(self, wrapper):
-        prompt, password, choices, default = wrapper.data
-        prompt = hglib.tounicode(prompt)
-        if choices:
-            dlg = QMessageBox(QMessageBox.Question,
-                        _('TortoiseHg Prompt'), prompt, parent=self.parent())
-            dlg.setWindowFlags(Qt.Sheet)
-            dlg.setWindowModality(Qt.WindowModal)
-            for index, choice in enumerate(choices):
-                button = dlg.addButton(hglib.tounicode(choice),
-                                       QMessageBox.ActionRole)
-                button.response = index
-                if index == default:
-                    dlg.setDefaultButton(button)
-            dlg.exec_()
-            button = dlg.clickedButton()
-            if button is 0:
-                self.responseq.put(None)
-            else:
-                self.responseq.put(button.response)
-        else:
-            mode = password and QLineEdit.Password \
-                             or QLineEdit.Normal
-            text, ok = qtlib.getTextInput(self.parent(),
-                         _('TortoiseHg Prompt'),
-                         prompt.title(),
-                         mode=mode)
-            if ok:
-                text = hglib.fromunicode(text)
-            else:
-                text = None
-            self.responseq.put(text)
+        self.responseq.put(askuser(self.parent(), *wrapper.data))
 
     def run(self):
         ui = QtUi(responseq=self.responseq)
@@ -17,7 +17,7 @@ import re
 from mercurial import hg, util, error, match, scmutil, copies
 
 from tortoisehg.hgqt.i18n import _
-from tortoisehg.util import hglib, paths
+from tortoisehg.util import hglib, paths, snapshotstore
 from tortoisehg.hgqt import qtlib, thgrepo
 
 from PyQt4.QtCore import *
@@ -81,13 +81,26 @@ def snapshotset(repo, ctxs, sa, sb, copies, copyworkingdir = False):
     return dirs, labels, fns_and_mtimes
 
 def snapshot(repo, files, ctx):
-    '''snapshot files as of some revision'''
+    '''snapshot files as of some revision
+
+    Snapshots of a revision served by the snapshot store are kept in one
+    tree per revision, which later diff sessions reuse.  The first snapshot
+    of a file still writes it twice, to the store and to the tree, unless
+    the file system supports copy-on-write clones.
+    '''
+    store = None
+    if ctx.rev() is not None and snapshotstore.cacheable(repo):
+        store = snapshotstore.store()
     dirname = os.path.basename(repo.root) or 'root'
-    dirname += '.%d' % _diffCount
-    if ctx.rev() is not None:
-        dirname += '.%d' % ctx.rev()
+    if store:
+        dirname += '.%d.%s' % (ctx.rev(), snapshotstore.treekey(repo, ctx))
+    else:
+        dirname += '.%d' % _diffCount
+        if ctx.rev() is not None:
+            dirname += '.%d' % ctx.rev()
     base = os.path.join(qtlib.gettempdir(), dirname)
     fns_and_mtime = []
+    shared = []
     if not os.path.exists(base):
         os.makedirs(base)
     for fn in files:
@@ -103,18 +116,25 @@ def snapshot(repo, files, ctx):
         try:
             if not os.path.isdir(destdir):
                 os.makedirs(destdir)
+            if store:
+                # Cloned read/only from the snapshot store, to indicate
+                # it's static (archival) nature
+                shared.append((wfn, dest))
+                continue
             data = repo.wwritedata(wfn, ctx[wfn].data())
             f = open(dest, 'wb')
             f.write(data)
             f.close()
             if ctx.rev() is None:
-                fns_and_mtime.append((dest, repo.wjoin(fn), 
+                fns_and_mtime.append((dest, repo.wjoin(fn),
                                     os.lstat(dest).st_mtime))
             else:
                 # Make file read/only, to indicate it's static (archival) nature
                 os.chmod(dest, stat.S_IREAD)
         except EnvironmentError:
             pass
+    if shared:
+        store.materialize(repo, ctx, shared)
     return base, fns_and_mtime
 
 def launchtool(cmd, opts, replace, block):
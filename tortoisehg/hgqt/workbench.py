@@ -10,7 +10,6 @@ Main Qt4 application for TortoiseHg
 
 import os
 import sys
-import getpass # used to get the username on the workbench server
 from mercurial import ui, util
 from mercurial.error import RepoError
 from tortoisehg.util import paths, hglib
@@ -21,12 +20,13 @@ from tortoisehg.hgqt.repowidget import RepoWidget
 from tortoisehg.hgqt.reporegistry import RepoRegistryView
 from tortoisehg.hgqt.logcolumns import ColumnSelectDialog
 from tortoisehg.hgqt.docklog import LogDockWidget
+from tortoisehg.hgqt.docktrace import TraceDockWidget
 from tortoisehg.hgqt.settings import SettingsDialog
-from tortoisehg.hgqt.run import portable_start_fork
+from tortoisehg.hgqt.run import portable_start_fork, qtrun, servername
 
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
-from PyQt4.QtNetwork import QLocalServer, QLocalSocket
+from PyQt4.QtNetwork import QLocalSocket
 
 class ThgTabBar(QTabBar):
     def mouseReleaseEvent(self, event):
@@ -72,6 +72,11 @@ class Workbench(QMainWindow):
         self.log.hide()
         self.addDockWidget(Qt.BottomDockWidgetArea, self.log)
 
+        self.trace = TraceDockWidget(self)
+        self.trace.setObjectName('Trace')
+        self.trace.hide()
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.trace)
+
         self._setupActions()
 
         self.restoreSettings()
@@ -201,6 +206,10 @@ class Workbench(QMainWindow):
         self.docktbar.addAction(a)
         self.menuView.addAction(a)
 
+        a = self.trace.toggleViewAction()
+        a.setText(_('Show &Timings'))
+        self.menuView.addAction(a)
+
         newseparator(menu='view')
         self.menuViewregistryopts = self.menuView.addMenu(_('Repository Registry Options'))
         self.actionShowPaths = \
@@ -1134,7 +1143,7 @@ class Workbench(QMainWindow):
             self.storeSettings()
             self.reporegistry.close()
             if self.server:
-                self.server.close()
+                qtrun.stopServer(self)
             # mimic QDialog exit
             self.finished.emit(0)
 
@@ -1171,32 +1180,25 @@ class Workbench(QMainWindow):
         sd.exec_()
 
     def createWorkbenchServer(self):
-        self.server = QLocalServer()
-        self.server.newConnection.connect(self.newConnection)
-        self.server.listen(qApp.applicationName()+ '-' + getpass.getuser())
-
-    def newConnection(self):
-        socket = self.server.nextPendingConnection()
-        if socket:
-            socket.waitForReadyRead(10000)
-            root = str(socket.readAll())
-            if root and root != '[echo]':
-                self._openRepo(root, reuse=True)
-
-                # Bring the workbench window to the front
-                # This assumes that the client process has
-                # called allowSetForegroundWindow(-1) right before
-                # sending the request
-                self.setWindowState(self.windowState() & ~Qt.WindowMinimized
-                                    | Qt.WindowActive)
-                self.show()
-                self.raise_()
-                self.activateWindow()
-                # Revoke the blanket permission to set the foreground window
-                allowSetForegroundWindow(os.getpid())
-
-            socket.write(QByteArray(root))
-            socket.flush()
+        # the application server also runs other thg commands on request
+        qtrun.startServer(self)
+        self.server = qtrun.serving()
+
+    def showRepoFromServer(self, root):
+        'Open a repository requested by connectToExistingWorkbench()'
+        self._openRepo(root, reuse=True)
+
+        # Bring the workbench window to the front
+        # This assumes that the client process has
+        # called allowSetForegroundWindow(-1) right before
+        # sending the request
+        self.setWindowState(self.windowState() & ~Qt.WindowMinimized
+                            | Qt.WindowActive)
+        self.show()
+        self.raise_()
+        self.activateWindow()
+        # Revoke the blanket permission to set the foreground window
+        allowSetForegroundWindow(os.getpid())
 
 def allowSetForegroundWindow(processid=-1):
     """Allow a given process to set the foreground window"""
@@ -1226,8 +1228,7 @@ def connectToExistingWorkbench(root=None):
     else:
         data = '[echo]'
     socket = QLocalSocket()
-    socket.connectToServer(qApp.applicationName() + '-' + getpass.getuser(),
-        QIODevice.ReadWrite)
+    socket.connectToServer(servername(), QIODevice.ReadWrite)
     if socket.waitForConnected(10000):
         # Momentarily let any process set the foreground window
         # The server process with revoke this permission as soon as it gets
@@ -1262,7 +1263,13 @@ def run(ui, *pats, **opts):
     # the workbench server
     singleworkbenchmode = ui.configbool('tortoisehg', 'workbench.single', True)
     mustcreateserver = False
-    if singleworkbenchmode:
+    if singleworkbenchmode and qtrun.serving():
+        # we are the server; reuse our own workbench if there is one
+        if qtrun.workbench and root and not opts.get('newworkbench'):
+            qtrun.workbench.showRepoFromServer(root)
+            return None
+        mustcreateserver = not qtrun.workbench
+    elif singleworkbenchmode:
         newworkbench = opts.get('newworkbench')
         if root and not newworkbench:
             if connectToExistingWorkbench(root):
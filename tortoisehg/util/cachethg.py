@@ -9,7 +9,7 @@ import os
 import sys
 
 from mercurial import hg, util, ui, node, merge, error, scmutil
-from tortoisehg.util import paths, debugthg, hglib
+from tortoisehg.util import paths, debugthg, hglib, tracing
 
 debugging = False
 enabled = True
@@ -200,6 +200,7 @@ def get_states(upath, repo=None):
      # get file status
     tc1 = GetTickCount()
 
+    start = tracing.now()
     try:
         matcher = scmutil.match(repo[None], [pdir])
         repostate = repo.status(match=matcher, ignored=True,
@@ -208,6 +209,7 @@ def get_states(upath, repo=None):
         debugf("abort: %s", inst)
         debugf("treat as unknown : %s", path)
         return UNKNOWN
+    tracing.record('cachethg.status', start)
 
     debugf("status() took %g ticks", (GetTickCount() - tc1))
     mergestate = repo.dirstate.parents()[1] != node.nullid and \
@@ -240,5 +242,83 @@ def get_states(upath, repo=None):
     return status
 
 
+def get_states_batch(upaths, repo):
+    """
+    Get the states of several paths of repo from a single status walk.
+
+    Returns {upath: states}.  Like get_states(), the states of a directory
+    are those of the files below it.  The overlay cache is not used.
+    """
+    root = repo.root
+    rootprefix = os.path.join(root, '')
+    result = {}
+    rels = {}
+    for upath in upaths:
+        try:
+            # handle some Asian charsets
+            path = upath.encode('mbcs')
+        except:
+            path = upath
+        path = path.rstrip(os.sep) or path
+        if path == root or os.path.isdir(os.path.join(path, '.hg')):
+            result[upath] = ROOT
+        elif not path.startswith(rootprefix):
+            result[upath] = NOT_IN_REPO
+        else:
+            rel = util.pconvert(path[len(rootprefix):])
+            if rel == '.hg' or rel.startswith('.hg/'):
+                result[upath] = NOT_IN_REPO
+            else:
+                rels[upath] = rel
+    if not rels:
+        return result
+
+    start = tracing.now()
+    try:
+        matcher = scmutil.match(repo[None],
+                                ['path:' + r for r in rels.itervalues()])
+        repostate = repo.status(match=matcher, ignored=True,
+                                clean=True, unknown=True)
+    except util.Abort, inst:
+        debugf("abort: %s", inst)
+        for upath in rels:
+            result[upath] = UNKNOWN
+        return result
+    tracing.record('cachethg.batch', start, {'paths': len(rels)})
+
+    states = list(STATUS_STATES)
+    if repo.dirstate.parents()[1] != node.nullid and \
+       hasattr(merge, 'mergestate'):
+        mstate = merge.mergestate(repo)
+        unresolved = [f for f in mstate if mstate[f] == 'u']
+        if unresolved:
+            modified = repostate[0]
+            modified[:] = set(modified) - set(unresolved)
+            repostate.insert(0, unresolved)
+            states.insert(0, UNRESOLVED)
+    states = zip(repostate, states)
+    states[-1], states[-2] = states[-2], states[-1] #clean before ignored
+
+    found = {}  # {relpath: set of states of it or below it}
+    for grp, st in states:
+        for f in grp:
+            while True:
+                s = found.setdefault(f, set())
+                if st in s:
+                    break  # so do all parent directories
+                s.add(st)
+                if not f:
+                    break
+                f = os.path.dirname(f)
+    order = [st for grp, st in states]
+    for upath, rel in rels.iteritems():
+        s = found.get(rel)
+        if s:
+            result[upath] = ''.join([st for st in order if st in s])
+        else:
+            result[upath] = UNKNOWN
+    return result
+
+
 def add(path, state):
     overlay_cache[path] = overlay_cache.get(path, '') + state
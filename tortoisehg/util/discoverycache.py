@@ -0,0 +1,103 @@
+# discoverycache.py - remember common heads between repositories and remotes
+#
+# Copyright 2012 TortoiseHg Developers
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""Per repository and remote cache of the last known common heads
+
+Once installed by setup(), incoming, outgoing, push and pull dispatched
+in this process (cmdui's command threads) start from the common heads
+found by the previous discovery against the same remote.  Instead of a
+full discovery, the remote is asked in one round trip whether it still
+knows those heads and which of the local changesets above them it has.
+If the remote lost any of them, they were stripped or rolled back
+locally, or too many local changesets need to be checked, the usual
+discovery runs and refreshes the cache.  Thus entries need not be
+invalidated.  Without --force, a remote without common heads also goes
+through the usual discovery, which refuses unrelated repositories.
+
+The changesets found by the last outgoing query of a repository are kept
+for takeoutgoing(), so that callers need not parse the command output.
+"""
+
+from mercurial import discovery, extensions, revset, util, error
+from mercurial.node import nullid
+
+MAXCANDIDATES = 1000   # beyond this, a full discovery is cheaper
+
+_commonheads = {}  # {(root, url): [node]}
+_outgoing = {}     # {root: discovery.outgoing}
+_installed = False
+
+def _key(repo, remote):
+    return (repo.root, util.hidepassword(remote.url()))
+
+def _heads(repo, nodes):
+    nodes = [n for n in nodes if n != nullid]
+    if not nodes:
+        return [nullid]
+    cl = repo.changelog
+    spec = revset.formatspec('heads(%ln)', nodes)
+    return [cl.node(r) for r in revset.match(None, spec)(repo, range(len(cl)))]
+
+def _fastcommon(repo, remote, cached):
+    '''Common heads derived from the cached ones with a single known()
+    query, or None if a full discovery is needed'''
+    cl = repo.changelog
+    if not util.all(n in cl.nodemap for n in cached):
+        return None  # stripped locally
+    candidates = cl.findmissing(cached, repo.heads())
+    if len(candidates) > MAXCANDIDATES:
+        return None
+    known = remote.known(list(cached) + candidates)
+    if not util.all(known[:len(cached)]):
+        return None  # stripped remotely
+    common = list(cached)
+    common.extend(n for n, k in zip(candidates, known[len(cached):]) if k)
+    return _heads(repo, common)
+
+def _findcommonincoming(orig, repo, remote, heads=None, force=False):
+    key = _key(repo, remote)
+    cached = _commonheads.get(key)
+    if (cached and not heads and remote.capable('known')
+        and (force or cached != [nullid])):
+        try:
+            common = _fastcommon(repo, remote, cached)
+            if common is not None:
+                srvheads = remote.heads()
+        except (error.RepoError, error.ResponseError):
+            common = None
+        if common is not None:
+            nodemap = repo.changelog.nodemap
+            anyinc = not util.all(h in nodemap for h in srvheads)
+            _commonheads[key] = common
+            return common, anyinc, srvheads
+    common, anyinc, srvheads = orig(repo, remote, heads=heads, force=force)
+    _commonheads[key] = list(common)
+    return common, anyinc, srvheads
+
+def _findcommonoutgoing(orig, repo, other, *args, **kwargs):
+    og = orig(repo, other, *args, **kwargs)
+    _outgoing[repo.root] = og
+    return og
+
+def setup():
+    'Install the cache into this process'
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    extensions.wrapfunction(discovery, 'findcommonincoming',
+                            _findcommonincoming)
+    extensions.wrapfunction(discovery, 'findcommonoutgoing',
+                            _findcommonoutgoing)
+
+def takeoutgoing(root):
+    '''Nodes of the changesets found by the last outgoing query run for
+    the repository at root, or None; the result is returned only once'''
+    og = _outgoing.pop(root, None)
+    if og is None:
+        return None
+    return og.missing
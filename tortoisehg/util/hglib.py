@@ -823,3 +823,26 @@ def getLineSeparator(line):
 def dispatch(ui, args):
     req = hgdispatch.request(args, ui)
     return hgdispatch._dispatch(req)
+
+# global options taking a value, as separate argument or after '='
+_globalvalueopts = ('-R', '--repository', '--cwd', '--config', '--encoding',
+                    '--encodingmode')
+
+def commandname(cmdline):
+    '''Canonical name of the hg command of cmdline, skipping global
+    options; aliases and unambiguous prefixes are resolved if the command
+    is known, else the name is returned as given'''
+    args = iter(cmdline)
+    for arg in args:
+        if arg in _globalvalueopts:
+            next(args, None)
+        elif not arg.startswith('-'):
+            break
+    else:
+        return ''
+    from mercurial import commands
+    try:
+        aliases = cmdutil.findcmd(arg, commands.table, False)[0]
+    except (error.AmbiguousCommand, error.UnknownCommand):
+        return arg
+    return aliases[0].lstrip('^')
@@ -5,8 +5,6 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2, incorporated herein by reference.
 
-import os
-
 from mercurial import hg, ui, node, error
 
 from tortoisehg.util.i18n import _ as gettext
@@ -263,15 +261,15 @@ class menuThg:
         Commands are instances of TortoiseMenu, TortoiseMenuSep or TortoiseMenu
         """
         states = set()
-        onlyfiles = len(files) > 0
         hashgignore = False
         for f in files:
-            if not os.path.isfile(f):
-                onlyfiles = False
             if f.endswith('.hgignore'):
                 hashgignore = True
-            states.update(cachethg.get_states(f, repo))
-        if not files:
+        if files:
+            # one status walk for the whole selection
+            for s in cachethg.get_states_batch(files, repo).itervalues():
+                states.update(s)
+        else:
             states.update(cachethg.get_states(cwd, repo))
             if cachethg.ROOT in states and len(states) == 1:
                 states.add(cachethg.MODIFIED)
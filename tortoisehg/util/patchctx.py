@@ -7,6 +7,7 @@
 
 import os
 import sys
+import copy
 import shlex
 import binascii
 import cStringIO
@@ -18,9 +19,151 @@ from hgext import mq, record
 
 from tortoisehg.util import hglib
 
-class patchctx(object):
+_MAXCACHED = 256
+_parsedcache = {}  # {path: _parsedpatch}
+_lastused = {}     # {path: clock}, to evict the least recently used
+_clock = 0
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_mtime, st.st_size
+
+class _parsedpatch(object):
+    """Header, file list and hunks of a patch file
+
+    Instances are shared by all patchctx objects of the same file while its
+    mtime and size are unchanged; see parsedpatch().  The hunks are parsed
+    on first use.  ph, the mq.patchheader, is shared read-only; patchctx
+    copies the file list and hunks, which its users modify.
+    """
     _parseErrorFileName = '*ParseError*'
 
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.fsize = 0
+        self.ph = None
+        self.identity = node.nullid
+        self.user = ''
+        self.desc = ''
+        self.branch = ''
+        self.node = node.nullid
+        self.hasnode = False
+        self.date = None
+        self.status = [[], [], []]
+        self.fileorder = []
+        self.parseerror = None
+        self._files = None
+
+        try:
+            self.mtime, self.fsize = _stamp(path)
+            ph = mq.patchheader(path)
+            self.ph = ph
+            hash = util.sha1(path)
+            hash.update(str(self.mtime))
+            self.identity = hash.digest()
+        except EnvironmentError:
+            return
+
+        try:
+            self.branch = ph.branch or ''
+            self.node = binascii.unhexlify(ph.nodeid)
+            self.hasnode = True
+        except TypeError:
+            pass
+        except AttributeError:
+            # hacks to try to deal with older versions of mq.py
+            self.branch = ''
+            ph.diffstartline = len(ph.comments)
+            if ph.message:
+                ph.diffstartline += 1
+
+        self.user = ph.user or ''
+        self.desc = ph.message and '\n'.join(ph.message).strip() or ''
+        try:
+            self.date = ph.date and util.parsedate(ph.date) or None
+        except error.Abort:
+            pass
+
+    def files(self):
+        if self._files is None:
+            self._files = self._parsefiles()
+        return self._files
+
+    def _parsefiles(self):
+        if self.ph is None or not self.ph.haspatch:
+            return {}
+
+        M, A, R = 0, 1, 2
+        def get_path(a, b):
+            type = (a == '/dev/null') and A or M
+            type = (b == '/dev/null') and R or type
+            rawpath = (b != '/dev/null') and b or a
+            if not (rawpath.startswith('a/') or rawpath.startswith('b/')):
+                return type, rawpath
+            return type, rawpath.split('/', 1)[-1]
+
+        files = {}
+        pf = open(self.path, 'rb')
+        try:
+            try:
+                # consume comments and headers
+                for i in range(self.ph.diffstartline):
+                    pf.readline()
+                for chunk in record.parsepatch(pf):
+                    if not isinstance(chunk, record.header):
+                        continue
+                    top = patch.parsefilename(chunk.header[-2])
+                    bot = patch.parsefilename(chunk.header[-1])
+                    type, path = get_path(top, bot)
+                    if path not in chunk.files():
+                        type, path = 0, chunk.files()[-1]
+                    if path not in files:
+                        self.status[type].append(path)
+                        files[path] = [chunk]
+                        self.fileorder.append(path)
+                    files[path].extend(chunk.hunks)
+            except (patch.PatchError, AttributeError), e:
+                self.status[2].append(self._parseErrorFileName)
+                files[self._parseErrorFileName] = []
+                self.parseerror = e
+                if 'THGDEBUG' in os.environ:
+                    print e
+        finally:
+            pf.close()
+        return files
+
+def _touch(path):
+    global _clock
+    _clock += 1
+    _lastused[path] = _clock
+
+def parsedpatch(path):
+    """Return the parsed patch file at path, from the cache if its mtime
+    and size are unchanged"""
+    cached = _parsedcache.get(path)
+    if cached is not None and cached.mtime is not None:
+        try:
+            if _stamp(path) == (cached.mtime, cached.fsize):
+                _touch(path)
+                return cached
+        except EnvironmentError:
+            pass
+    pp = _parsedpatch(path)
+    if path not in _parsedcache and len(_parsedcache) >= _MAXCACHED:
+        invalidatepatch(min(_lastused, key=_lastused.__getitem__))
+    _parsedcache[path] = pp
+    _touch(path)
+    return pp
+
+def invalidatepatch(path):
+    'Drop the cached parse of the patch file at path'
+    _parsedcache.pop(path, None)
+    _lastused.pop(path, None)
+
+class patchctx(object):
+    _parseErrorFileName = _parsedpatch._parseErrorFileName
+
     def __init__(self, patchpath, repo, pf=None, rev=None):
         """ Read patch context from file
         :param pf: currently ignored
@@ -32,56 +175,34 @@ class patchctx(object):
         self._patchname = os.path.basename(patchpath)
         self._repo = repo
         self._rev = rev or 'patch'
-        self._status = [[], [], []]
-        self._fileorder = []
-        self._user = ''
-        self._desc = ''
-        self._branch = ''
-        self._node = node.nullid
-        self._identity = node.nullid
-        self._mtime = None
-        self._fsize = 0
-        self._parseerror = None
+        self._parsed = pp = parsedpatch(patchpath)
+        self._user = pp.user
+        self._desc = pp.desc
+        self._branch = pp.branch
+        self._node = pp.node
+        self._identity = pp.identity
+        self._mtime = pp.mtime
+        self._fsize = pp.fsize
+        self._date = pp.date or util.makedate()
         self._phase = 'draft'
-
-        try:
-            self._mtime = os.path.getmtime(patchpath)
-            self._fsize = os.path.getsize(patchpath)
-            ph = mq.patchheader(self._path)
-            self._ph = ph
-            hash = util.sha1(self._path)
-            hash.update(str(self._mtime))
-            self._identity = hash.digest()
-        except EnvironmentError:
-            self._date = util.makedate()
+        if pp.ph is None:
             return
+        self._ph = pp.ph
 
         try:
-            self._branch = ph.branch or ''
-            self._node = binascii.unhexlify(ph.nodeid)
-            if self._repo.ui.configbool('mq', 'secret'):
+            if pp.hasnode and self._repo.ui.configbool('mq', 'secret'):
                 self._phase = 'secret'
-        except TypeError:
-            pass
-        except AttributeError:
-            # hacks to try to deal with older versions of mq.py
-            self._branch = ''
-            ph.diffstartline = len(ph.comments)
-            if ph.message:
-                ph.diffstartline += 1
         except error.ConfigError:
             pass
 
-        self._user = ph.user or ''
-        self._desc = ph.message and '\n'.join(ph.message).strip() or ''
-        try:
-            self._date = ph.date and util.parsedate(ph.date) or util.makedate()
-        except error.Abort:
-            self._date = util.makedate()
+    @property
+    def _parseerror(self):
+        return self._parsed.parseerror
 
     def invalidate(self):
         # ensure the patch contents are re-read
         self._mtime = 0
+        invalidatepatch(self._path)
 
     @property
     def substate(self):
@@ -184,46 +305,21 @@ class patchctx(object):
     def phasestr(self):
         return self._phase
 
+    # copies of the parsed patch, as they are modified by chunks.py
+
     @propertycache
     def _files(self):
-        if not hasattr(self, '_ph') or not self._ph.haspatch:
-            return {}
-
-        M, A, R = 0, 1, 2
-        def get_path(a, b):
-            type = (a == '/dev/null') and A or M
-            type = (b == '/dev/null') and R or type
-            rawpath = (b != '/dev/null') and b or a
-            if not (rawpath.startswith('a/') or rawpath.startswith('b/')):
-                return type, rawpath
-            return type, rawpath.split('/', 1)[-1]
-
         files = {}
-        pf = open(self._path, 'rb')
-        try:
-            try:
-                # consume comments and headers
-                for i in range(self._ph.diffstartline):
-                    pf.readline()
-                for chunk in record.parsepatch(pf):
-                    if not isinstance(chunk, record.header):
-                        continue
-                    top = patch.parsefilename(chunk.header[-2])
-                    bot = patch.parsefilename(chunk.header[-1])
-                    type, path = get_path(top, bot)
-                    if path not in chunk.files():
-                        type, path = 0, chunk.files()[-1]
-                    if path not in files:
-                        self._status[type].append(path)
-                        files[path] = [chunk]
-                        self._fileorder.append(path)
-                    files[path].extend(chunk.hunks)
-            except (patch.PatchError, AttributeError), e:
-                self._status[2].append(self._parseErrorFileName)
-                files[self._parseErrorFileName] = []
-                self._parseerror = e
-                if 'THGDEBUG' in os.environ:
-                    print e
-        finally:
-            pf.close()
+        for wfile, chunks in self._parsed.files().iteritems():
+            files[wfile] = [copy.copy(c) for c in chunks]
         return files
+
+    @propertycache
+    def _status(self):
+        self._parsed.files()
+        return [list(l) for l in self._parsed.status]
+
+    @propertycache
+    def _fileorder(self):
+        self._parsed.files()
+        return list(self._parsed.fileorder)
@@ -0,0 +1,240 @@
+# snapshotstore.py - content-addressed store of file revisions
+#
+# Copyright 2012 TortoiseHg Developers
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""Shared store of file revisions for visual diff snapshots
+
+Blobs are keyed by filelog node and the repository's decode and eol
+settings, so the same file revision is read from the repository once and
+shared by all snapshots of all diff sessions.  Snapshot files are
+materialized as copy-on-write clones of the blobs where the file system
+allows it, or as copies; never as hardlinks, since editors may write to
+snapshot files in place.
+"""
+
+import os, sys, stat, errno, shutil, tempfile, threading, thread, time
+import Queue
+
+from mercurial import hg, util, error, bundlerepo, node
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl(dest, FICLONE, src) clones a file on btrfs, xfs, ...
+_FICLONE = 0x40049409
+
+MAXAGE = 7 * 24 * 3600   # remove blobs unused for a week
+MAXSIZE = 1024 ** 3      # and the least recently used above 1GB
+MAXWORKERS = 4
+_PARALLELMIN = 32        # fetch in parallel only above this many files
+
+def storepath():
+    try:
+        import getpass
+        user = getpass.getuser()
+    except Exception:
+        user = ''
+    name = 'thg-snapshots'
+    if user:
+        name += '.' + user
+    return os.path.join(tempfile.gettempdir(), name)
+
+def cacheable(repo):
+    '''Whether the snapshots of repo depend on filelog node and filters
+    only; keyword expansion also depends on the changeset'''
+    return not repo.ui.configitems('keyword')
+
+def _filterkey(repo):
+    '''Identify the filters applied by repo.wwritedata(), including the
+    decode patterns and settings of the eol extension'''
+    items = (sorted(repo.ui.configitems('decode'))
+             + sorted(repo.ui.configitems('eol')))
+    return util.sha1(repr(items)).hexdigest()[:8]
+
+def treekey(repo, ctx):
+    '''Identify the snapshot tree of ctx in repo, so later diff sessions
+    can reuse the files already materialized for the same revision'''
+    key = '\0'.join([repo.root, ctx.hex(), _filterkey(repo)])
+    return util.sha1(key).hexdigest()[:12]
+
+def _checkprivate(path):
+    '''Raise OSError unless path is a directory only accessible by the
+    current user; another user may have created it in the shared temp dir'''
+    if not hasattr(os, 'getuid'):
+        return
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+        or stat.S_IMODE(st.st_mode) & 077):
+        raise OSError(errno.EPERM, 'snapshot store is not private', path)
+
+def _makedirs(path, mode=0777):
+    try:
+        os.makedirs(path, mode)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _clonefile(src, dest):
+    '''Create dest with the content of src, preferably sharing storage:
+    copy-on-write clone, then plain copy'''
+    if fcntl and sys.platform.startswith('linux'):
+        try:
+            fs = open(src, 'rb')
+            try:
+                fd = open(dest, 'wb')
+                try:
+                    fcntl.ioctl(fd.fileno(), _FICLONE, fs.fileno())
+                    return
+                finally:
+                    fd.close()
+            finally:
+                fs.close()
+        except EnvironmentError:
+            pass
+    shutil.copyfile(src, dest)
+
+class SnapshotStore(object):
+    """Blobs of file revisions below path, <hex[:2]>/<hex[2:]>.<filterkey>"""
+
+    def __init__(self, path=None):
+        self.path = path or storepath()
+
+    def blobpath(self, filenode, filterkey):
+        h = node.hex(filenode)
+        return os.path.join(self.path, h[:2], '%s.%s' % (h[2:], filterkey))
+
+    def materialize(self, repo, ctx, files):
+        '''Write the (wfn, dest) pairs of files from ctx, sharing storage
+        with the store where possible; the written files are read-only'''
+        filterkey = _filterkey(repo)
+        jobs = []
+        missing = {}
+        for wfn, dest in files:
+            filenode = ctx[wfn].filenode()
+            blob = self.blobpath(filenode, filterkey)
+            jobs.append((blob, dest))
+            if blob not in missing and not os.path.exists(blob):
+                missing[blob] = (wfn, filenode, blob)
+        self._fetch(repo, missing.values())
+        for blob, dest in jobs:
+            # snapshot trees outlive the diff session; never leave a
+            # partial file behind at dest
+            tmp = '%s.%d.tmp' % (dest, os.getpid())
+            try:
+                _clonefile(blob, tmp)
+                os.chmod(tmp, stat.S_IREAD)
+                util.rename(tmp, dest)
+                os.utime(blob, None)
+            except EnvironmentError:
+                try:
+                    os.chmod(tmp, stat.S_IREAD | stat.S_IWRITE)
+                    os.unlink(tmp)
+                except EnvironmentError:
+                    pass
+
+    def _fetch(self, repo, missing):
+        'Store the missing (wfn, filenode, blob) entries'
+        nworkers = min(MAXWORKERS, len(missing) // _PARALLELMIN)
+        if nworkers < 2 or isinstance(repo, bundlerepo.bundlerepository):
+            for wfn, filenode, blob in missing:
+                self._store(repo, wfn, filenode, blob)
+            return
+        q = Queue.Queue()
+        for item in missing:
+            q.put(item)
+        def worker():
+            # revlogs are not thread-safe; each worker opens its own repo
+            try:
+                r = hg.repository(repo.ui, repo.root)
+            except error.RepoError:
+                return
+            while True:
+                try:
+                    wfn, filenode, blob = q.get_nowait()
+                except Queue.Empty:
+                    return
+                self._store(r, wfn, filenode, blob)
+        threads = [threading.Thread(target=worker, name='snapshot')
+                   for i in xrange(nworkers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # anything left over if a worker could not open the repository
+        while not q.empty():
+            self._store(repo, *q.get_nowait())
+
+    def _store(self, repo, wfn, filenode, blob):
+        tmp = '%s.%d.%d.tmp' % (blob, os.getpid(), thread.get_ident())
+        try:
+            data = repo.wwritedata(wfn, repo.file(wfn).read(filenode))
+            _makedirs(os.path.dirname(blob), 0700)
+            f = open(tmp, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.chmod(tmp, stat.S_IREAD)
+            util.rename(tmp, blob)
+        except (EnvironmentError, error.LookupError):
+            try:
+                os.chmod(tmp, stat.S_IREAD | stat.S_IWRITE)
+                os.unlink(tmp)
+            except EnvironmentError:
+                pass
+
+    def gc(self, maxage=MAXAGE, maxsize=MAXSIZE):
+        '''Remove blobs unused for maxage seconds, then the least recently
+        used ones while the store is larger than maxsize bytes
+
+        Snapshot files cloned from a removed blob keep their content.
+        '''
+        now = time.time()
+        blobs = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except EnvironmentError:
+                    continue
+                if fn.endswith('.tmp') and now - st.st_mtime < 3600:
+                    continue  # possibly being written by another process
+                blobs.append((st.st_mtime, st.st_size, path))
+        blobs.sort()
+        total = sum(b[1] for b in blobs)
+        for mtime, size, path in blobs:
+            if now - mtime < maxage and total <= maxsize:
+                break
+            try:
+                os.chmod(path, stat.S_IREAD | stat.S_IWRITE)
+                os.unlink(path)
+                total -= size
+            except EnvironmentError:
+                pass
+
+_store = None
+
+def store():
+    '''Shared snapshot store, or None if its directory cannot be created
+    or is not private to the user; stale blobs are collected in the
+    background the first time it is used by a process'''
+    global _store
+    if _store is None:
+        st = SnapshotStore()
+        try:
+            _makedirs(st.path, 0700)
+            _checkprivate(st.path)
+        except EnvironmentError:
+            _store = False
+            return None
+        _store = st
+        t = threading.Thread(target=_store.gc, name='snapshotgc')
+        t.setDaemon(True)
+        t.start()
+    return _store or None
@@ -0,0 +1,101 @@
+# startupprof.py - measure the startup time of thg
+#
+# Copyright 2012 TortoiseHg Developers
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""Per-module import times and time to first window for --profile-startup
+
+This module must not import Qt or Mercurial itself, so that it can be
+enabled by the thg script before anything else is loaded.
+"""
+
+import sys, time
+import __builtin__
+
+_starttime = None
+_firstwindow = None
+_stack = []    # [child time] of imports in progress
+_records = []  # [(name, total time, self time)]
+_origimport = None
+
+def enabled():
+    return _starttime is not None
+
+def enable():
+    """Start timing imports
+
+    If Mercurial's demandimport is active, the real imports happen in
+    demandimport._origimport, which is wrapped instead of __import__.
+    """
+    global _starttime, _origimport
+    if enabled():
+        return
+    _starttime = time.time()
+    demandimport = sys.modules.get('mercurial.demandimport')
+    if demandimport and __builtin__.__import__ is demandimport._demandimport:
+        _origimport = demandimport._origimport
+        demandimport._origimport = _timedimport
+    else:
+        _origimport = __builtin__.__import__
+        __builtin__.__import__ = _timedimport
+
+def _candidates(name, globals, level):
+    """Full names the import of name from the module of globals may load
+
+    Python 2 first tries an implicit relative import from the package of
+    the importing module, then the absolute name.
+    """
+    if not globals or level == 0 or '__name__' not in globals:
+        return [name]
+    pkg = globals['__name__']
+    if '__path__' not in globals:
+        pkg = pkg.rpartition('.')[0]
+    for i in xrange(level - 1):
+        pkg = pkg.rpartition('.')[0]
+    if level > 0:
+        return [('%s.%s' % (pkg, name)).strip('.')]
+    if not pkg:
+        return [name]
+    return ['%s.%s' % (pkg, name), name]
+
+def _timedimport(name, *args, **kwargs):
+    globals = args and args[0] or kwargs.get('globals')
+    if len(args) > 3:
+        level = args[3]
+    else:
+        level = kwargs.get('level', -1)
+    names = _candidates(name, globals, level)
+    # sys.modules maps failed relative lookups to None
+    if [n for n in names if sys.modules.get(n) is not None]:
+        return _origimport(name, *args, **kwargs)
+    _stack.append(0.0)
+    start = time.time()
+    try:
+        return _origimport(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        childtime = _stack.pop()
+        if _stack:
+            _stack[-1] += elapsed
+        loaded = [n for n in names if sys.modules.get(n) is not None]
+        _records.append((loaded and loaded[0] or name, elapsed,
+                         elapsed - childtime))
+
+def windowshown():
+    """Record the time to first window, once"""
+    global _firstwindow
+    if enabled() and _firstwindow is None:
+        _firstwindow = time.time() - _starttime
+
+def report(fp=None, limit=30):
+    """Write import times sorted by self time, and time to first window"""
+    fp = fp or sys.stderr
+    total = sum(r[2] for r in _records)
+    fp.write('%8s %8s  %s\n' % ('self ms', 'total ms', 'module'))
+    for name, elapsed, selftime in sorted(_records, key=lambda r: -r[2])[:limit]:
+        fp.write('%8.1f %8.1f  %s\n' % (selftime * 1000, elapsed * 1000, name))
+    fp.write('%d modules imported in %.1f ms\n' % (len(_records), total * 1000))
+    if _firstwindow is not None:
+        fp.write('first window shown after %.1f ms\n' % (_firstwindow * 1000))
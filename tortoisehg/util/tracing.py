@@ -0,0 +1,117 @@
+# tracing.py - timed spans of hot paths
+#
+# Copyright 2012 TortoiseHg Developers
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""Low overhead recording of timed spans
+
+Instrumented functions are decorated with traced(name); other code calls
+now() before and record(name, start) after the operation.  Nothing is
+recorded unless tracing is enabled, by the tortoisehg.tracing setting,
+the THGTRACE environment variable or setenabled().  The last MAXSPANS
+spans are kept; stats() summarizes them per operation and
+writechrometrace() exports them in the trace event format understood by
+chrome://tracing.
+"""
+
+import os, time, thread
+from collections import deque
+
+try:
+    import json
+except ImportError:
+    json = None
+
+MAXSPANS = 100000
+
+# upper bounds of the histogram buckets, in milliseconds; the last bucket
+# has no bound
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+if os.name == 'nt':
+    now = time.clock
+else:
+    now = time.time
+
+enabled = 'THGTRACE' in os.environ
+_spans = deque(maxlen=MAXSPANS)  # (name, start, duration, thread id, args)
+_epoch = now()
+
+def configure(ui):
+    'Enable tracing from user configuration'
+    setenabled(ui.configbool('tortoisehg', 'tracing')
+               or 'THGTRACE' in os.environ)
+
+def setenabled(value):
+    global enabled
+    enabled = bool(value)
+
+def record(name, start, args=None):
+    '''Record the span of name which began at start, as returned by now();
+    may be called from any thread'''
+    if enabled:
+        _spans.append((name, start, now() - start, thread.get_ident(), args))
+
+def traced(name):
+    'Decorator recording the calls of a function as spans of name'
+    def decorate(func):
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = now()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, start)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorate
+
+def clear():
+    _spans.clear()
+
+def spans():
+    'Recorded spans, oldest first'
+    return list(_spans)
+
+def _bucket(ms):
+    for i, bound in enumerate(BUCKETS):
+        if ms < bound:
+            return i
+    return len(BUCKETS)
+
+def stats():
+    '''Summary of the recorded spans as [(name, count, total secs, max secs,
+    histogram)], where histogram counts the spans of each bucket'''
+    summary = {}
+    for name, start, duration, tid, args in spans():
+        s = summary.get(name)
+        if s is None:
+            s = summary[name] = [0, 0.0, 0.0, [0] * (len(BUCKETS) + 1)]
+        s[0] += 1
+        s[1] += duration
+        s[2] = max(s[2], duration)
+        s[3][_bucket(duration * 1000)] += 1
+    return [(name,) + tuple(s) for name, s in sorted(summary.iteritems())]
+
+def chrometrace():
+    'Recorded spans as a trace event dictionary'
+    pid = os.getpid()
+    events = []
+    for name, start, duration, tid, args in spans():
+        ev = {'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+              'ts': int((start - _epoch) * 1e6), 'dur': int(duration * 1e6),
+              'pid': pid, 'tid': tid}
+        if args:
+            ev['args'] = args
+        events.append(ev)
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def writechrometrace(fp):
+    'Write the recorded spans to the file object fp as JSON'
+    if json is None:
+        raise ImportError('json module is required to export traces')
+    json.dump(chrometrace(), fp)